@@ -0,0 +1,169 @@
+import json
+import logging
+import os
+import re
+import numpy as np
+
+from parse_utils import AMOUNT_HEADS, BudgetHead, BudgetSheet, clean_header
+
+
+class BudgetStore:
+    """
+    All parsed demands in one columnar file, as an alternative to the
+    per-demand JSONs in budget_parsed/.
+
+    Layout:
+        MAGIC | arrays | JSON index | u64 index length
+
+    The JSON index holds the dictionary of distinct head components, the
+    sheet metadata of every demand (with cleaned headers) and the
+    [head_beg, head_end) range of its amount_heads. The arrays, each 8-byte
+    aligned and memory-mapped on load, are:
+        path_offsets: int64[n_heads + 1], head i is path_ids[o[i]:o[i + 1]]
+        path_ids:     int32[n_components], ids into the dictionary
+        amounts:      float64[n_heads]
+        measures:     float64[n_heads * 12], the heads' "amounts" row by row,
+                      only if every head has them
+    """
+
+    MAGIC = b"BUDGETST"
+    VERSION = 1
+
+    def __init__(self, store_path: str) -> None:
+        self.store_path = store_path
+
+        with open(store_path, "rb") as f:
+            magic = f.read(len(self.MAGIC))
+            if magic != self.MAGIC:
+                raise ValueError(f"{store_path} is not a budget store")
+            f.seek(-8, os.SEEK_END)
+            index_len = int(np.frombuffer(f.read(8), dtype="<u8")[0])
+            f.seek(-8 - index_len, os.SEEK_END)
+            index = json.loads(f.read(index_len).decode("utf-8"))
+
+        if index["version"] != self.VERSION:
+            raise ValueError(f"Unsupported store version: {index['version']}")
+
+        self.names: list[str] = index["names"]
+        self.demands: dict[int, dict] = {d["dno"]: d for d in index["demands"]}
+
+        arrays = {}
+        for arr_name, arr_spec in index["arrays"].items():
+            arrays[arr_name] = np.memmap(
+                store_path,
+                dtype=arr_spec["dtype"],
+                mode="r",
+                offset=arr_spec["offset"],
+                shape=(arr_spec["count"],),
+            )
+
+        self.path_offsets = arrays["path_offsets"]
+        self.path_ids = arrays["path_ids"]
+        self.amounts = arrays["amounts"]
+        self.measures = None
+        if "measures" in arrays:
+            self.measures = arrays["measures"].reshape(-1, len(AMOUNT_HEADS))
+
+    @property
+    def demand_ids(self) -> list[int]:
+        return sorted(self.demands.keys())
+
+    def get_header(self, dno: int) -> list[str]:
+        return self.demands[dno]["meta"]["header"]
+
+    def get_heads(self, dno: int) -> list[BudgetHead]:
+        demand = self.demands[dno]
+        head_beg, head_end = demand["head_beg"], demand["head_end"]
+
+        # one sequential read per column for the whole demand
+        offsets = np.asarray(self.path_offsets[head_beg : head_end + 1])
+        path_ids = np.asarray(self.path_ids[offsets[0] : offsets[-1]]).tolist()
+        amounts = np.asarray(self.amounts[head_beg:head_end]).tolist()
+
+        offsets = (offsets - offsets[0]).tolist()
+        all_heads = []
+        for head_idx, amount in enumerate(amounts):
+            path = path_ids[offsets[head_idx] : offsets[head_idx + 1]]
+            all_heads.append({"head": [self.names[i] for i in path], "amount": amount})
+
+        if self.measures is not None:
+            measures = np.asarray(self.measures[head_beg:head_end]).tolist()
+            for head, head_measures in zip(all_heads, measures):
+                head["amounts"] = head_measures
+
+        return all_heads
+
+    def get_sheet(self, dno: int) -> BudgetSheet:
+        sheet: BudgetSheet = dict(self.demands[dno]["meta"])
+        sheet["amount_heads"] = self.get_heads(dno)
+        return sheet
+
+    def get_all_sheets(self) -> dict[int, BudgetSheet]:
+        return {dno: self.get_sheet(dno) for dno in self.demand_ids}
+
+    @classmethod
+    def write(cls, all_sheets: list[BudgetSheet], store_path: str) -> None:
+        get_int = lambda x: int(re.findall(r"\d+", x)[0])
+
+        name_ids: dict[str, int] = {}
+        all_demands = []
+        path_offsets = [0]
+        path_ids = []
+        amounts = []
+        measures = []
+
+        all_sheets = [sheet for sheet in all_sheets if sheet is not None]
+        for sheet in all_sheets:
+            meta = {k: v for k, v in sheet.items() if k != "amount_heads"}
+            meta["header"] = clean_header(list(sheet["header"]))
+            dno = get_int(meta["header"][1])
+
+            head_beg = len(amounts)
+            for head in sheet["amount_heads"]:
+                for name in head["head"]:
+                    path_ids.append(name_ids.setdefault(name, len(name_ids)))
+                path_offsets.append(len(path_ids))
+                amounts.append(head["amount"])
+                measures.append(head.get("amounts"))
+
+            all_demands.append(
+                {"dno": dno, "meta": meta, "head_beg": head_beg, "head_end": len(amounts)}
+            )
+
+        all_arrays = [
+            ("path_offsets", np.array(path_offsets, dtype="<i8")),
+            ("path_ids", np.array(path_ids, dtype="<i4")),
+            ("amounts", np.array(amounts, dtype="<f8")),
+        ]
+        # parses from before the heads had them have none
+        if all(x is not None for x in measures):
+            measures = np.array(measures, dtype="<f8").reshape(-1)
+            all_arrays.append(("measures", measures))
+
+        index = {
+            "version": cls.VERSION,
+            "names": list(name_ids.keys()),
+            "demands": all_demands,
+            "arrays": {},
+        }
+
+        tmp_path = f"{store_path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(cls.MAGIC)
+            for arr_name, arr in all_arrays:
+                f.write(b"\0" * (-f.tell() % 8))
+                index["arrays"][arr_name] = {
+                    "dtype": arr.dtype.str,
+                    "count": len(arr),
+                    "offset": f.tell(),
+                }
+                f.write(arr.tobytes())
+
+            index_bytes = json.dumps(index).encode("utf-8")
+            f.write(index_bytes)
+            f.write(np.array([len(index_bytes)], dtype="<u8").tobytes())
+        os.replace(tmp_path, store_path)
+
+        logging.info(
+            f"Wrote {len(all_demands)} demands ({len(amounts)} heads) to {store_path}"
+        )
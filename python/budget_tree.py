@@ -1,6 +1,7 @@
+import itertools
 import logging
 import re
-from typing import TypedDict
+from typing import Iterator, TypedDict
 import numpy as np
 import pandas as pd
 import os
@@ -21,46 +22,144 @@ class BudgetNode:
     INR_ONE_CRORE = INR_ONE_LAKH * 100
     INR_ONE_LAKH_CRORE = INR_ONE_CRORE * INR_ONE_LAKH
 
-    def __init__(self, name: str, total_init: float) -> None:
-        self.name = name.strip()
-        if "Demand No." in self.name:
-            logging.warn("Demand No. found in name. Removing.")
-            self.name = self.name.split("\n")[2]
+    # children sort keys, indexes into get_sort_vals
+    ORDER_INIT, ORDER_TOTAL, ORDER_MAX = range(3)
+    # pending keys kept to order ties, see _flush_sort
+    MAX_SORT_KEYS = 4
+    # stamps of the changes of sort values, they order the ties
+    _change_seq = itertools.count()
 
+    def __init__(self, name: str, total_init: float) -> None:
+        self.name = self.clean_name(name)
         self.key = self.sanitize_str(name)
         self.total_init = total_init
         self.total_children = 0
-        self.children: list["BudgetNode"] = []
-        self.child_index: dict[str, int] = {}
+        # sum of get_total_children_recursive of the children, kept by deltas,
+        # and whether total_children was last set from it (see finalize)
+        self._rec_children = 0
+        self._total_is_rec = False
+        # last sorted order, then the children added since, see children
+        self._children: list["BudgetNode"] = []
+        self._sort_keys: list[tuple[int, int]] = []
+        # get_sort_vals and when each last changed, see _touch
+        self._sort_vals = self.get_sort_vals(self)
+        self._seqs = [next(self._change_seq)] * len(self._sort_vals)
+        self._has_dup_keys = False
+        self.child_index: dict[str, "BudgetNode"] = {}
+        # the index of the tree this node is in, and its path there
+        self._path_index: "PathIndex" = None
+        self._path: tuple[str, ...] = ()
+
+    @property
+    def children(self) -> list["BudgetNode"]:
+        """
+        Children by total, largest first. Inserts only append and record the
+        key of the change (one of the ORDER_* keys), the list is sorted here
+        when first read after changes and then kept until the next one.
+        """
+        self._flush_sort()
+        return self._children
+
+    def _flush_sort(self) -> None:
+        # Sorting on every insert left the ties of a key in the order of
+        # their last change while it was in use (see _touch), and those
+        # unchanged since in the order of the key before. So the keys used
+        # since the last sort go newest first, each with the stamp of its
+        # first use, and the remaining ties keep the last sorted order.
+        # Older keys than the last MAX_SORT_KEYS no longer decide ties.
+        if len(self._sort_keys) > 0:
+            sort_keys = self._sort_keys
+
+            def get_sort_key(node) -> tuple:
+                sort_vals = self.get_sort_vals(node)
+                sort_key = []
+                for key_idx, seq_beg in sort_keys:
+                    seq = node._seqs[key_idx]
+                    if abs(seq) < seq_beg:
+                        seq = seq_beg
+                    sort_key += [sort_vals[key_idx], -seq]
+                return tuple(sort_key)
+
+            self._children.sort(key=get_sort_key, reverse=True)
+            self._sort_keys = []
+
+    @staticmethod
+    def get_sort_vals(node: "BudgetNode") -> tuple[float, float, float]:
+        # by ORDER_INIT, ORDER_TOTAL and ORDER_MAX, of nodes and views
+        return (
+            node.total_init,
+            node.get_total(),
+            max(node.total_init, node.total_children),
+        )
 
-    def sanitize_str(self, s: str) -> str:
+    def _set_sort_key(self, sort_key: int) -> None:
+        if len(self._sort_keys) == 0 or self._sort_keys[0][0] != sort_key:
+            self._sort_keys.insert(0, (sort_key, next(self._change_seq)))
+            del self._sort_keys[self.MAX_SORT_KEYS :]
+
+    def _touch(self) -> None:
+        # Restamp the sort values that changed, the others keep their ties.
+        # A value that went up was below its new ties and goes after them,
+        # one that went down was above them and goes first (negative stamp).
+        sort_vals = self.get_sort_vals(self)
+        for idx, val in enumerate(sort_vals):
+            if val > self._sort_vals[idx]:
+                self._seqs[idx] = next(self._change_seq)
+            elif val < self._sort_vals[idx]:
+                self._seqs[idx] = -next(self._change_seq)
+        self._sort_vals = sort_vals
+
+    def _insert_child(self, child_node: "BudgetNode") -> None:
+        if child_node.key in self.child_index:
+            self._has_dup_keys = True
+        # appended last, so after every tie, as sorting on insert left it
+        child_node._seqs = [next(self._change_seq)] * len(self._seqs)
+        self._children.append(child_node)
+        self.child_index[child_node.key] = child_node
+        if self._path_index is not None:
+            self._path_index.add_subtree(self._path + (child_node.key,), child_node)
+
+    @staticmethod
+    def clean_name(name: str) -> str:
+        name = name.strip()
+        if "Demand No." in name:
+            logging.warn("Demand No. found in name. Removing.")
+            name = name.split("\n")[2]
+
+        return name
+
+    @staticmethod
+    def sanitize_str(s: str) -> str:
         s = s.strip()
         s = re.sub(r"\s+", "", s)
         s = s.lower()
         return s
 
     def add_child(self, child_str: str, child_total: float) -> None:
+        self._set_sort_key(self.ORDER_INIT)
         child_check = self.get_child(child_str)
         if child_check is not None:
             logging.warn("Child already exists. Updating total.")
+            rec_prev = child_check._get_total_rec()
             child_check.total_init += child_total
+            child_check._touch()
+            self._rec_children += child_check._get_total_rec() - rec_prev
         else:
-            self.children.append(BudgetNode(child_str, child_total))
+            child_node = BudgetNode(child_str, child_total)
+            self._insert_child(child_node)
+            self._rec_children += child_node._get_total_rec()
 
         self.total_children += child_total
-
-        self.children = sorted(self.children, key=lambda x: x.total_init, reverse=True)
-        child_keys = [child.key for child in self.children]
-        child_idxes = list(range(len(self.children)))
-        self.child_index = dict(zip(child_keys, child_idxes))
+        self._total_is_rec = False
+        self._touch()
 
     def add_child_node(self, child_node: "BudgetNode") -> None:
-        self.children.append(child_node)
+        self._set_sort_key(self.ORDER_TOTAL)
+        self._insert_child(child_node)
         self.total_children += child_node.get_total()
-        self.children = sorted(self.children, key=lambda x: x.get_total(), reverse=True)
-        child_keys = [child.key for child in self.children]
-        child_idxes = list(range(len(self.children)))
-        self.child_index = dict(zip(child_keys, child_idxes))
+        self._rec_children += child_node._get_total_rec()
+        self._total_is_rec = False
+        self._touch()
 
     def add_child_ls(self, child_ls: list[str], child_total: float) -> None:
         if len(child_ls) == 0:
@@ -78,9 +177,10 @@ class BudgetNode:
         if len(child_ls) == 1:
             return cur_child
         else:
+            rec_prev = cur_child._get_total_rec()
             leaf_child = cur_child.add_child_ls(child_ls[1:], child_total)
             if leaf_child is not None:
-                self._update_total_children(child_total)
+                self._update_total_children(cur_child._get_total_rec() - rec_prev)
             return leaf_child
 
     def get_total(self) -> float:
@@ -90,15 +190,21 @@ class BudgetNode:
         return self.total_children
 
     def _update_total_children(self, amount: float) -> None:
-        self.total_children = self.get_total_children_recursive()
-        self.children = sorted(
-            self.children,
-            key=lambda x: max(x.total_init, x.total_children),
-            reverse=True,
-        )
-        child_keys = [child.key for child in self.children]
-        child_idxes = list(range(len(self.children)))
-        self.child_index = dict(zip(child_keys, child_idxes))
+        # amount is the change of get_total_children_recursive of the child
+        # on the insert path, so no subtree is walked. Sums in another order
+        # can differ in the last bits, finalize recomputes them once.
+        self._set_sort_key(self.ORDER_MAX)
+        self._rec_children += amount
+        self.total_children = self._get_total_rec()
+        self._total_is_rec = True
+        self._touch()
+
+    def _get_total_rec(self) -> float:
+        # get_total_children_recursive from the kept sum
+        if self.total_init > 0:
+            return self.total_init
+
+        return self._rec_children
 
     def get_total_children_recursive(self) -> float:
         if self.total_init > 0:
@@ -110,15 +216,47 @@ class BudgetNode:
 
         return total_children
 
+    def finalize(self) -> float:
+        """
+        Sort the children of the whole subtree and sum the totals kept by
+        add_child_ls again in that order, so they equal
+        get_total_children_recursive exactly. Call once after the inserts.
+        Returns get_total_children_recursive of this node.
+        """
+        rec_children = 0
+        for child in self.children:
+            rec_children += child.finalize()
+
+        self._rec_children = rec_children
+        if self._total_is_rec:
+            self.total_children = self._get_total_rec()
+
+        return self._get_total_rec()
+
     def get_child(self, child_str: str) -> "BudgetNode":
         child_key = self.sanitize_str(child_str)
+        if self._has_dup_keys:
+            # the last of a key in children order wins, as in a dict of it
+            self.child_index = {child.key: child for child in self.children}
+
         if child_key in self.child_index:
-            return self.children[self.child_index[child_key]]
+            return self.child_index[child_key]
         else:
             logging.warn(f'Child "{child_str}" not found in "{self.name}"')
             return None
 
+    def make_path_index(self) -> "PathIndex":
+        """Index this subtree by path, inserts below keep it up to date"""
+        path_index = PathIndex()
+        path_index.add_subtree((), self)
+        return path_index
+
     def get_child_ls(self, path: list[str]) -> "BudgetNode":
+        if self._path_index is not None:
+            child = self._path_index.find(path, self._path)
+            if child is not None:
+                return child
+
         if len(path) == 0:
             return self
 
@@ -216,6 +354,7 @@ class BudgetNode:
         return df
 
     def adjust_totals_with_children(self) -> None:
+        # children keep the order of the totals before adjusting
         for child in self.children:
             child.adjust_totals_with_children()
 
@@ -244,6 +383,69 @@ class BudgetNode:
         return edge_dict
 
 
+class PathIndex:
+    """
+    The nodes of a tree by the tuple of sanitized keys on the way to them
+    from its root, which is (). Every indexed node refers to the index, and
+    BudgetNode._insert_child adds new children (with their subtrees), so a
+    path is one dict lookup instead of a get_child per level.
+
+    Paths through a repeated key of the same parent lead to the node that
+    was inserted last, get_child takes the last in children order.
+    """
+
+    def __init__(self) -> None:
+        self.nodes: dict[tuple[str, ...], BudgetNode] = {}
+        self.name_keys: dict[str, str] = {}
+
+    def __len__(self) -> int:
+        return len(self.nodes)
+
+    def __contains__(self, path: tuple[str, ...]) -> bool:
+        return path in self.nodes
+
+    def add_subtree(self, path: tuple[str, ...], node: BudgetNode) -> None:
+        all_nodes = [(path, node)]
+        while all_nodes:
+            path, node = all_nodes.pop()
+            self.nodes[path] = node
+            node._path_index = self
+            node._path = path
+            for child in node._children:
+                all_nodes.append((path + (child.key,), child))
+
+    def get_key_path(self, names: list[str]) -> tuple[str, ...]:
+        all_keys = []
+        for name in names:
+            key = self.name_keys.get(name)
+            if key is None:
+                key = self.name_keys[name] = BudgetNode.sanitize_str(name)
+            all_keys.append(key)
+        return tuple(all_keys)
+
+    def get(self, path: tuple[str, ...]) -> BudgetNode:
+        return self.nodes.get(path)
+
+    def find(self, names: list[str], path: tuple[str, ...] = ()) -> BudgetNode:
+        """Node of the names below path, None if there is none"""
+        return self.nodes.get(path + self.get_key_path(names))
+
+    def iter_prefix(
+        self, path: tuple[str, ...]
+    ) -> Iterator[tuple[tuple[str, ...], BudgetNode]]:
+        """Paths and nodes of the node at path and all nodes below it"""
+        node = self.nodes.get(path)
+        if node is None:
+            return
+
+        all_nodes = [(path, node)]
+        while all_nodes:
+            path, node = all_nodes.pop()
+            yield path, node
+            for child in reversed(node.children):
+                all_nodes.append((path + (child.key,), child))
+
+
 class BudgetTreeUtils:
     def __init__(self):
         pass
@@ -324,6 +526,10 @@ class BudgetTreeUtils:
 
     @staticmethod
     def serialize(root: BudgetNode) -> pd.DataFrame:
+        # TreeStore views serialize all edges at once
+        if hasattr(root, "serialize_edges"):
+            return root.serialize_edges()
+
         all_edges = []
         mock_root = BudgetNode("ROOT", 0)
         mock_root.add_child_node(root)
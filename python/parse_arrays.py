@@ -0,0 +1,491 @@
+import bisect
+import logging
+import numpy as np
+import pandas as pd
+
+from typing import Optional, Union
+
+from parse_trace import TRACE
+from parse_utils import (
+    find_net_row,
+    get_section_input,
+    get_head_measures,
+    BudgetSheet,
+    HeadTable,
+    HEAD_CAPS,
+    HEAD_NET,
+    HEAD_TOTAL,
+    HEAD_VALID,
+    SectionInput,
+)
+from sheet_reader import SheetData
+
+# strings of the workbook being parsed, cleared per workbook by parse_demands
+HEAD_TABLE = HeadTable()
+
+# work-stack actions, see run_parse_stack
+ADD_HEAD = 0  # (ADD_HEAD, row_idx, context)
+PARSE_RANGE = 1  # (PARSE_RANGE, beg, end, col_idx, context)
+ADD_RANGE = 2  # (ADD_RANGE, beg, end, col_idx, context)
+
+
+class HeadIndex:
+    """
+    Sorted row positions of every head in one name column, so the first
+    occurrence of a head within a row range is a binary search instead of
+    a scan of the range.
+    """
+
+    def __init__(self, col: np.ndarray) -> None:
+        self.rows: dict[str, list[int]] = {}
+        for row_idx, head in enumerate(col):
+            if isinstance(head, str):
+                self.rows.setdefault(head, []).append(row_idx)
+
+    def get_duplicates(self) -> dict[str, list[int]]:
+        """Heads on more than one row, the ones lookups may warn about"""
+        return {head: rows for head, rows in self.rows.items() if len(rows) > 1}
+
+    def find(self, head: str, beg: int, end: int) -> tuple[int, int]:
+        """First row of head in [beg, end) (-1 if none) and the match count"""
+        rows = self.rows.get(head, [])
+        first = bisect.bisect_left(rows, beg)
+        last = bisect.bisect_left(rows, end, lo=first)
+        if first == last:
+            return -1, 0
+        return rows[first], last - first
+
+
+class SectionArrays:
+    """
+    A prepared section (see get_section_input) as plain arrays.
+
+    Rows are addressed by position, 0 being the first row after the section
+    header, and row ranges are half-open [beg, end). The expand_* functions
+    below mirror parse_recursive and friends in parse_utils row for row,
+    .loc's inclusive ends included, so both engines emit the same heads.
+
+    Head predicates are read from the flags of head_table instead of being
+    evaluated per cell.
+    """
+
+    def __init__(self, sec_input: SectionInput, head_table: HeadTable) -> None:
+        self.row_base = sec_input["labels"].start
+        self.nrows = len(sec_input["labels"])
+        self.head_table = head_table
+
+        columns = sec_input["columns"]
+        self.names = [columns[col] for col in sec_input["name_cols"]]
+        name_classes = [head_table.classify_col(col) for col in self.names]
+        self.name_ids = [ids for ids, _ in name_classes]
+        self.name_flags = [flags for _, flags in name_classes]
+        self.amounts = sec_input["amounts"]
+        self.measures = sec_input["measures"]
+
+        # sorted positions of the net markers, searched by get_net_row
+        self.net_rows = np.array([], dtype=np.int64)
+        if "net" in columns:
+            _, net_flags = head_table.classify_col(columns["net"])
+            self.net_rows = np.flatnonzero(net_flags & HEAD_NET)
+
+        self.head_index = [HeadIndex(col) for col in self.names]
+        for col_idx, head_index in enumerate(self.head_index):
+            duplicates = head_index.get_duplicates()
+            if len(duplicates) > 0:
+                logging.debug(f"Duplicate heads in name{col_idx}: {duplicates}")
+
+    def get_labels(self, beg: int, end: int) -> tuple[int, int]:
+        """Sheet row labels of [beg, end), for logging and tracing"""
+        return (self.row_base + beg, self.row_base + end)
+
+    def is_valid_head(self, col_idx: int, row_idx: int) -> bool:
+        return bool(self.name_flags[col_idx][row_idx] & HEAD_VALID)
+
+    def get_head_rows(self, col_idx: int, beg: int, end: int) -> np.ndarray:
+        """Rows of [beg, end) with a valid head in name column col_idx"""
+        return beg + np.flatnonzero(self.name_flags[col_idx][beg:end] & HEAD_VALID)
+
+    def get_net_row(self, beg: int, end: int) -> int:
+        """First net row in [beg, end), -1 if none"""
+        return find_net_row(self.net_rows, beg, end)
+
+
+def get_range_row(
+    section: SectionArrays, cur_col_idx: int, beg: int, end: int, val: str
+) -> int:
+    row_idx, nmatches = section.head_index[cur_col_idx].find(val, beg, end)
+    if nmatches == 0:
+        logging.warning(f"No matches found for val: {val}!")
+    elif nmatches > 1:
+        logging.warning(f"Multiple matches found for val: {val}!")
+    return row_idx
+
+
+def has_valid_heads(section: SectionArrays, col_idx: int, beg: int, end: int) -> bool:
+    return bool(np.any(section.name_flags[col_idx][beg:end] & HEAD_VALID))
+
+
+def add_row_head(
+    section: SectionArrays, row_idx: int, context: list, parsed_sheet: BudgetSheet
+) -> None:
+    head_amount = float(section.amounts[row_idx])
+    if abs(head_amount) > 1e-1:
+        logging.info(f"-> !! Adding {context} to tree (amount: {head_amount})")
+        head_row = {"head": context, "amount": head_amount}
+        if parsed_sheet.get("measures"):
+            head_row["amounts"] = get_head_measures(section.measures[row_idx])
+        parsed_sheet["amount_heads"].append(head_row)
+        if TRACE.enabled:
+            row_label = section.row_base + int(row_idx)
+            TRACE.add("head_added", row_label, context, head_amount)
+    else:
+        logging.info(f"-> !! Skipping {context} (amount: {head_amount})")
+        if TRACE.enabled:
+            row_label = section.row_base + int(row_idx)
+            TRACE.add("head_skipped", row_label, context, head_amount)
+
+
+def is_valid_net_range(
+    section: SectionArrays, beg: int, end: int, cur_col_idx: int
+) -> bool:
+    """
+    The kind of net range that has no valid heads in the rest of the columns
+    """
+    if end - beg <= 0:
+        return False
+
+    if has_valid_heads(section, cur_col_idx, beg + 1, end):
+        return False
+
+    for col_idx in range(cur_col_idx + 1, len(section.names)):
+        if has_valid_heads(section, col_idx, beg, end):
+            return False
+
+    return True
+
+
+def is_valid_net_range_another(
+    section: SectionArrays, beg: int, end: int, cur_col_idx: int
+) -> bool:
+    if end - beg <= 0:
+        return False
+
+    if has_valid_heads(section, cur_col_idx, beg + 1, end):
+        return False
+
+    is_head_valid = not np.isnan(section.amounts[beg])
+    if is_head_valid:
+        return False
+
+    amount_col = section.amounts[beg:end]
+    amount_col = amount_col[~np.isnan(amount_col)]
+    col_sum = amount_col[:-1].sum()
+    col_net = amount_col[-1]
+
+    logging.debug(f"-> col_sum: {col_sum}, col_net: {col_net}")
+    return abs(col_sum - col_net) < 1
+
+
+def get_net_range(
+    section: SectionArrays, beg: int, end: int, cur_col_idx: int
+) -> Optional[int]:
+    """End of the net range starting at beg, None if there is none"""
+    net_row_idx = section.get_net_row(beg, end)
+    logging.debug(f"-> has_net_slice: {net_row_idx != -1}")
+
+    if net_row_idx == -1:
+        return None
+
+    net_end = net_row_idx + 1
+
+    is_valid_net_heuristic_1 = is_valid_net_range(section, beg, net_end, cur_col_idx)
+    is_valid_net_heuristic_2 = is_valid_net_range_another(
+        section, beg, net_end, cur_col_idx
+    )
+    is_valid_net = is_valid_net_heuristic_1 or is_valid_net_heuristic_2
+
+    if TRACE.enabled:
+        TRACE.add("net_slice", *section.get_labels(beg, net_end), is_valid_net)
+
+    if is_valid_net:
+        return net_end
+
+    return None
+
+
+def get_head_range(
+    section: SectionArrays, beg: int, end: int, cur_col_idx: int
+) -> Optional[int]:
+    """End of the range of the head at beg, None if there is no valid head"""
+    head_rows = section.get_head_rows(cur_col_idx, beg, end)
+    if len(head_rows) > 1:
+        return int(head_rows[1])
+    elif len(head_rows) == 1:
+        return end
+    return None
+
+
+def expand_add_range_net_fallback(
+    section: SectionArrays, beg: int, end: int, cur_col_idx: int, context: list
+) -> list[tuple]:
+    col = section.names[cur_col_idx]
+    cur_head = col[beg]
+    if section.is_valid_head(cur_col_idx, beg) and cur_head == context[-1]:
+        cur_context = context[:-1]
+        logging.debug(f"-> removing duplicate head from context")
+    else:
+        logging.debug(
+            f"-> NOT removing duplicate head from context (cur_head: {cur_head})"
+        )
+        cur_context = context
+
+    return [
+        (ADD_HEAD, row_idx, cur_context + [col[row_idx]])
+        for row_idx in section.get_head_rows(cur_col_idx, beg, end)
+    ]
+
+
+def expand_add_range_net(
+    section: SectionArrays,
+    beg: int,
+    end: int,
+    cur_col_idx: int,
+    net_row_idx: int,
+    context: list,
+) -> list[tuple]:
+    logging.debug(f"---> In add_range_handle_net (context: {context})")
+    net_total = section.amounts[net_row_idx]
+    range_prev_total = np.nansum(section.amounts[beg:net_row_idx])
+    logging.debug(f"-> net_total: {net_total}, slice_prev_total: {range_prev_total}")
+
+    if abs(net_total - range_prev_total) > 1:
+        range_beg, range_end = section.get_labels(beg, end)
+        logging.critical(
+            f"!! NET TOTAL MISMATCH (rows {range_beg}-{range_end},"
+            f" net: {net_total}, sum: {range_prev_total})"
+        )
+        if TRACE.enabled:
+            TRACE.add(
+                "net_mismatch", range_beg, range_end, net_total, range_prev_total
+            )
+        actions = expand_add_range_net_fallback(
+            section, beg, end, cur_col_idx, context
+        )
+    else:
+        # skip all heads except net
+        logging.debug(f"-> Adding net head: {context}")
+        cur_head = section.names[cur_col_idx][beg]
+        if section.is_valid_head(cur_col_idx, beg) and cur_head != context[-1]:
+            actions = [(ADD_HEAD, net_row_idx, context + [cur_head])]
+        else:
+            actions = [(ADD_HEAD, net_row_idx, context)]
+
+    if net_row_idx + 1 < end:
+        actions.append((ADD_RANGE, net_row_idx + 1, end, cur_col_idx, context))
+
+    return actions
+
+
+def expand_add_range(
+    section: SectionArrays, beg: int, end: int, cur_col_idx: int, context: list
+) -> list[tuple]:
+    """add_slice over the rows [beg, end) of a section"""
+    logging.debug(f"Adding range: {section.get_labels(beg, end)}")
+    net_row_idx = section.get_net_row(beg, end)
+    if net_row_idx != -1:
+        logging.debug(f"-> !! NET CASE")
+        return expand_add_range_net(
+            section, beg, end, cur_col_idx, net_row_idx, context
+        )
+
+    col = section.names[cur_col_idx]
+    return [
+        (ADD_HEAD, row_idx, context + [col[row_idx]]) for row_idx in range(beg, end)
+    ]
+
+
+def expand_parse_range(
+    section: SectionArrays, beg: int, end: int, cur_col_idx: int, context: list
+) -> list[tuple]:
+    """
+    One call of parse_recursive over the rows [beg, end) of a section. The
+    heads it adds and the ranges it recurses into are returned as actions,
+    in the order parse_recursive would take them.
+    """
+    if end - beg <= 0:
+        return []
+
+    if TRACE.enabled:
+        TRACE.add("enter_range", *section.get_labels(beg, end), cur_col_idx, context)
+
+    if end - beg == 1:
+        head = section.names[cur_col_idx][beg]
+        logging.debug(f"--> Single row: {head}")
+        if section.is_valid_head(cur_col_idx, beg):
+            return [(ADD_HEAD, beg, context + [head])]
+        elif len(section.names) > cur_col_idx + 1:
+            return [(PARSE_RANGE, beg, end, cur_col_idx + 1, context)]
+        return []
+
+    logging.debug(
+        f"In parse_range (context: {context}, rows: {section.get_labels(beg, end)})"
+    )
+
+    if cur_col_idx >= len(section.names):
+        range_beg, range_end = section.get_labels(beg, end)
+        logging.critical(
+            f"parse_range: cur_col_idx >= len(names_cols)."
+            f" skipping rows {range_beg}-{range_end}"
+        )
+        return []
+
+    heads_cur = section.names[cur_col_idx]
+    flags_cur = section.name_flags[cur_col_idx]
+    valid_rows = section.get_head_rows(cur_col_idx, beg, end)
+
+    if len(valid_rows) == 0:
+        logging.debug("Recursing ...")
+        return [(PARSE_RANGE, beg, end, cur_col_idx + 1, context)]
+
+    rows_all_caps = valid_rows[(flags_cur[valid_rows] & HEAD_CAPS) != 0]
+    if len(rows_all_caps) > 0:
+        valid_rows = rows_all_caps
+
+    valid_heads = heads_cur[valid_rows].tolist()
+    logging.debug(f"Valid heads: {valid_heads}")
+
+    is_head_beg = (flags_cur[valid_rows] & HEAD_TOTAL) == 0
+    heads_beg = heads_cur[valid_rows[is_head_beg]].tolist()
+    valid_heads_set = set(valid_heads)
+    head_table = section.head_table
+
+    actions = []
+    cur_max_end_idx = beg
+    for head_idx, head_open in enumerate(heads_beg):
+        head_open_id = head_table.ids[head_open]
+        head_close_id = head_table.get_close(head_open_id)
+        head_close_found = (
+            head_close_id != -1 and head_table.strs[head_close_id] in valid_heads_set
+        )
+        beg_idx = get_range_row(section, cur_col_idx, beg, end, head_open)
+        if head_close_found:
+            head_close = head_table.strs[head_close_id]
+            end_idx = get_range_row(section, cur_col_idx, beg, end, head_close)
+        elif head_idx + 1 == len(heads_beg):
+            end_idx = end
+        else:
+            head_next = heads_beg[head_idx + 1]
+            end_idx = get_range_row(section, cur_col_idx, beg, end, head_next)
+
+        logging.debug(f"Open-close pair: {head_open} ({beg_idx} - {end_idx})")
+        if TRACE.enabled:
+            TRACE.add(
+                "head_pair",
+                head_open,
+                section.row_base + beg_idx,
+                section.row_base + end_idx,
+                head_close_found,
+            )
+
+        if beg_idx < cur_max_end_idx:
+            # recursive heads
+            logging.debug(
+                f"Skipped {beg_idx} (cur_max: {cur_max_end_idx}). Must be nested."
+            )
+            continue
+
+        if beg_idx > cur_max_end_idx + 1:
+            logging.debug("Recursing for slice skipped by current head")
+            actions.append(
+                (PARSE_RANGE, cur_max_end_idx + 1, beg_idx, cur_col_idx, context)
+            )
+
+        head_context = context + [head_open]
+        if head_close_found:
+            actions.append((ADD_HEAD, end_idx, head_context))
+            actions.append(
+                (PARSE_RANGE, beg_idx + 1, end_idx, cur_col_idx, head_context)
+            )
+        elif head_table.flags[head_open_id] & HEAD_CAPS:
+            # parse_recursive's .loc[beg + 1 : end] includes the row at end
+            range_end = min(end_idx + 1, end)
+            actions.append(
+                (PARSE_RANGE, beg_idx + 1, range_end, cur_col_idx, head_context)
+            )
+        else:
+            # consume head, either as individual entity, or as part of a net
+            net_end = get_net_range(section, beg_idx, end, cur_col_idx)
+            head_end = get_head_range(section, beg_idx, end, cur_col_idx)
+            if net_end is not None:
+                logging.debug("Found net slice!!")
+                actions.append(
+                    (ADD_RANGE, beg_idx, net_end, cur_col_idx, head_context)
+                )
+            else:
+                logging.debug("Found head slice!!")
+                if not np.isnan(section.amounts[beg_idx]):
+                    actions.append((ADD_HEAD, beg_idx, head_context))
+                if head_end is not None:
+                    actions.append(
+                        (PARSE_RANGE, beg_idx + 1, head_end, cur_col_idx, head_context)
+                    )
+
+        cur_max_end_idx = end_idx
+
+    if cur_max_end_idx < end:
+        actions.append(
+            (PARSE_RANGE, cur_max_end_idx + 1, end, cur_col_idx + 1, context)
+        )
+
+    return actions
+
+
+def run_parse_stack(
+    section: SectionArrays, context: list, parsed_sheet: BudgetSheet
+) -> tuple[int, int]:
+    """
+    Parse a whole section off an explicit work-stack instead of Python
+    recursion. Every expanded range pushes its actions in reverse, so they
+    pop, and heads get added, in parse_recursive's order.
+
+    Returns the peak stack size and the peak nesting depth.
+    """
+    stack = [(1, (PARSE_RANGE, 0, section.nrows, 0, context))]
+    peak_size, peak_depth = 1, 1
+
+    while len(stack) > 0:
+        depth, action = stack.pop()
+        peak_depth = max(peak_depth, depth)
+
+        if action[0] == ADD_HEAD:
+            _, row_idx, head_context = action
+            add_row_head(section, row_idx, head_context, parsed_sheet)
+            continue
+
+        kind, beg, end, cur_col_idx, range_context = action
+        if kind == PARSE_RANGE:
+            actions = expand_parse_range(section, beg, end, cur_col_idx, range_context)
+        else:
+            actions = expand_add_range(section, beg, end, cur_col_idx, range_context)
+
+        stack.extend((depth + 1, a) for a in reversed(actions))
+        peak_size = max(peak_size, len(stack))
+
+    return peak_size, peak_depth
+
+
+def parse_section_arrays(
+    sheet: Union[pd.DataFrame, SheetData],
+    section_spec: dict,
+    parsed_sheet: BudgetSheet,
+    layout_key: str = None,
+) -> None:
+    """Same as parse_section, on the "array" engine"""
+    sec_input = get_section_input(sheet, section_spec, layout_key)
+    section = SectionArrays(sec_input, HEAD_TABLE)
+    context = [sec_input["header"]]
+    peak_size, peak_depth = run_parse_stack(section, context, parsed_sheet)
+    logging.info(
+        f"Parsed section {section_spec['name']} ({section.nrows} rows):"
+        f" peak stack {peak_size}, peak depth {peak_depth}"
+    )
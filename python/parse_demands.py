@@ -3,66 +3,620 @@ import os
 import json
 import logging
 
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
 import pandas as pd
 
+from budget_store import BudgetStore
+from parse_arrays import parse_section_arrays, HEAD_TABLE, SectionArrays
+from parse_trace import TRACE
+from reconcile import get_reconcile_table, reconcile_section, Reconciliation
 from budget_tree import BudgetNode, BudgetTreeUtils
 from parse_utils import (
+    get_layout_key,
     get_meta_structure,
+    get_section_input,
     parse_header,
     parse_section,
+    triage_sheet,
     BudgetSheet,
-    BudgetSheet,
+    SheetTriage,
+    LAYOUT_TEMPLATES,
+    PARSER_VERSION,
 )
+from sheet_cache import SheetCache
+from sheet_reader import SheetData, WorkbookReader
 
+# written into budget_parsed/ by incremental ingests
+SHEET_MANIFEST = "sheets.jsonl"
+# a manifest entry is reused only if these match the current ingest too
+MANIFEST_OPTION_KEYS = ["parser_version", "engine", "sections", "measures"]
+INGEST_REPORT = "ingest_report.txt"
+# the triage of every sheet, written with parse_secondary_sheets(triage_path)
+TRIAGE_MANIFEST = "triage.jsonl"
+# written into budget_parsed/ by reconcile_secondary_sheets
+RECONCILE_REPORT = "reconcile.csv"
 
-def save_parsed_sheet(parsed_sheet: BudgetSheet, output_dir: str) -> None:
-    os.makedirs(output_dir, exist_ok=True)
+# rows read per sheet to triage it, the header block ends well within this
+TRIAGE_ROWS = 30
+
+# section parsers, both emit identical amount_heads
+PARSE_ENGINES = {"frame": parse_section, "array": parse_section_arrays}
+
+
+def get_parsed_sheet_fname(parsed_sheet: BudgetSheet) -> str:
     header = parsed_sheet["header"]
     h0 = BudgetTreeUtils.get_key_abbrev(header[0])
     h2 = BudgetTreeUtils.get_key_abbrev(header[2])
     h1_int = re.findall(r"\d+", header[1])[0]
 
-    fname = f"{output_dir}/dno_{h1_int}_{h0}_{h2}.json"
+    return f"dno_{h1_int}_{h0}_{h2}.json"
+
+
+def save_parsed_sheet(parsed_sheet: BudgetSheet, output_dir: str) -> None:
+    os.makedirs(output_dir, exist_ok=True)
+    fname = f"{output_dir}/{get_parsed_sheet_fname(parsed_sheet)}"
     logging.info(f"Saving sheet to {fname}")
     with open(fname, "w") as f:
         f.write(json.dumps(parsed_sheet, indent=2))
 
 
-def parse_sheet_inner(sheet_name: str, sheet):
+def parse_sheet_struct(
+    sheet_name: str,
+    sheet,
+    engine: str = "frame",
+    sections: list[str] = None,
+    measures: bool = False,
+) -> BudgetSheet:
+    """
+    Parse a demand sheet. With sections, only the sections of those names
+    ("A", "B", ...) are parsed, and the filter is recorded in the output as
+    "section_filter". With measures, every head also keeps all its amount
+    columns as "amounts" (in AMOUNT_HEADS order), for make_json_tree.
+    """
+    parse_section_fn = PARSE_ENGINES[engine]
+    if TRACE.enabled:
+        TRACE.add("sheet", sheet_name)
+
     sheet_struct: BudgetSheet = get_meta_structure(sheet)
 
     if sheet_struct is None or "sections" not in sheet_struct:
         logging.critical(f"No sections found in sheet")
-        return
+        return None
 
     sheet_struct["sheet_name"] = sheet_name
 
+    # a SheetData only gets the header and section rows as frames
     hsec = sheet_struct["header_sec"]
-    header_slice = sheet.loc[hsec["start"] : hsec["end"]]
+    if isinstance(sheet, SheetData):
+        header_slice = sheet.get_frame(hsec["start"], hsec["end"] + 1)
+    else:
+        header_slice = sheet.loc[hsec["start"] : hsec["end"]]
     header = parse_header(header_slice, sheet_struct["amount_cols"])
     sheet_struct["amount_header"] = header
 
     logging.info(f"Sheet structure: {json.dumps(sheet_struct, indent=4)}")
 
-    sheet = sheet.dropna(axis=1, how="all")
+    if not isinstance(sheet, SheetData):
+        sheet = sheet.dropna(axis=1, how="all")
+    layout_key = get_layout_key(sheet, sheet_struct)
 
     all_sections = sheet_struct["sections"]
+    if sections is not None:
+        sheet_struct["section_filter"] = sorted(sections)
+    if measures:
+        sheet_struct["measures"] = True
 
     for section in all_sections:
-        parse_section(sheet, section, sheet_struct)
+        if sections is not None and section["name"] not in sections:
+            logging.info(f"Skipping section: {section['name']}")
+            continue
+        parse_section_fn(sheet, section, sheet_struct, layout_key)
+
+    return sheet_struct
+
+
+def parse_sheet_inner(
+    sheet_name: str,
+    sheet,
+    sheet_cache: SheetCache = None,
+    engine: str = "frame",
+    sections: list[str] = None,
+    measures: bool = False,
+):
+    if sheet_cache is None or not isinstance(sheet, SheetData):
+        sheet_struct = parse_sheet_struct(sheet_name, sheet, engine, sections, measures)
+    else:
+        cache_key = sheet_cache.sheet_key(sheet, sections, measures)
+        cache_hit, sheet_struct = sheet_cache.get(cache_key)
+        if cache_hit:
+            logging.info(f"Using cached parse for sheet {sheet_name}")
+            if sheet_struct is not None:
+                sheet_struct["sheet_name"] = sheet_name
+        else:
+            sheet_struct = parse_sheet_struct(
+                sheet_name, sheet, engine, sections, measures
+            )
+            sheet_cache.put(cache_key, sheet_struct)
+
+    if sheet_struct is None:
+        return None
 
     save_parsed_sheet(sheet_struct, "budget_parsed")
+    return sheet_struct
+
+
+class SheetLogBuffer(logging.Handler):
+    """Holds a worker's log records for one sheet so they can be replayed
+    in the parent process as a single block."""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.records: list[logging.LogRecord] = []
+
+    def emit(self, record: logging.LogRecord) -> None:
+        # records are pickled back to the parent, so render them here
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        self.records.append(record)
+
+
+# per-process workbook handle, cache and parse options, set up by
+# _init_sheet_worker
+_worker_reader: WorkbookReader = None
+_worker_cache: SheetCache = None
+_worker_engine: str = "frame"
+_worker_sections: list[str] = None
+_worker_measures: bool = False
+
+
+def _init_sheet_worker(
+    xls_path: str,
+    log_level: int,
+    sheet_cache: SheetCache,
+    engine: str,
+    sections: list[str],
+    measures: bool,
+) -> None:
+    global _worker_reader, _worker_cache, _worker_engine, _worker_sections
+    global _worker_measures
+    _worker_reader = WorkbookReader(xls_path)
+    _worker_cache = sheet_cache
+    _worker_engine = engine
+    _worker_sections = sections
+    _worker_measures = measures
+    HEAD_TABLE.clear()
+    LAYOUT_TEMPLATES.clear()
+
+    # drop handlers inherited from the parent, logs go through SheetLogBuffer
+    root_logger = logging.getLogger()
+    root_logger.handlers = []
+    root_logger.setLevel(log_level)
+
+
+def _parse_sheet_worker(sidx: int):
+    root_logger = logging.getLogger()
+    log_buf = SheetLogBuffer()
+    root_logger.addHandler(log_buf)
+
+    sheet_struct, exc = None, None
+    try:
+        sheet = _worker_reader.read_sheet(sidx)
+        logging.info(f"Parsing sheet {sidx}: {sheet.sheet_name}")
+        sheet_struct = parse_sheet_inner(
+            sheet.sheet_name,
+            sheet,
+            _worker_cache,
+            _worker_engine,
+            _worker_sections,
+            _worker_measures,
+        )
+    except Exception as e:
+        logging.exception(f"Failed to parse sheet {sidx}")
+        exc = e
+    finally:
+        root_logger.removeHandler(log_buf)
+
+    return sidx, sheet_struct, log_buf.records, exc
+
+
+def get_sheet_order(xls_reader: WorkbookReader, sheet_idxes: list[int]) -> list[int]:
+    """Largest sheets first, so the slowest sheet is never scheduled last."""
+    return sorted(sheet_idxes, key=xls_reader.sheet_rows, reverse=True)
+
+
+def parse_secondary_sheets_parallel(
+    xls_reader: WorkbookReader,
+    sheet_idxes: list[int],
+    num_workers: int,
+    sheet_cache: SheetCache = None,
+    engine: str = "frame",
+    sections: list[str] = None,
+    measures: bool = False,
+) -> dict[int, BudgetSheet]:
+    sheet_order = get_sheet_order(xls_reader, sheet_idxes)
+    log_level = logging.getLogger().getEffectiveLevel()
+
+    logging.info(f"Parsing {len(sheet_idxes)} sheets with {num_workers} workers")
+
+    all_results = {}
+    next_pos = 0
+    with ProcessPoolExecutor(
+        max_workers=num_workers,
+        initializer=_init_sheet_worker,
+        initargs=(
+            xls_reader.xls_path,
+            log_level,
+            sheet_cache,
+            engine,
+            sections,
+            measures,
+        ),
+    ) as executor:
+        futures = [executor.submit(_parse_sheet_worker, sidx) for sidx in sheet_order]
+
+        for future in as_completed(futures):
+            sidx, sheet_struct, records, exc = future.result()
+            all_results[sidx] = (sheet_struct, records, exc)
+
+            # replay logs in sheet order, one sheet at a time
+            while next_pos < len(sheet_idxes) and sheet_idxes[next_pos] in all_results:
+                _, records, exc = all_results[sheet_idxes[next_pos]]
+                for record in records:
+                    logging.getLogger(record.name).handle(record)
+                if exc is not None:
+                    raise exc
+                next_pos += 1
+
+    # the workers' entries are not in this process' bookkeeping yet
+    if sheet_cache is not None:
+        sheet_cache.refresh()
+
+    return {sidx: all_results[sidx][0] for sidx in sheet_idxes}
+
+
+def triage_workbook(
+    xls_reader: WorkbookReader,
+    sheet_idxes: list[int] = None,
+    max_rows: int = TRIAGE_ROWS,
+    manifest_path: str = None,
+) -> list[SheetTriage]:
+    """Triage every sheet from its first max_rows rows, see triage_sheet."""
+    all_triage = []
+    for sheet in xls_reader.iter_sheets(sheet_idxes, max_rows=max_rows):
+        triage = triage_sheet(sheet)
+        if not triage["is_demand"]:
+            logging.info(f"Skipping sheet {sheet.sheet_idx}: {sheet.sheet_name}")
+        all_triage.append(triage)
+
+    if manifest_path is not None:
+        write_triage_manifest(all_triage, manifest_path)
+
+    return all_triage
+
+
+def write_triage_manifest(all_triage: list[SheetTriage], manifest_path: str) -> None:
+    os.makedirs(os.path.dirname(manifest_path) or ".", exist_ok=True)
+    with open(manifest_path, "w") as f:
+        for triage in all_triage:
+            f.write(json.dumps(triage) + "\n")
 
 
-def parse_secondary_sheets():
+def read_sheet_manifest(output_dir: str) -> list[dict]:
+    manifest_path = f"{output_dir}/{SHEET_MANIFEST}"
+    if not os.path.exists(manifest_path):
+        return []
+
+    with open(manifest_path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def write_sheet_manifest(output_dir: str, all_entries: list[dict]) -> None:
+    os.makedirs(output_dir, exist_ok=True)
+    with open(f"{output_dir}/{SHEET_MANIFEST}", "w") as f:
+        for entry in all_entries:
+            f.write(json.dumps(entry) + "\n")
+
+
+def write_ingest_report(
+    output_dir: str, changed_dnos: list[int], removed_dnos: list[int], nunchanged: int
+) -> None:
+    report = [
+        f"Changed demands: {changed_dnos}",
+        f"Removed demands: {removed_dnos}",
+        f"Unchanged sheets: {nunchanged}",
+    ]
+    for line in report:
+        logging.info(line)
+
+    with open(f"{output_dir}/{INGEST_REPORT}", "w") as f:
+        f.write("\n".join(report) + "\n")
+
+
+def parse_secondary_sheets_incremental(
+    xls_reader: WorkbookReader,
+    sheet_idxes: list[int],
+    num_workers: int = 1,
+    sheet_cache: SheetCache = None,
+    engine: str = "frame",
+    sections: list[str] = None,
+    measures: bool = False,
+) -> list[BudgetSheet]:
+    """
+    Reparse only the sheets whose cells changed since the last ingest.
+
+    Sheets are matched to the previous ingest by content digest, parser
+    version and parse options (see SHEET_MANIFEST), so reordered or renamed
+    sheets are not reparsed either.
+    Outputs of changed sheets replace their old files in budget_parsed/,
+    outputs that no current sheet produces are removed, and the changed
+    demand numbers are written to INGEST_REPORT.
+    """
+    output_dir = "budget_parsed"
+    get_int = lambda x: int(re.findall(r"\d+", x)[0])
+
+    prev_entries = {e["digest"]: e for e in read_sheet_manifest(output_dir)}
+
+    all_entries = {}
+    all_parsed = {}
+    changed_idxes = []
+    for sheet in xls_reader.iter_sheets(sheet_idxes):
+        entry = {
+            "sheet_idx": sheet.sheet_idx,
+            "sheet_name": sheet.sheet_name,
+            "digest": sheet.digest(),
+            "parser_version": PARSER_VERSION,
+            "engine": engine,
+            "sections": sections,
+            "measures": measures,
+            "fname": None,
+        }
+        all_entries[sheet.sheet_idx] = entry
+
+        prev_entry = prev_entries.get(entry["digest"])
+        if prev_entry is not None and any(
+            prev_entry.get(key) != entry[key] for key in MANIFEST_OPTION_KEYS
+        ):
+            prev_entry = None
+        prev_fname = prev_entry["fname"] if prev_entry else None
+        if prev_entry is not None and prev_fname is None:
+            all_parsed[sheet.sheet_idx] = None
+        elif prev_fname is not None and os.path.exists(f"{output_dir}/{prev_fname}"):
+            with open(f"{output_dir}/{prev_fname}") as f:
+                all_parsed[sheet.sheet_idx] = json.loads(f.read())
+            entry["fname"] = prev_fname
+        else:
+            changed_idxes.append(sheet.sheet_idx)
+            if num_workers <= 1:
+                logging.info(f"Parsing sheet {sheet.sheet_idx}: {sheet.sheet_name}")
+                all_parsed[sheet.sheet_idx] = parse_sheet_inner(
+                    sheet.sheet_name, sheet, sheet_cache, engine, sections, measures
+                )
+
+    logging.info(f"{len(changed_idxes)} of {len(sheet_idxes)} sheets changed")
+
+    if num_workers > 1 and len(changed_idxes) > 0:
+        all_parsed.update(
+            parse_secondary_sheets_parallel(
+                xls_reader,
+                changed_idxes,
+                num_workers,
+                sheet_cache,
+                engine,
+                sections,
+                measures,
+            )
+        )
+
+    changed_dnos = []
+    for sidx in changed_idxes:
+        sheet_struct = all_parsed[sidx]
+        if sheet_struct is not None:
+            all_entries[sidx]["fname"] = get_parsed_sheet_fname(sheet_struct)
+            changed_dnos.append(get_int(sheet_struct["header"][1]))
+
+    # splice: drop outputs of sheets that are gone from the workbook
+    cur_fnames = {e["fname"] for e in all_entries.values()}
+    removed_dnos = []
+    for prev_entry in prev_entries.values():
+        prev_fname = prev_entry["fname"]
+        if prev_fname is None or prev_fname in cur_fnames:
+            continue
+        removed_dnos.append(get_int(prev_fname))
+        if os.path.exists(f"{output_dir}/{prev_fname}"):
+            logging.info(f"Removing stale output {prev_fname}")
+            os.remove(f"{output_dir}/{prev_fname}")
+
+    write_sheet_manifest(output_dir, [all_entries[sidx] for sidx in sheet_idxes])
+    write_ingest_report(
+        output_dir,
+        sorted(set(changed_dnos)),
+        sorted(set(removed_dnos) - set(changed_dnos)),
+        len(sheet_idxes) - len(changed_idxes),
+    )
+
+    return [all_parsed[sidx] for sidx in sheet_idxes]
+
+
+def trace_sheet(sheet_idx: int, trace_path: str, engine: str = "frame") -> None:
+    """
+    Parse one sheet with the parse trace on and dump it to trace_path,
+    see parse_trace.replay_trace to read it back.
+    """
     xls_path = r"../data/budget_doc/allsbe.xlsx"
-    xls_file = pd.ExcelFile(xls_path, engine="openpyxl")
+    with WorkbookReader(xls_path) as xls_reader:
+        sheet = xls_reader.read_sheet(sheet_idx)
+
+    HEAD_TABLE.clear()
+    LAYOUT_TEMPLATES.clear()
+    TRACE.start()
+    try:
+        parse_sheet_struct(sheet.sheet_name, sheet, engine)
+    finally:
+        TRACE.stop()
 
-    for sidx, sheet_name in enumerate(xls_file.sheet_names):
-        if sidx == 0:
+    TRACE.dump(trace_path)
+
+
+def reconcile_sheet(
+    sheet: SheetData, sections: list[str] = None
+) -> list[Reconciliation]:
+    """Total/Net mismatches of a demand sheet, see reconcile.reconcile_section"""
+    sheet_struct = get_meta_structure(sheet)
+    if sheet_struct is None or "sections" not in sheet_struct:
+        return []
+
+    demand_no = int(re.findall(r"\d+", sheet_struct["header"][1])[0])
+    sheet = sheet.to_frame().dropna(axis=1, how="all")
+    layout_key = get_layout_key(sheet, sheet_struct)
+
+    all_mismatches = []
+    for section in sheet_struct["sections"]:
+        if sections is not None and section["name"] not in sections:
             continue
+        sec_input = get_section_input(sheet, section, layout_key)
+        all_mismatches.extend(
+            reconcile_section(
+                SectionArrays(sec_input, HEAD_TABLE),
+                sec_input["header"],
+                demand_no,
+                section["name"],
+            )
+        )
+
+    return all_mismatches
+
+
+def reconcile_secondary_sheets(sections: list[str] = None) -> pd.DataFrame:
+    """
+    Check the Total and Net rows of all demand sheets against the amounts
+    they sum, after a parse. Mismatches are written to budget_parsed/ as
+    RECONCILE_REPORT, one row each.
+    """
+    xls_path = r"../data/budget_doc/allsbe.xlsx"
+    HEAD_TABLE.clear()
+    LAYOUT_TEMPLATES.clear()
+
+    all_mismatches = []
+    with WorkbookReader(xls_path) as xls_reader:
+        sheet_idxes = get_demand_sheet_idxes(xls_reader)
+        for sheet in xls_reader.iter_sheets(sheet_idxes):
+            logging.info(f"Reconciling sheet {sheet.sheet_idx}: {sheet.sheet_name}")
+            all_mismatches.extend(reconcile_sheet(sheet, sections))
+
+    table = get_reconcile_table(all_mismatches)
+    logging.info(f"{len(table)} Total/Net mismatches")
+    table.to_csv(f"budget_parsed/{RECONCILE_REPORT}", index=False)
+    return table
+
+
+def get_demand_sheet_idxes(
+    xls_reader: WorkbookReader, triage_path: str = None
+) -> list[int]:
+    """Secondary sheets that pass triage, recorded in triage_path if set"""
+    all_triage = triage_workbook(
+        xls_reader, range(1, len(xls_reader.sheet_names)), manifest_path=triage_path
+    )
+    return [t["sheet_idx"] for t in all_triage if t["is_demand"]]
+
+
+def parse_secondary_sheets(
+    num_workers: int = 1,
+    sheet_cache: SheetCache = None,
+    store_path: str = None,
+    incremental: bool = False,
+    engine: str = "frame",
+    sections: list[str] = None,
+    measures: bool = False,
+    triage_path: str = None,
+) -> list[BudgetSheet]:
+    """
+    Parse all demand sheets into budget_parsed/. If store_path is set, all
+    demands are also packed into a single BudgetStore file there. With
+    incremental, only sheets that changed since the last incremental run
+    are reparsed. engine picks the section parser, see PARSE_ENGINES.
+    sections limits parsing to the named sections (e.g. parse_xls's
+    TREE_SECTIONS), None parses all of them. measures keeps every amount
+    column of the heads, see parse_sheet_struct. triage_path (e.g.
+    budget_parsed/TRIAGE_MANIFEST) gets the triage of every sheet read.
+    """
+    xls_path = r"../data/budget_doc/allsbe.xlsx"
+    if sections is not None:
+        sections = sorted(set(sections))
+    HEAD_TABLE.clear()
+    LAYOUT_TEMPLATES.clear()
+
+    if incremental:
+        with WorkbookReader(xls_path) as xls_reader:
+            sheet_idxes = get_demand_sheet_idxes(xls_reader, triage_path)
+            all_parsed = parse_secondary_sheets_incremental(
+                xls_reader,
+                sheet_idxes,
+                num_workers,
+                sheet_cache,
+                engine,
+                sections,
+                measures,
+            )
+        if store_path is not None:
+            BudgetStore.write(all_parsed, store_path)
+        return all_parsed
+
+    if sheet_cache is not None:
+        workbook_key = sheet_cache.workbook_key(xls_path, sections, measures)
+        cache_hit, workbook_entry = sheet_cache.get(workbook_key)
+        # entries cached before the triage was kept are parsed again
+        if cache_hit and isinstance(workbook_entry, dict):
+            logging.info(f"Using cached parse for workbook {xls_path}")
+            if triage_path is not None:
+                write_triage_manifest(workbook_entry["triage"], triage_path)
+            all_parsed = workbook_entry["sheets"]
+            for sheet_struct in all_parsed:
+                if sheet_struct is not None:
+                    save_parsed_sheet(sheet_struct, "budget_parsed")
+            if store_path is not None:
+                BudgetStore.write(all_parsed, store_path)
+            return all_parsed
+
+    with WorkbookReader(xls_path) as xls_reader:
+        all_triage = triage_workbook(
+            xls_reader, range(1, len(xls_reader.sheet_names)), manifest_path=triage_path
+        )
+        sheet_idxes = [t["sheet_idx"] for t in all_triage if t["is_demand"]]
+
+        if num_workers > 1:
+            parsed_map = parse_secondary_sheets_parallel(
+                xls_reader,
+                sheet_idxes,
+                num_workers,
+                sheet_cache,
+                engine,
+                sections,
+                measures,
+            )
+            all_parsed = [parsed_map[sidx] for sidx in sheet_idxes]
+        else:
+            all_parsed = []
+            for sheet in xls_reader.iter_sheets(sheet_idxes):
+                logging.info(f"Parsing sheet {sheet.sheet_idx}: {sheet.sheet_name}")
+                # input(". Press ENTER. ")
+                all_parsed.append(
+                    parse_sheet_inner(
+                        sheet.sheet_name, sheet, sheet_cache, engine, sections, measures
+                    )
+                )
+            logging.info(
+                f"Layout templates: {len(LAYOUT_TEMPLATES)} layouts,"
+                f" {LAYOUT_TEMPLATES.stats}"
+            )
+
+    if sheet_cache is not None:
+        sheet_cache.put(workbook_key, {"triage": all_triage, "sheets": all_parsed})
+
+    if store_path is not None:
+        BudgetStore.write(all_parsed, store_path)
 
-        logging.info(f"Parsing sheet {sidx}: {sheet_name}")
-        # input(". Press ENTER. ")
-        sheet = xls_file.parse(sidx, convert_float=False)
-        parse_sheet_inner(sheet_name, sheet)
+    return all_parsed
@@ -0,0 +1,87 @@
+import json
+import logging
+import numpy as np
+
+from typing import Iterator
+
+# event name -> field names, rows are sheet row labels
+TRACE_EVENTS = {
+    "sheet": ("sheet_name",),
+    "section": ("name", "beg", "end"),
+    "enter_range": ("beg", "end", "col_idx", "context"),
+    "head_pair": ("head", "beg", "end", "closed"),
+    "net_slice": ("beg", "end", "accepted"),
+    "net_mismatch": ("beg", "end", "net_total", "prev_total"),
+    "head_added": ("row", "head", "amount"),
+    "head_skipped": ("row", "head", "amount"),
+}
+
+
+class ParseTrace:
+    """
+    Typed events of a parse, for inspecting how a sheet was split into heads.
+
+    Disabled by default. Call sites check TRACE.enabled before building an
+    event, so a disabled trace costs one attribute check. Events are kept as
+    tuples (event name first, then the fields of TRACE_EVENTS) and only
+    turned into dicts by dump().
+    """
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self.events: list[tuple] = []
+
+    def start(self) -> None:
+        self.events = []
+        self.enabled = True
+
+    def stop(self) -> None:
+        self.enabled = False
+
+    def add(self, event: str, *fields) -> None:
+        self.events.append((event, *fields))
+
+    def get_records(self) -> list[dict]:
+        all_records = []
+        for event, *fields in self.events:
+            record = {"event": event}
+            record.update(zip(TRACE_EVENTS[event], fields))
+            all_records.append(record)
+        return all_records
+
+    @staticmethod
+    def _to_json(val):
+        # numpy scalars from the array engine (np.bool_, np.int64, ...)
+        if isinstance(val, np.generic):
+            return val.item()
+        return str(val)
+
+    def dump(self, trace_path: str) -> None:
+        with open(trace_path, "w") as f:
+            for record in self.get_records():
+                f.write(json.dumps(record, default=self._to_json) + "\n")
+
+        logging.info(f"Wrote {len(self.events)} trace events to {trace_path}")
+
+
+# the parser's trace, see parse_demands.trace_sheet
+TRACE = ParseTrace()
+
+
+def read_trace(trace_path: str) -> list[dict]:
+    with open(trace_path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def replay_trace(trace_path: str, sheet_name: str = None) -> Iterator[str]:
+    """Lines describing a dumped trace, optionally of one sheet only"""
+    cur_sheet = None
+    for record in read_trace(trace_path):
+        event = record.pop("event")
+        if event == "sheet":
+            cur_sheet = record["sheet_name"]
+        if sheet_name is not None and cur_sheet != sheet_name:
+            continue
+
+        fields = ", ".join(f"{k}: {v}" for k, v in record.items())
+        yield f"{event:<13} {fields}"
@@ -1,3 +1,4 @@
+import hashlib
 import json
 import logging
 import pandas as pd
@@ -6,12 +7,21 @@ import string
 import sys
 import numpy as np
 
-from typing import Any, TypedDict
+from typing import Any, NotRequired, TypedDict, Union
+
+from parse_trace import TRACE
+from sheet_reader import SheetData
+
+# Bump whenever a parser change alters BudgetSheet output, so that
+# cached parses from older versions are not reused
+PARSER_VERSION = 1
 
 
 class BudgetHead(TypedDict):
     head: list[str]
     amount: float
+    # every amount column of the row, in AMOUNT_HEADS order
+    amounts: NotRequired[list[float]]
 
 
 class BudgetSheet(TypedDict):
@@ -21,6 +31,38 @@ class BudgetSheet(TypedDict):
     sections: list[dict[str, int]]
     amount_cols: list[str]
     amount_heads: list[BudgetHead]
+    # heads carry "amounts", see parse_sheet_struct
+    measures: NotRequired[bool]
+
+
+class SheetTriage(TypedDict):
+    sheet_idx: int
+    sheet_name: str
+    is_demand: bool
+    demand_no: int
+    header: list[str]
+    header_sec: dict[str, int]
+    amount_cols: list[str]
+
+
+def clean_str(s: str) -> str:
+    s = "".join([c if c in string.printable else " " for c in s])
+    s = re.sub(r"\s+", " ", s)
+    return s
+
+
+def clean_header(fheader: list[str]) -> list[str]:
+    """Merge a demand header into [ministry, demand no., department]"""
+    if len(fheader) > 3:
+        fheader[2] = "".join(fheader[2:])
+        fdata_header = fheader[:3]
+    elif len(fheader) == 3:
+        fdata_header = fheader
+    else:
+        logging.error(f"Invalid header: {fheader}")
+        sys.exit(-1)
+
+    return list(map(clean_str, fdata_header))
 
 
 def find_candidates(sheet_strs: list[tuple[int, str]], search_str: str):
@@ -53,6 +95,77 @@ def is_mostly_caps(s: str):
     return ratio > 0.8
 
 
+# HeadTable flags, one per head predicate
+HEAD_VALID = 1 << 0  # is_valid_head
+HEAD_CAPS = 1 << 1  # is_mostly_caps
+HEAD_TOTAL = 1 << 2  # contains "Total - ", never opens a head
+HEAD_NET = 1 << 3  # net marker of a net column
+
+
+def get_head_flags(head: str) -> int:
+    flags = 0
+    if is_valid_head(head):
+        flags |= HEAD_VALID
+    if is_mostly_caps(head):
+        flags |= HEAD_CAPS
+    if "Total - " in head:
+        flags |= HEAD_TOTAL
+    if head.strip().casefold() == "net":
+        flags |= HEAD_NET
+    return flags
+
+
+class HeadTable:
+    """
+    Distinct cell strings of a workbook, interned and classified once.
+
+    Every string gets an id and its HEAD_* flags when it is first seen.
+    A "Total - X" string is also recorded as the close of X, see get_close.
+    """
+
+    def __init__(self) -> None:
+        self.clear()
+
+    def __len__(self) -> int:
+        return len(self.strs)
+
+    def clear(self) -> None:
+        self.ids: dict[str, int] = {}
+        self.strs: list[str] = []
+        self.flags: list[int] = []
+        self.closes: dict[int, int] = {}
+
+    def intern(self, head: str) -> int:
+        head_id = self.ids.get(head)
+        if head_id is not None:
+            return head_id
+
+        head_id = len(self.strs)
+        self.ids[head] = head_id
+        self.strs.append(head)
+        self.flags.append(get_head_flags(head))
+
+        if head.startswith("Total - "):
+            self.closes[self.intern(head[len("Total - ") :])] = head_id
+
+        return head_id
+
+    def get_close(self, head_id: int) -> int:
+        """Id of "Total - <head>", -1 if no such string was interned"""
+        return self.closes.get(head_id, -1)
+
+    def classify_col(self, col: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """Ids and flags of every cell of col, -1 and 0 for non-strings"""
+        ids = np.array(
+            [self.intern(x) if isinstance(x, str) else -1 for x in col],
+            dtype=np.int64,
+        )
+        flags = np.zeros(len(ids), dtype=np.uint8)
+        is_str = ids >= 0
+        flags[is_str] = np.array(self.flags, dtype=np.uint8)[ids[is_str]]
+        return ids, flags
+
+
 def is_net_col(col: pd.Series) -> bool:
     # mixed col, get strs only
     col = col.dropna()
@@ -62,6 +175,26 @@ def is_net_col(col: pd.Series) -> bool:
     return "net" in col.tolist()
 
 
+def get_net_rows(sheet_slice: pd.DataFrame) -> np.ndarray:
+    """Sorted row labels of the net markers in the "net" column, if any"""
+    if "net" not in sheet_slice.columns:
+        return np.array([], dtype=np.int64)
+
+    is_net = [
+        isinstance(x, str) and x.strip().casefold() == "net"
+        for x in sheet_slice["net"]
+    ]
+    return sheet_slice.index[np.array(is_net, dtype=bool)].to_numpy(dtype=np.int64)
+
+
+def find_net_row(net_rows: np.ndarray, beg: int, end: int) -> int:
+    """First of the sorted net_rows within [beg, end), -1 if none"""
+    net_pos = np.searchsorted(net_rows, beg)
+    if net_pos < len(net_rows) and net_rows[net_pos] < end:
+        return int(net_rows[net_pos])
+    return -1
+
+
 def get_row_idx(col: pd.Series, val: str):
     matches = col[col == val].index.tolist()
     if len(matches) == 0:
@@ -91,14 +224,26 @@ def normalize_col(col: pd.Series):
     return col
 
 
+def get_head_measures(row_amounts) -> list[float]:
+    """A head's amounts in AMOUNT_HEADS order, empty cells as 0"""
+    return np.nan_to_num(np.asarray(row_amounts, dtype=np.float64)).tolist()
+
+
 def add_head(row: pd.Series, context: list[str], parsed_sheet: BudgetSheet) -> None:
     head_amount = row["be_cur_total"]
     if abs(head_amount) > 1e-1:
         logging.info(f"-> !! Adding {context} to tree (amount: {head_amount})")
         head_row = {"head": context, "amount": head_amount}
+        if parsed_sheet.get("measures"):
+            row_amounts = pd.to_numeric(row.reindex(AMOUNT_HEADS), errors="coerce")
+            head_row["amounts"] = get_head_measures(row_amounts)
         parsed_sheet["amount_heads"].append(head_row)
+        if TRACE.enabled:
+            TRACE.add("head_added", row.name, context, head_amount)
     else:
         logging.info(f"-> !! Skipping {context} (amount: {head_amount})")
+        if TRACE.enabled:
+            TRACE.add("head_skipped", row.name, context, head_amount)
 
 
 def col_has_vals(slice: pd.DataFrame, col_names, col_idx) -> tuple[bool, bool]:
@@ -166,21 +311,28 @@ def is_valid_net_slice_another(
 
 
 def get_net_slice(
-    sheet_slice: pd.DataFrame, names_cols: list[str], cur_col_idx: int
+    sheet_slice: pd.DataFrame,
+    names_cols: list[str],
+    cur_col_idx: int,
+    net_rows: np.ndarray = None,
 ) -> None:
-    has_net_slice = ("net" in sheet_slice.columns) and is_net_col(sheet_slice["net"])
+    """
+    net_rows are the section's net rows (see get_net_rows), computed from
+    sheet_slice if not given.
+    """
+    if net_rows is None:
+        net_rows = get_net_rows(sheet_slice)
+
+    slice_beg, slice_end = sheet_slice.index.start, sheet_slice.index.stop
+    net_row_loc = find_net_row(net_rows, slice_beg, slice_end)
+    has_net_slice = net_row_loc != -1
     logging.debug(f"-> has_net_slice: {has_net_slice}")
 
     if not has_net_slice:
         return None
 
-    slice_net = sheet_slice[sheet_slice["net"].str.casefold().str.strip() == "net"]
-    net_rows = slice_net.index.tolist()
-    net_row_loc = net_rows[0]
     slice_until_net = sheet_slice.loc[:net_row_loc, :]
 
-    logging.debug(f"-> slice_until_net: \n{slice_until_net}")
-
     is_valid_net_heuristic_1 = is_valid_net_slice(
         slice_until_net, names_cols, cur_col_idx
     )
@@ -189,6 +341,9 @@ def get_net_slice(
     )
     is_valid_net = is_valid_net_heuristic_1 or is_valid_net_heuristic_2
 
+    if TRACE.enabled:
+        TRACE.add("net_slice", sheet_slice.index.start, net_row_loc + 1, is_valid_net)
+
     if is_valid_net:
         return slice_until_net
 
@@ -240,6 +395,7 @@ def add_slice_handle_net(
     net_row_loc: int,
     context: list[str],
     parsed_sheet: BudgetSheet,
+    net_rows: np.ndarray = None,
 ) -> None:
     logging.debug(f"---> In add_slice_handle_net (context: {context})")
     net_total = slice.loc[net_row_loc, "be_cur_total"]
@@ -250,8 +406,14 @@ def add_slice_handle_net(
     logging.debug(f"-> net_total: {net_total}, slice_prev_total: {slice_prev_total}")
     # check if net_total and slice_prev_total are approximately equal
     if abs(net_total - slice_prev_total) > 1:
-        logging.critical("!! NET TOTAL MISMATCH")
-        logging.critical(slice)
+        logging.critical(
+            f"!! NET TOTAL MISMATCH (rows {slice_beg}-{slice_end},"
+            f" net: {net_total}, sum: {slice_prev_total})"
+        )
+        if TRACE.enabled:
+            TRACE.add(
+                "net_mismatch", slice_beg, slice_end, net_total, slice_prev_total
+            )
         add_slice_handle_net_fallback(
             slice, last_name_col, net_row_loc, context, parsed_sheet
         )
@@ -276,9 +438,8 @@ def add_slice_handle_net(
             add_head(slice.loc[net_row_loc, :], context, parsed_sheet)
 
     slice_rest = slice.loc[net_row_loc + 1 :, :]
-    logging.debug(f"--> Recursing with slice_rest: \n{slice_rest}")
     if len(slice_rest) > 0:
-        add_slice(slice_rest, last_name_col, context, parsed_sheet)
+        add_slice(slice_rest, last_name_col, context, parsed_sheet, net_rows)
 
 
 def add_slice(
@@ -286,15 +447,18 @@ def add_slice(
     last_name_col: str,
     context: list[str],
     parsed_sheet: BudgetSheet,
+    net_rows: np.ndarray = None,
 ) -> None:
-    logging.debug(f"Adding slice: \n{slice}")
-    if "net" in slice.columns and is_net_col(slice["net"]):
-        logging.debug(f"-> !! NET CASE")
+    logging.debug(f"Adding slice: rows {slice.index.start}-{slice.index.stop}")
+    if net_rows is None:
+        net_rows = get_net_rows(slice)
 
-        slice_net = slice[slice["net"].str.casefold().str.strip() == "net"]
-        net_rows = slice_net.index.tolist()
-        net_row_loc = net_rows[0]
-        add_slice_handle_net(slice, last_name_col, net_row_loc, context, parsed_sheet)
+    net_row_loc = find_net_row(net_rows, slice.index.start, slice.index.stop)
+    if net_row_loc != -1:
+        logging.debug(f"-> !! NET CASE")
+        add_slice_handle_net(
+            slice, last_name_col, net_row_loc, context, parsed_sheet, net_rows
+        )
     else:
         for row_idx, row in slice.iterrows():
             row_head = row[last_name_col]
@@ -302,76 +466,269 @@ def add_slice(
             add_head(row, context + [row_head], parsed_sheet)
 
 
+# cell classes of get_cell_types
+CELL_EMPTY = 0
+CELL_NUM = 1  # float or int (bools included, as with isinstance)
+CELL_ALPHA = 2  # string of 2+ ascii letters only
+CELL_OTHER = 3
+
+# strings are CELL_ALPHA candidates, checked with is_alpha_str
+CELL_TYPE_CLASSES = {
+    float: CELL_NUM,
+    np.float64: CELL_NUM,
+    int: CELL_NUM,
+    bool: CELL_NUM,
+    str: CELL_ALPHA,
+}
+
+
+def is_alpha_str(s: str) -> bool:
+    return set(s.lower()).issubset(set(string.ascii_lowercase)) and len(s) >= 2
+
+
+def get_cell_types(df: pd.DataFrame) -> np.ndarray:
+    """CELL_* class of every cell of df, as a uint8 matrix of df's shape"""
+    values = df.to_numpy(dtype=object)
+    if values.size == 0:
+        return np.full(values.shape, CELL_OTHER, dtype=np.uint8)
+
+    # type() and dict.get are builtins, so neither pass runs Python code per cell
+    value_types = np.frompyfunc(type, 1, 1)(values)
+    cell_types = np.frompyfunc(CELL_TYPE_CLASSES.get, 2, 1)(value_types, CELL_OTHER)
+    cell_types = cell_types.astype(np.uint8)
+
+    is_str = cell_types == CELL_ALPHA
+    if is_str.any():
+        is_alpha = np.frompyfunc(is_alpha_str, 1, 1)(values[is_str]).astype(bool)
+        str_types = np.where(is_alpha, CELL_ALPHA, CELL_OTHER).astype(np.uint8)
+        cell_types[is_str] = str_types
+
+    # NaN is a float, so this goes last
+    cell_types[pd.isna(values)] = CELL_EMPTY
+    return cell_types
+
+
 def get_num_pct(series: pd.Series) -> float:
     total_count = len(series)
-    float_count = series.dropna().apply(lambda x: isinstance(x, float)).sum()
-    int_count = series.dropna().apply(lambda x: isinstance(x, int)).sum()
-    num_count = float_count + int_count
+    num_count = (get_cell_types(series.to_frame()) == CELL_NUM).sum()
     return num_count * 100 if total_count > 0 else 0.0
 
 
 def get_str_pct(series: pd.Series) -> float:
     total_count = len(series)
-    str_count = (
-        series.dropna()
-        .apply(
-            lambda x: isinstance(x, str)
-            and set(x.lower()).issubset(set(string.ascii_lowercase))
-            and len(x) >= 2
-        )
-        .sum()
-    )
+    str_count = (get_cell_types(series.to_frame()) == CELL_ALPHA).sum()
     return (str_count / total_count) * 100 if total_count > 0 else 0.0
 
 
 def get_slice_columns(df: pd.DataFrame) -> tuple[list[str], list[str]]:
     col_key = lambda x: int(re.findall(r"\d+", x)[0])
 
-    scores_num = list(map(lambda x: (get_num_pct(df[x]), x), df.columns))
-    scores_num = sorted(scores_num, reverse=True)
+    all_cols = df.columns.tolist()
+    col_keys = dict(zip(all_cols, map(col_key, all_cols)))
+
+    # one pass over the cells, the rest is per column
+    cell_types = get_cell_types(df)
+    num_counts = (cell_types == CELL_NUM).sum(axis=0).tolist()
+    has_vals = (cell_types != CELL_EMPTY).any(axis=0).tolist()
+
+    # most numeric first, then the 12 rightmost columns that have numbers
+    scores_num = sorted(zip(num_counts, all_cols), reverse=True)
     scores_num = [x for x in scores_num if x[0] > 0]
-    scores_num = sorted(scores_num, key=lambda x: col_key(x[1]), reverse=True)
-    amount_cols = list(map(lambda x: x[1], scores_num[:12]))
-    amount_cols = sorted(amount_cols, key=col_key)
+    scores_num = sorted(scores_num, key=lambda x: col_keys[x[1]], reverse=True)
+    amount_cols = [x[1] for x in scores_num[:12]]
+    amount_cols = sorted(amount_cols, key=col_keys.get)
 
-    amount_col_min = min(amount_cols, key=col_key)
-    name_cols = [x for x in df.columns if col_key(x) < col_key(amount_col_min)]
-    name_cols = df[name_cols].dropna(axis=1, how="all").columns.tolist()
+    amount_key_min = min(col_keys[x] for x in amount_cols)
+    name_cols = [
+        x
+        for x, x_has_vals in zip(all_cols, has_vals)
+        if col_keys[x] < amount_key_min and x_has_vals
+    ]
 
     return name_cols, amount_cols
 
 
-def get_meta_structure(dfg_sheet) -> BudgetSheet:
+def get_template_columns(
+    df: pd.DataFrame, amount_cols: list[str]
+) -> Union[list[str], None]:
+    """
+    Name columns of df if amount_cols are the columns get_slice_columns would
+    pick for it, else None. Only the cells right of the first amount column
+    are classified, name columns just need a value.
+    """
+    if not set(amount_cols).issubset(df.columns):
+        return None
+
+    col_key = lambda x: int(re.findall(r"\d+", x)[0])
+    amount_key_min = col_key(amount_cols[0])
+    all_cols = df.columns.tolist()
+    right_cols = [x for x in all_cols if col_key(x) >= amount_key_min]
+
+    # the 12 rightmost numeric columns, if no other column right of them has numbers
+    has_nums = (get_cell_types(df[right_cols]) == CELL_NUM).any(axis=0).tolist()
+    num_cols = [x for x, x_has_nums in zip(right_cols, has_nums) if x_has_nums]
+    if set(num_cols) != set(amount_cols):
+        return None
+
+    left_cols = [x for x in all_cols if col_key(x) < amount_key_min]
+    has_vals = df[left_cols].notna().any(axis=0).tolist()
+    return [x for x, x_has_vals in zip(left_cols, has_vals) if x_has_vals]
+
+
+def get_layout_key(
+    sheet: Union[pd.DataFrame, SheetData], sheet_struct: BudgetSheet
+) -> str:
+    """
+    Fingerprint of a sheet's column geometry: its column labels, its amount
+    columns and which cells of the header block are filled.
+    """
+    hsec = sheet_struct["header_sec"]
+    if isinstance(sheet, SheetData):
+        header_slice = sheet.get_frame(hsec["start"], hsec["end"] + 1)
+    else:
+        header_slice = sheet.loc[hsec["start"] : hsec["end"]]
+    header_types = get_cell_types(header_slice)
+    layout = [
+        header_slice.columns.tolist(),
+        sheet_struct["amount_cols"],
+        (header_types != CELL_EMPTY).astype(int).tolist(),
+    ]
+    return hashlib.sha1(json.dumps(layout).encode("utf-8")).hexdigest()
+
+
+class LayoutTemplates:
+    """
+    Amount columns of sections, learned per sheet layout (see get_layout_key).
+
+    The first section of a layout runs get_slice_columns and records its 12
+    amount columns. Later sections of the same layout reuse them once
+    get_template_columns confirms them, and fall back to get_slice_columns
+    if it does not.
+    """
+
+    def __init__(self) -> None:
+        self.clear()
+
+    def clear(self) -> None:
+        self.templates: dict[str, list[str]] = {}
+        self.stats = {"learned": 0, "reused": 0, "rejected": 0}
+
+    def __len__(self) -> int:
+        return len(self.templates)
+
+    def get_slice_columns(
+        self, df: pd.DataFrame, layout_key: str = None
+    ) -> tuple[list[str], list[str]]:
+        if layout_key is None:
+            return get_slice_columns(df)
+
+        amount_cols = self.templates.get(layout_key)
+        if amount_cols is not None:
+            name_cols = get_template_columns(df, amount_cols)
+            if name_cols is not None:
+                self.stats["reused"] += 1
+                return name_cols, list(amount_cols)
+
+            self.stats["rejected"] += 1
+            logging.debug(f"Layout template {layout_key[:8]} rejected")
+
+        name_cols, amount_cols = get_slice_columns(df)
+        if layout_key not in self.templates and len(amount_cols) == 12:
+            self.templates[layout_key] = list(amount_cols)
+            self.stats["learned"] += 1
+
+        return name_cols, amount_cols
+
+
+# per workbook, cleared with HEAD_TABLE by parse_demands
+LAYOUT_TEMPLATES = LayoutTemplates()
+
+
+def get_sheet_strs(dfg_sheet: Union[pd.DataFrame, SheetData]) -> list[tuple[int, str]]:
+    """(row_idx, concatenated string cells) for every row with any text"""
+    if isinstance(dfg_sheet, SheetData):
+        str_cells = dfg_sheet.str_cells
+        row_idxes = np.arange(len(str_cells))
+    else:
+        cells = dfg_sheet.to_numpy(dtype=object)
+        cell_types = np.frompyfunc(type, 1, 1)(cells)
+        str_cells = np.where(cell_types == str, cells, "")
+        row_idxes = dfg_sheet.index.to_numpy()
+
+    if str_cells.size == 0:
+        return []
+
+    # object-dtype add concatenates the string cells of each row
+    row_strs = np.add.reduce(str_cells, axis=1).astype(str)
+    row_strs = np.char.strip(row_strs)
+    has_text = np.char.str_len(row_strs) > 0
+
+    return list(zip(row_idxes[has_text].tolist(), row_strs[has_text].tolist()))
+
+
+# Markers located by get_meta_structure, matched like find_candidates does
+META_MARKERS = {
+    "demand": re.compile(".*Demand No.*", re.DOTALL),
+    "budget": re.compile(".*Budget Estimates.*", re.DOTALL),
+    "revenue": re.compile("RevenueCapitalTotal", re.DOTALL),
+}
+SECTION_MARKER = re.compile("^([A-F]). ", re.DOTALL)
+
+
+def classify_sheet_strs(
+    sheet_strs: list[tuple[int, str]]
+) -> tuple[dict[str, int], dict[str, int]]:
+    """
+    Single pass over sheet_strs. Returns the position in sheet_strs of the
+    first row matching each of META_MARKERS, and of the first header row of
+    each section A-F.
+    """
+    markers_found: dict[str, int] = {}
+    sections_found: dict[str, int] = {}
+
+    for pos, (_, row_str) in enumerate(sheet_strs):
+        for marker_name, marker_re in META_MARKERS.items():
+            if marker_name not in markers_found and marker_re.match(row_str):
+                markers_found[marker_name] = pos
+
+        sec_match = SECTION_MARKER.match(row_str)
+        if sec_match and sec_match.group(1) not in sections_found:
+            sections_found[sec_match.group(1)] = pos
+
+    return markers_found, sections_found
+
+
+def get_row_labels(
+    dfg_sheet: Union[pd.DataFrame, SheetData], row_idx: int, vals: list[str]
+) -> list[str]:
+    """Column labels of the cells in row row_idx that equal one of vals"""
+    if isinstance(dfg_sheet, SheetData):
+        row = dfg_sheet.str_cells[row_idx]
+        return [dfg_sheet.columns[c] for c in np.flatnonzero(np.isin(row, vals))]
+
+    row = dfg_sheet.iloc[row_idx, :]
+    return row[row.isin(vals)].index.tolist()
+
+
+def get_meta_structure(dfg_sheet: Union[pd.DataFrame, SheetData]) -> BudgetSheet:
     """Parse sections in the sheet. Section ranges are (a, b]"""
-    sheet_strs = []
-    for row_idx, row in dfg_sheet.iterrows():
-        row_clean = row.dropna()
-        row_str = "".join([x for x in row_clean if type(x) == str])
-        row_str = row_str.strip()
-        if len(row_str) > 0:
-            sheet_strs.append((row_idx, row_str))
-
-    results = find_candidates(sheet_strs, ".*Demand No.*")
-    if len(results) < 1:
+    sheet_strs = get_sheet_strs(dfg_sheet)
+    markers_found, sections_found = classify_sheet_strs(sheet_strs)
+
+    if "demand" not in markers_found:
         logging.warning("WARN: Cannot parse sheet!")
         return None
 
-    demand_lid, demand_line = results[0]
+    demand_lid, demand_line = sheet_strs[markers_found["demand"]]
+    budget_lid, budget_line = sheet_strs[markers_found["budget"]]
 
-    results = find_candidates(sheet_strs, ".*Budget Estimates.*")
-    budget_lid, budget_line = results[0]
-
-    results = find_candidates(sheet_strs, "RevenueCapitalTotal")
-    revenue_lid, revenue_line = results[0]
-    revenue_row = dfg_sheet.iloc[revenue_lid, :]
-    amount_cols = revenue_row[
-        revenue_row.isin(["Revenue", "Capital", "Total"])
-    ].index.tolist()
+    revenue_lidx = markers_found["revenue"]
+    revenue_lid, revenue_line = sheet_strs[revenue_lidx]
+    amount_cols = get_row_labels(dfg_sheet, revenue_lid, ["Revenue", "Capital", "Total"])
 
     assert len(amount_cols) == 12
     assert revenue_lid > budget_lid
 
-    revenue_lidx = sheet_strs.index((revenue_lid, revenue_line))
     header_actual = sheet_strs[revenue_lidx + 1 : revenue_lidx + 5]
     header_sec_expected = ["Gross", "Recoveries", "Receipts", "Net"]
     for sec_actual, sec_expected in zip(header_actual, header_sec_expected):
@@ -379,18 +736,14 @@ def get_meta_structure(dfg_sheet) -> BudgetSheet:
 
     header_sec = {"start": header_actual[0][0], "end": header_actual[-1][0]}
 
-    find_candidates(sheet_strs, "^A. ")
-    find_candidates(sheet_strs, "^D. ")
-
     all_sections = []
 
     logging.info("Discovering sections...")
     section_candidates = ["A", "B", "C", "D", "E", "F"]
     for sec in section_candidates:
-        candidates = find_candidates(sheet_strs, f"^{sec}. ")
-        if len(candidates) > 0:
+        if sec in sections_found:
             logging.info(f"Found section {sec}")
-            cur_sec_beg = candidates[0][0]
+            cur_sec_beg = sheet_strs[sections_found[sec]][0]
             if len(all_sections) > 0:
                 all_sections[-1]["end"] = cur_sec_beg
             section = {"name": sec, "start": cur_sec_beg, "end": -1}
@@ -416,16 +769,76 @@ def get_meta_structure(dfg_sheet) -> BudgetSheet:
     return sheet_structure
 
 
+def triage_sheet(sheet: SheetData) -> SheetTriage:
+    """
+    Decide from the first rows of a sheet (see WorkbookReader.read_sheet's
+    max_rows) whether it is a demand sheet, like get_meta_structure does
+    from the whole sheet. Header fields are filled in when the header block
+    is within the rows read, and left empty otherwise.
+    """
+    triage: SheetTriage = {
+        "sheet_idx": sheet.sheet_idx,
+        "sheet_name": sheet.sheet_name,
+        "is_demand": False,
+        "demand_no": None,
+        "header": [],
+        "header_sec": {},
+        "amount_cols": [],
+    }
+
+    sheet_strs = get_sheet_strs(sheet)
+    markers_found, _ = classify_sheet_strs(sheet_strs)
+    if "demand" not in markers_found:
+        return triage
+
+    demand_line = sheet_strs[markers_found["demand"]][1]
+    triage["is_demand"] = True
+    triage["header"] = demand_line.split("\n")
+
+    demand_nos = re.findall(r"Demand No\.?\s*(\d+)", demand_line)
+    if len(demand_nos) > 0:
+        triage["demand_no"] = int(demand_nos[0])
+
+    if "revenue" in markers_found:
+        revenue_lidx = markers_found["revenue"]
+        revenue_lid = sheet_strs[revenue_lidx][0]
+        triage["amount_cols"] = get_row_labels(
+            sheet, revenue_lid, ["Revenue", "Capital", "Total"]
+        )
+
+        header_actual = sheet_strs[revenue_lidx + 1 : revenue_lidx + 5]
+        if len(header_actual) == 4:
+            triage["header_sec"] = {
+                "start": header_actual[0][0],
+                "end": header_actual[-1][0],
+            }
+
+    return triage
+
+
 def parse_recursive(
     sheet_slice,
     names_cols: list[str],
     cur_col_idx: int,
     context: list,
     parsed_sheet: BudgetSheet,
+    net_rows: np.ndarray = None,
 ) -> None:
     if len(sheet_slice) == 0:
         return
 
+    if net_rows is None:
+        net_rows = get_net_rows(sheet_slice)
+
+    if TRACE.enabled:
+        TRACE.add(
+            "enter_range",
+            sheet_slice.index.start,
+            sheet_slice.index.stop,
+            cur_col_idx,
+            context,
+        )
+
     if len(sheet_slice) == 1:
         head = sheet_slice.iloc[0, :][names_cols[cur_col_idx]]
         logging.debug(f"--> Single row: {head}")
@@ -438,11 +851,16 @@ def parse_recursive(
                 )
             else:
                 parse_recursive(
-                    sheet_slice, names_cols, cur_col_idx + 1, context, parsed_sheet
+                    sheet_slice,
+                    names_cols,
+                    cur_col_idx + 1,
+                    context,
+                    parsed_sheet,
+                    net_rows,
                 )
         return
 
-    logging.debug(f"In parse_recursive (context: {context})\n{sheet_slice}")
+    logging.debug(f"In parse_recursive (context: {context})")
 
     # if cur_col_idx == len(names_cols) - 1:
     #     last_name_col = names_cols[cur_col_idx]
@@ -455,7 +873,7 @@ def parse_recursive(
     if cur_col_idx >= len(names_cols):
         logging.critical(
             f"parse_recursive: cur_col_idx >= len(names_cols)."
-            f" skipping slice:\n{sheet_slice}"
+            f" skipping rows {sheet_slice.index.start}-{sheet_slice.index.stop}"
         )
         return
 
@@ -466,7 +884,9 @@ def parse_recursive(
         # print(sheet_slice)
         # add_head(sheet_slice.iloc[0, :], context)
         logging.debug("Recursing ...")
-        parse_recursive(sheet_slice, names_cols, cur_col_idx + 1, context, parsed_sheet)
+        parse_recursive(
+            sheet_slice, names_cols, cur_col_idx + 1, context, parsed_sheet, net_rows
+        )
         return
 
     heads_all_caps = [h for h in valid_heads if is_mostly_caps(h)]
@@ -506,6 +926,9 @@ def parse_recursive(
             # Add the start head
             # add_head(sheet_slice.loc[beg_idx, :], context + [head_open])
 
+        if TRACE.enabled:
+            TRACE.add("head_pair", head_open, beg_idx, end_idx, head_close_found)
+
         if beg_idx < cur_max_end_idx:
             # recursive heads
             logging.debug(
@@ -523,6 +946,7 @@ def parse_recursive(
                 cur_col_idx,
                 context,
                 parsed_sheet,
+                net_rows,
             )
 
         if head_close_found:
@@ -533,6 +957,7 @@ def parse_recursive(
                 cur_col_idx,
                 context + [head_open],
                 parsed_sheet,
+                net_rows,
             )
         elif is_mostly_caps(head_open):
             parse_recursive(
@@ -541,19 +966,18 @@ def parse_recursive(
                 cur_col_idx,
                 context + [head_open],
                 parsed_sheet,
+                net_rows,
             )
         else:
             # consume head, either as individual entity, or as part of a net
             # we have no right to consume past current head_open
             # that is handled by recursion
             net_slice = get_net_slice(
-                sheet_slice.loc[beg_idx:, :], names_cols, cur_col_idx
+                sheet_slice.loc[beg_idx:, :], names_cols, cur_col_idx, net_rows
             )
-            logging.debug(f"net slice: {net_slice}")
             head_slice = get_head_slice(
                 sheet_slice.loc[beg_idx:, :], names_cols, cur_col_idx
             )
-            logging.debug(f"head slice: {head_slice}")
             if net_slice is not None:
                 logging.debug("Found net slice!!")
                 add_slice(
@@ -561,6 +985,7 @@ def parse_recursive(
                     names_cols[cur_col_idx],
                     context + [head_open],
                     parsed_sheet,
+                    net_rows,
                 )
             else:
                 logging.debug("Found head slice!!")
@@ -579,6 +1004,7 @@ def parse_recursive(
                         cur_col_idx,
                         context + [head_open],
                         parsed_sheet,
+                        net_rows,
                     )
 
         cur_max_end_idx = end_idx
@@ -590,72 +1016,156 @@ def parse_recursive(
             cur_col_idx + 1,
             context,
             parsed_sheet,
+            net_rows,
         )
 
     pass
 
 
-def parse_section(
-    sheet: pd.DataFrame, section_spec: dict, parsed_sheet: BudgetSheet
-) -> None:
-    logging.info(f"Parsing section: {section_spec['name']}")
+class SectionInput(TypedDict):
+    name: str
+    header: str
+    labels: pd.Index
+    columns: dict[str, np.ndarray]
+    name_cols: list[str]
+    amounts: np.ndarray
+    # rows x AMOUNT_HEADS, amounts is its be_cur_total column
+    measures: np.ndarray
+    nbytes: int
 
-    sbeg, send = section_spec["start"], section_spec["end"]
-    sec_slice = sheet.iloc[sbeg:send, :].copy()
-    # sec_slice = sheet.iloc[sbeg:send, :].dropna(axis=1, how="all")
-    # sec_slice = sheet.iloc[sbeg:send, :].copy().dropna(axis=1, how="all")
 
-    maj_heads = ["actual_prev2", "be_prev", "re_prev", "be_cur"]
-    sub_heads = ["revenue", "capital", "total"]
-    amount_heads = []
-    for mh in maj_heads:
-        for sh in sub_heads:
-            amount_heads.append(f"{mh}_{sh}")
+AMOUNT_HEADS = [
+    f"{mh}_{sh}"
+    for mh in ["actual_prev2", "be_prev", "re_prev", "be_cur"]
+    for sh in ["revenue", "capital", "total"]
+]
 
-    name_cols, amount_cols = get_slice_columns(sec_slice)
+normalize_heads = np.frompyfunc(normalize_head, 1, 1)
 
-    # rename all columns in amount_cols to amount_heads
-    sec_slice = sec_slice.rename(columns=dict(zip(amount_cols, amount_heads)))
 
-    name_cols_renamed = [f"name{idx}" for idx in range(len(name_cols))]
-    sec_slice = sec_slice.rename(columns=dict(zip(name_cols, name_cols_renamed)))
+def get_section_input(
+    sheet: Union[pd.DataFrame, SheetData], section_spec: dict, layout_key: str = None
+) -> SectionInput:
+    """
+    Cut a section out of a sheet in one pass, as column arrays. Name columns
+    are renamed to name0..nameN and normalized, amount columns to
+    AMOUNT_HEADS, and the net column (if any) to "net". Rows exclude the
+    section header and the Grand Total row, columns that are empty in them
+    are dropped. With a layout_key, the columns come from LAYOUT_TEMPLATES.
+
+    Only the normalized name columns and the amount columns as one float64
+    matrix are allocated, every other column is a view into the sheet. A
+    SheetData sheet is only read as a frame of the section's rows.
+    """
+    logging.info(f"Parsing section: {section_spec['name']}")
+    if TRACE.enabled:
+        TRACE.add(
+            "section", section_spec["name"], section_spec["start"], section_spec["end"]
+        )
 
-    valid_cols = [col for col in sec_slice.columns if "Unnamed: " not in col]
-    sec_slice = sec_slice[valid_cols]
+    sbeg, send = section_spec["start"], section_spec["end"]
+    # a row slice of a sheet is a view, it is only read from
+    if isinstance(sheet, SheetData):
+        sec_rows = sheet.get_frame(sbeg, send)
+    else:
+        sec_rows = sheet.iloc[sbeg:send]
+    name_cols, amount_cols = LAYOUT_TEMPLATES.get_slice_columns(sec_rows, layout_key)
 
-    for col in name_cols_renamed:
-        sec_slice[col] = normalize_col(sec_slice[col])
+    col_renames = dict(zip(amount_cols, AMOUNT_HEADS))
+    col_renames.update((col, f"name{idx}") for idx, col in enumerate(name_cols))
 
-    sec_row_beg = sec_slice.index.start
-    sec_row_end = sec_slice.index.stop
+    all_cols = {}
+    for col in sec_rows.columns:
+        col_renamed = col_renames.get(col, col)
+        if "Unnamed: " in col_renamed:
+            continue
+        col_vals = sec_rows[col].to_numpy()
+        if col_renamed.startswith("name"):
+            col_vals = normalize_heads(col_vals)
+        all_cols[col_renamed] = col_vals
 
-    sec_header = sec_slice.iloc[0][0]
+    sec_header = next(iter(all_cols.values()))[0]
     assert re.match(r"^[A-Z].\ .*", sec_header)
 
     # Skip section header from parsing
-
-    sec_row_beg += 1
-    grand_total_row = get_row_idx(sec_slice[name_cols_renamed[0]], "Grand Total")
+    row_beg, row_end = 1, send - sbeg
+    name0 = pd.Series(all_cols["name0"], copy=False)
+    grand_total_row = get_row_idx(name0, "Grand Total")
     if grand_total_row != -1:
-        sec_row_end = grand_total_row - 1
+        row_end = grand_total_row
+
+    columns = {}
+    for col, col_vals in all_cols.items():
+        col_vals = col_vals[row_beg:row_end]
+        if not pd.isna(col_vals).all():
+            columns[col] = col_vals
+
+    name_cols = [c for c in all_cols if c.startswith("name") and c in columns]
+    if is_net_col(pd.Series(columns[name_cols[-1]], copy=False)):
+        net_col = name_cols.pop()
+        columns = {("net" if c == net_col else c): v for c, v in columns.items()}
+
+    # column-major, so each amount column (be_cur_total first of all) is
+    # contiguous, and columns empty in the section stay NaN
+    measures = np.full((row_end - row_beg, len(AMOUNT_HEADS)), np.nan, order="F")
+    for col_idx, col in enumerate(AMOUNT_HEADS):
+        if col in columns:
+            measures[:, col_idx] = pd.to_numeric(columns[col], errors="coerce")
+    amounts = measures[:, AMOUNT_HEADS.index("be_cur_total")]
+
+    nbytes = measures.nbytes + sum(
+        all_cols[c].nbytes for c in all_cols if c.startswith("name")
+    )
+    logging.debug(
+        f"Prepared section {section_spec['name']}: {len(amounts)} rows,"
+        f" {len(columns)} columns, peak {nbytes} bytes"
+    )
 
-    sec_slice = sec_slice.loc[sec_row_beg:sec_row_end, :]
-    sec_slice = sec_slice.dropna(axis=1, how="all")
+    return {
+        "name": section_spec["name"],
+        "header": sec_header,
+        "labels": sec_rows.index[row_beg:row_end],
+        "columns": columns,
+        "name_cols": name_cols,
+        "amounts": amounts,
+        "measures": measures,
+        "nbytes": nbytes,
+    }
+
+
+def prepare_section(
+    sheet: Union[pd.DataFrame, SheetData], section_spec: dict, layout_key: str = None
+) -> tuple[pd.DataFrame, list[str], str]:
+    """
+    get_section_input as a frame, for the frame engine. Returns
+    (sec_slice, name_cols, sec_header), the frame is the only copy made.
+    """
+    sec_input = get_section_input(sheet, section_spec, layout_key)
+    sec_slice = pd.DataFrame(sec_input["columns"], index=sec_input["labels"])
 
-    name_cols = [c for c in name_cols_renamed if c in sec_slice.columns]
+    frame_bytes = int(sec_slice.memory_usage(index=False).sum())
+    logging.debug(
+        f"Section frame {sec_input['name']}: {frame_bytes} bytes,"
+        f" peak {sec_input['nbytes'] + frame_bytes} bytes"
+    )
+
+    return sec_slice, sec_input["name_cols"], sec_input["header"]
 
-    if is_net_col(sec_slice[name_cols[-1]]):
-        net_col = name_cols[-1]
-        name_cols = name_cols[:-1]
-        sec_slice = sec_slice.rename(columns={net_col: "net"})
 
-    parse_recursive(sec_slice, name_cols, 0, [sec_header], parsed_sheet)
+def parse_section(
+    sheet: Union[pd.DataFrame, SheetData],
+    section_spec: dict,
+    parsed_sheet: BudgetSheet,
+    layout_key: str = None,
+) -> None:
+    sec_slice, name_cols, sec_header = prepare_section(sheet, section_spec, layout_key)
+    net_rows = get_net_rows(sec_slice)
+    parse_recursive(sec_slice, name_cols, 0, [sec_header], parsed_sheet, net_rows)
 
 
 def parse_header(sheet_header, names_cols: list[str]) -> dict[str, float]:
     # sheet_header = sheet_header[names_cols]
     sheet_header = sheet_header.dropna(axis=1, how="all")
-    logging.debug(f"Sheet header: \n{sheet_header}")
     header_keys = sheet_header.iloc[:, 0].tolist()
     header_vals = sheet_header.iloc[:, -1].tolist()
     # convert to np.array, make NaN in case of errors
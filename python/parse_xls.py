@@ -7,15 +7,20 @@ import pandas as pd
 import sys
 import logging
 
+from budget_store import BudgetStore
 from budget_tree import BudgetNode, BudgetTreeUtils
+from tree_store import TreeNodeView, TreeStore
 from parse_utils import (
     get_meta_structure,
     parse_header,
     parse_section,
+    clean_header,
+    clean_str,
     BudgetSheet,
 )
 
-from parse_demands import parse_secondary_sheets
+from parse_demands import parse_secondary_sheets, triage_workbook
+from sheet_reader import WorkbookReader
 
 
 def reconstruct_hierarchy_from_df(df, key_column, heuristic):
@@ -64,20 +69,22 @@ def parse_main_sheet(main_sheet):
 
 def setup_main_sheet():
     xls_path = r"budget_doc/allsbe.xlsx"
-    xls_file = pd.ExcelFile(xls_path, engine="openpyxl")
-    xls_sheet0 = xls_file.parse(0)
+    with WorkbookReader(xls_path, convert_float=True) as xls_reader:
+        xls_sheet0 = xls_reader.read_sheet(0).to_frame()
     min_df, dept_df = parse_main_sheet(xls_sheet0)
     min_df
     dept_df
     print(xls_sheet0)
 
 
-def parse_demands(xls_file: pd.ExcelFile):
-    num_sheets = len(xls_file.sheet_names)
+def parse_demands(xls_reader: WorkbookReader):
+    num_sheets = len(xls_reader.sheet_names)
+    all_triage = triage_workbook(xls_reader, range(1, num_sheets))
+    demand_idxes = [t["sheet_idx"] for t in all_triage if t["is_demand"]]
+
     all_structs = []
-    for sheet_idx in range(1, num_sheets):
-        logging.info(f"Parsing Sheet {sheet_idx}")
-        sheet = xls_file.parse(sheet_idx)
+    for sheet in xls_reader.iter_sheets(demand_idxes):
+        logging.info(f"Parsing Sheet {sheet.sheet_idx}")
         sheet_struct = get_meta_structure(sheet)
         if sheet_struct is not None:
             all_structs.append(sheet_struct)
@@ -130,6 +137,8 @@ def parse_demands(xls_file: pd.ExcelFile):
 
 def construct_tree(main_sheet) -> BudgetNode:
     tree_root = BudgetNode("GOI2023-24", 0)
+    # ministry/department paths of the demand trees added later
+    tree_root.make_path_index()
 
     min_df, dept_df = parse_main_sheet(main_sheet)
     print(min_df)
@@ -170,49 +179,39 @@ def construct_tree(main_sheet) -> BudgetNode:
 #     fig.show()
 
 
-def clean_str(s: str) -> str:
-    s = "".join([c if c in string.printable else " " for c in s])
-    s = re.sub(r"\s+", " ", s)
-    return s
-
-
 def read_budget_json(json_path: str) -> BudgetSheet:
     fdata = json.loads(open(json_path).read())
-    fheader = fdata["header"]
-
-    if len(fheader) > 3:
-        fheader[2] = "".join(fheader[2:])
-        fdata_header = fheader[:3]
-    elif len(fheader) == 3:
-        fdata_header = fheader
-    else:
-        logging.error(f"Invalid header: {fheader}")
-        sys.exit(-1)
-
-        # print(fdata_header)
-    fdata["header"] = list(map(clean_str, fdata_header))
+    fdata["header"] = clean_header(fdata["header"])
 
     return fdata
 
 
-def get_all_jsons(json_dir: str) -> list[BudgetSheet]:
+def read_all_sheets(json_dir: str) -> dict[int, BudgetSheet]:
+    """Parsed demands by demand no., from a budget_parsed/ dir or a store file"""
+    if os.path.isfile(json_dir):
+        store = BudgetStore(json_dir)
+        logging.info(f"Found {len(store.demand_ids)} demands in {json_dir}")
+        return store.get_all_sheets()
+
     all_files = glob.glob(f"{json_dir}/*.json")
     logging.info(f"Found {len(all_files)} json files")
 
-    f = all_files[0]
-    all_headers = []
-    all_data = []
-
     get_int = lambda x: int(re.findall(r"\d+", x)[0])
     all_fdata: dict[int, BudgetSheet] = {}
 
     for f in all_files:
         fdata = read_budget_json(f)
-        fheader = fdata["header"]
-        all_headers.append(fheader)
-        dno = get_int(fheader[1])
+        dno = get_int(fdata["header"][1])
         all_fdata[dno] = fdata
 
+    return all_fdata
+
+
+def get_all_jsons(json_dir: str) -> list[BudgetSheet]:
+    get_int = lambda x: int(re.findall(r"\d+", x)[0])
+    all_fdata = read_all_sheets(json_dir)
+    all_headers = [fdata["header"] for fdata in all_fdata.values()]
+
     all_headers = sorted(all_headers, key=lambda x: get_int(x[1]))
     all_mins = list(zip(*all_headers))[0]
     all_mins_uniq = set(all_mins)
@@ -222,22 +221,9 @@ def get_all_jsons(json_dir: str) -> list[BudgetSheet]:
 
 
 def get_all_jsons_min(json_dir: str) -> tuple[list[list[str]], list[BudgetSheet]]:
-    all_files = glob.glob(f"{json_dir}/*.json")
-    logging.info(f"Found {len(all_files)} json files")
-
-    f = all_files[0]
-    all_headers = []
-    all_data = []
-
     get_int = lambda x: int(re.findall(r"\d+", x)[0])
-    all_fdata: dict[int, BudgetSheet] = {}
-
-    for f in all_files:
-        fdata = read_budget_json(f)
-        fheader = fdata["header"]
-        all_headers.append(fheader)
-        dno = get_int(fheader[1])
-        all_fdata[dno] = fdata
+    all_fdata = read_all_sheets(json_dir)
+    all_headers = [fdata["header"] for fdata in all_fdata.values()]
 
     all_headers = sorted(all_headers, key=lambda x: get_int(x[1]))
     all_mins = list(zip(*all_headers))[0]
@@ -270,39 +256,72 @@ def get_all_jsons_min(json_dir: str) -> tuple[list[list[str]], list[BudgetSheet]
     for mroot in trees_minwise:
         goi_root.add_child_node(mroot)
 
-    goi_root.adjust_totals_with_children()
-    print(goi_root.serialize(recursive=True, max_depth=1))
-    print(goi_root.children[0].serialize(recursive=True, max_depth=1))
+    # the finished tree as arrays, the nodes are dropped
+    goi_store = TreeStore.from_node(goi_root)
+    del goi_root, trees_minwise
+    goi_store.adjust_totals_with_children()
+    goi_tree = goi_store.root
+
+    print(goi_tree.serialize(recursive=True, max_depth=1))
+    print(goi_tree.children[0].serialize(recursive=True, max_depth=1))
     #  goi_root.children[0].adjust_totals_with_children()
     #  print(goi_root.children[0].serialize(recursive=True))
 
-    BudgetTreeUtils.serialize_full_goi(goi_root, "goi2324.v3")
+    BudgetTreeUtils.serialize_full_goi(goi_tree, "goi2324.v3")
 
     logging.info(f"Found {len(all_mins_uniq)} ministries (Total: {len(all_mins)})")
     return all_headers, all_fdata
 
 
+def gen_budget_store(json_dir: str, store_path: str) -> None:
+    all_files = sorted(glob.glob(f"{json_dir}/*.json"))
+    all_sheets = [json.loads(open(f).read()) for f in all_files]
+    BudgetStore.write(all_sheets, store_path)
+
+
+# sections the trees are built from, parse_secondary_sheets(sections=...)
+# need not parse any other
+TREE_SECTIONS = ["A"]
+TREE_HEAD_PREFIXES = tuple(f"{sec}. " for sec in TREE_SECTIONS)
+
+
 def add_json_to_tree_root(tree_root: BudgetNode, json_path: str) -> BudgetNode:
     data = json.loads(open(json_path).read())
-    heads = [h for h in data["amount_heads"] if h["head"][0].startswith("A. ")]
+    heads = [
+        h for h in data["amount_heads"] if h["head"][0].startswith(TREE_HEAD_PREFIXES)
+    ]
 
     min, dept = data["header"][0], data["header"][2]
     json_root = tree_root.get_child_ls([min, dept])
     for h in heads:
         json_root.add_child_ls(h["head"][1:], h["amount"])
+    json_root.finalize()
 
     return json_root
 
 
-def make_json_tree(data: BudgetSheet) -> BudgetNode:
+def make_json_tree(data: BudgetSheet, measures: bool = False) -> TreeNodeView:
+    """
+    With measures, every node also carries all amount columns of its heads,
+    for which the sheet must be parsed with measures (parse_secondary_sheets)
+    """
     json_root_str = "\n".join(data["header"])
-    json_root = BudgetNode(json_root_str, 0)
-    heads = [h for h in data["amount_heads"] if h["head"][0].startswith("A. ")]
+    heads = [
+        h for h in data["amount_heads"] if h["head"][0].startswith(TREE_HEAD_PREFIXES)
+    ]
 
-    for h in heads:
-        json_root.add_child_ls(h["head"][1:], h["amount"])
+    # as add_child_ls of every head on BudgetNode(json_root_str, 0)
+    all_paths = [h["head"][1:] for h in heads]
+    amounts = [h["amount"] for h in heads]
+    all_measures = None
+    if measures:
+        if any("amounts" not in h for h in heads):
+            raise ValueError(
+                f"Heads without amounts in {data['header'][0]}, parse with measures"
+            )
+        all_measures = [h["amounts"] for h in heads]
 
-    return json_root
+    return TreeStore.from_heads(json_root_str, all_paths, amounts, all_measures).root
 
 
 def gen_demands_dir(all_data: list[BudgetSheet], out_dir: str):
@@ -325,14 +344,14 @@ def gen_demands_dir(all_data: list[BudgetSheet], out_dir: str):
     demands_dir_df.to_csv(f"{out_dir}/demands_dir.csv", index=False)
 
 
-def gen_serialized_dfs(json_dir: str, out_dir: str):
+def gen_serialized_dfs(json_dir: str, out_dir: str, measures: bool = False):
     os.makedirs(out_dir, exist_ok=True)
 
     all_data = get_all_jsons(json_dir)
     gen_demands_dir(all_data, out_dir)
 
     for demand_id, data in all_data.items():
-        tree = make_json_tree(data)
+        tree = make_json_tree(data, measures)
         df = tree.serialize_rows()
         df_path = f"{out_dir}/dno_{demand_id}.csv"
         df.to_csv(df_path, index=False)
@@ -340,14 +359,14 @@ def gen_serialized_dfs(json_dir: str, out_dir: str):
     return
 
 
-def gen_edge_dfs(json_dir: str, out_dir: str):
+def gen_edge_dfs(json_dir: str, out_dir: str, measures: bool = False):
     os.makedirs(out_dir, exist_ok=True)
 
     all_data = get_all_jsons(json_dir)
     gen_demands_dir(all_data, out_dir)
 
     for demand_id, data in all_data.items():
-        tree = make_json_tree(data)
+        tree = make_json_tree(data, measures)
         df = BudgetTreeUtils.serialize(tree)
         df_path = f"{out_dir}/dno_{demand_id}.csv"
         df.to_csv(df_path, index=False)
@@ -394,9 +413,10 @@ def gen_min_edge_dfs(json_dir: str, out_dir: str):
 
 def run():
     logging.basicConfig(level=logging.INFO, stream=sys.stdout)
-    # parse_secondary_sheets()
+    # parse_secondary_sheets(sections=TREE_SECTIONS)
     #  gen_serialized_dfs("budget_parsed", "budget_treemap")
     #  gen_edge_dfs("budget_parsed", "budget_edges")
+    #  gen_budget_store("budget_parsed", "budget_parsed.bst")
     gen_min_edge_dfs("budget_parsed", "budget_edges_min")
 
 
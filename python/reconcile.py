@@ -0,0 +1,198 @@
+import logging
+import numpy as np
+import pandas as pd
+
+from typing import TypedDict
+
+from parse_arrays import SectionArrays
+from parse_utils import HEAD_TOTAL, HEAD_VALID
+
+# same tolerance as the net check of the parser, see expand_add_range_net
+RECONCILE_TOL = 1
+
+RECONCILE_COLS = [
+    "demand",
+    "section",
+    "kind",
+    "row",
+    "path",
+    "expected",
+    "actual",
+    "delta",
+]
+
+
+class Reconciliation(TypedDict):
+    demand: int
+    section: str
+    kind: str  # "total" or "net"
+    row: int  # sheet row of the Total/Net row
+    path: list[str]
+    expected: float
+    actual: float
+    delta: float
+
+
+def get_total_pairs(section: SectionArrays) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Rows of every head with a "Total - <head>" below it in the same name
+    column, and of that first Total row.
+    """
+    head_table = section.head_table
+    opens, closes = [], []
+    for col_idx, flags in enumerate(section.name_flags):
+        ids = section.name_ids[col_idx]
+        for row_idx in np.flatnonzero(flags & HEAD_VALID).tolist():
+            close_id = head_table.get_close(int(ids[row_idx]))
+            if close_id == -1:
+                continue
+
+            close_str = head_table.strs[close_id]
+            close_row, _ = section.head_index[col_idx].find(
+                close_str, row_idx + 1, section.nrows
+            )
+            if close_row != -1:
+                opens.append(row_idx)
+                closes.append(close_row)
+
+    return np.array(opens, dtype=np.int64), np.array(closes, dtype=np.int64)
+
+
+def get_net_groups(section: SectionArrays) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Net rows with an amount, and per name column the last row above each
+    with a string there (-1 if none). A Net row nets the rows from one of
+    these heads down to it: "8 ." in name0 over its 8.01, 8.02, ... or just
+    3.03 in name1 over its Recoveries row.
+    """
+    net_rows = section.net_rows[~np.isnan(section.amounts[section.net_rows])]
+
+    net_heads = np.full((len(section.names), len(net_rows)), -1, dtype=np.int64)
+    for col_idx, ids in enumerate(section.name_ids):
+        head_rows = np.concatenate([[-1], np.flatnonzero(ids >= 0)])
+        net_heads[col_idx] = head_rows[np.searchsorted(head_rows, net_rows) - 1]
+
+    return net_rows, net_heads
+
+
+def get_segment_sums(vals: np.ndarray, begs: np.ndarray, ends: np.ndarray):
+    """
+    Sums of vals over every [beg, end). Segments may nest, so vals is cut at
+    all distinct bounds by one np.add.reduceat and the segments are summed
+    from the running total of the parts.
+    """
+    if len(begs) == 0:
+        return np.zeros(0)
+
+    bounds = np.unique(np.concatenate([[0], begs, ends]))
+    bounds = bounds[bounds < len(vals)]
+    part_sums = np.add.reduceat(vals, bounds)
+    cum_sums = np.concatenate([[0.0], np.cumsum(part_sums)])
+
+    # len(vals) as an end maps past the last part
+    bounds = np.append(bounds, len(vals))
+    beg_parts = np.searchsorted(bounds, begs)
+    end_parts = np.searchsorted(bounds, ends)
+    return cum_sums[end_parts] - cum_sums[beg_parts]
+
+
+def get_row_head(section: SectionArrays, row_idx: int) -> str:
+    """First valid head on a row, None if it has none"""
+    for col_idx, flags in enumerate(section.name_flags):
+        if flags[row_idx] & HEAD_VALID:
+            return section.names[col_idx][row_idx]
+    return None
+
+
+def get_row_path(
+    section: SectionArrays, opens: np.ndarray, closes: np.ndarray, row_idx: int
+) -> list[str]:
+    """Heads of the Total pairs around a row, outermost first"""
+    is_around = (opens < row_idx) & (closes > row_idx)
+    return [get_row_head(section, x) for x in np.sort(opens[is_around]).tolist()]
+
+
+def reconcile_section(
+    section: SectionArrays, sec_header: str, demand_no: int, section_name: str
+) -> list[Reconciliation]:
+    """
+    Check every Total row against the amounts between its head and itself,
+    and every Net row against the amounts from its group head down to it.
+    Only mismatches are returned.
+    """
+    amounts = np.nan_to_num(section.amounts)
+
+    # Total and Net rows repeat amounts of the rows above them. A Net row
+    # that agrees with its rows adds nothing over them, one that does not
+    # is reported and its rows still count.
+    is_leaf = np.ones(section.nrows, dtype=bool)
+    is_leaf[section.net_rows] = False
+    for flags in section.name_flags:
+        is_leaf &= (flags & HEAD_TOTAL) == 0
+    leaf_amounts = np.where(is_leaf, amounts, 0.0)
+
+    opens, closes = get_total_pairs(section)
+    net_rows, net_heads = get_net_groups(section)
+    ncols, nnets = net_heads.shape
+    has_head = net_heads >= 0
+    group_begs = np.where(has_head, net_heads, net_rows).ravel()
+    group_ends = np.tile(net_rows, ncols)
+
+    # all segments in one reduction, totals first
+    all_sums = get_segment_sums(
+        leaf_amounts,
+        np.concatenate([opens + 1, group_begs]),
+        np.concatenate([closes, group_ends]),
+    )
+    total_sums = all_sums[: len(opens)]
+    group_sums = all_sums[len(opens) :].reshape(ncols, nnets)
+
+    # a Net row is checked against the group that comes closest to it
+    net_expected = amounts[net_rows]
+    group_deltas = np.where(has_head, np.abs(group_sums - net_expected), np.inf)
+    group_cols = group_deltas.argmin(axis=0)
+    net_idxes = np.arange(nnets)
+    net_sums = group_sums[group_cols, net_idxes]
+    net_heads = net_heads[group_cols, net_idxes]
+
+    all_checks = [
+        ("total", closes, opens, amounts[closes], total_sums),
+        ("net", net_rows, net_heads, net_expected, net_sums),
+    ]
+
+    all_mismatches = []
+    for kind, rows, head_rows, expected, actual in all_checks:
+        is_mismatch = np.abs(expected - actual) > RECONCILE_TOL
+        for idx in np.flatnonzero(is_mismatch).tolist():
+            row_idx, head_idx = int(rows[idx]), int(head_rows[idx])
+            path = [sec_header] + get_row_path(section, opens, closes, row_idx)
+            # the pair's own head, or the head of the net group
+            head = get_row_head(section, head_idx) if head_idx >= 0 else None
+            if head is not None and head != path[-1]:
+                path.append(head)
+
+            all_mismatches.append(
+                {
+                    "demand": demand_no,
+                    "section": section_name,
+                    "kind": kind,
+                    "row": section.row_base + row_idx,
+                    "path": path,
+                    "expected": float(expected[idx]),
+                    "actual": float(actual[idx]),
+                    "delta": float(expected[idx] - actual[idx]),
+                }
+            )
+
+    logging.info(
+        f"Reconciled section {section_name}: {len(opens)} totals,"
+        f" {len(net_rows)} nets, {len(all_mismatches)} mismatches"
+    )
+    return all_mismatches
+
+
+def get_reconcile_table(all_mismatches: list[Reconciliation]) -> pd.DataFrame:
+    """One row per mismatch, paths joined by " / " """
+    table = pd.DataFrame(all_mismatches, columns=RECONCILE_COLS)
+    table["path"] = table["path"].map(" / ".join)
+    return table.round({"expected": 2, "actual": 2, "delta": 2})
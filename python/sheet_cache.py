@@ -0,0 +1,155 @@
+import glob
+import hashlib
+import json
+import logging
+import os
+
+from collections import OrderedDict
+
+from parse_utils import PARSER_VERSION, BudgetSheet
+from sheet_reader import SheetData
+
+
+class SheetCache:
+    """
+    On-disk cache of parsed sheets.
+
+    Sheet entries are keyed by the sha256 of a sheet's cells, the parser
+    version, the section filter (if any) and whether heads keep all their
+    amounts, so a sheet is only reparsed when its contents, the parser or
+    the requested output change. Sheets
+    without sections are cached too (as null), so they are not rescanned
+    either. Workbook entries hold every parsed sheet of a workbook and the
+    triage of its sheets, keyed by the hash of the file itself, and let a
+    rerun over an unchanged workbook skip reading it altogether.
+
+    The cache is bounded to max_bytes, least recently used entries are
+    evicted first. Sizes and use order are kept in memory, from one scan of
+    the directory per process, so a put does not rescan it. Entries other
+    processes write count from the next scan (see refresh).
+    """
+
+    def __init__(self, cache_dir: str = "budget_cache", max_bytes: int = 64 << 20):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+        # entry path -> size, least recently used first, see _load_entries
+        self._entries: OrderedDict[str, int] = None
+        self._size = 0
+
+    def __getstate__(self) -> dict:
+        # parallel workers scan the directory themselves
+        state = self.__dict__.copy()
+        state["_entries"] = None
+        return state
+
+    @staticmethod
+    def sections_tag(sections: list[str] = None) -> str:
+        """Key part for a section filter, empty for a full parse"""
+        if sections is None:
+            return ""
+        return "-" + "".join(sorted(sections))
+
+    @staticmethod
+    def measures_tag(measures: bool = False) -> str:
+        return "-measures" if measures else ""
+
+    def sheet_key(
+        self, sheet: SheetData, sections: list[str] = None, measures: bool = False
+    ) -> str:
+        tags = self.sections_tag(sections) + self.measures_tag(measures)
+        return f"sheet-v{PARSER_VERSION}{tags}-{sheet.digest()}"
+
+    def workbook_key(
+        self, xls_path: str, sections: list[str] = None, measures: bool = False
+    ) -> str:
+        with open(xls_path, "rb") as f:
+            file_digest = hashlib.sha256(f.read()).hexdigest()
+        tags = self.sections_tag(sections) + self.measures_tag(measures)
+        return f"workbook-v{PARSER_VERSION}{tags}-{file_digest}"
+
+    def _entry_path(self, key: str) -> str:
+        return f"{self.cache_dir}/{key}.json"
+
+    def get(self, key: str) -> tuple[bool, BudgetSheet]:
+        """Returns (hit, value). A hit may have a None value."""
+        entry_path = self._entry_path(key)
+        try:
+            with open(entry_path) as f:
+                value = json.loads(f.read())
+        except FileNotFoundError:
+            return False, None
+
+        # mtime doubles as last-use time for eviction by other processes
+        os.utime(entry_path)
+        if self._entries is not None and entry_path in self._entries:
+            self._entries.move_to_end(entry_path)
+        logging.debug(f"Cache hit: {key}")
+        return True, value
+
+    def put(self, key: str, value) -> None:
+        entry_path = self._entry_path(key)
+        entry_str = json.dumps(value)
+        # write-then-rename, entries may be shared by parallel workers
+        tmp_path = f"{entry_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(entry_str)
+        os.replace(tmp_path, entry_path)
+
+        self._load_entries()
+        # json.dumps escapes to ASCII, so its length is the file size
+        self._size += len(entry_str) - self._entries.pop(entry_path, 0)
+        self._entries[entry_path] = len(entry_str)
+        if self._size > self.max_bytes:
+            self.evict(keep_path=entry_path)
+
+    def _load_entries(self) -> None:
+        if self._entries is not None:
+            return
+
+        all_entries = []
+        for entry_path in glob.glob(f"{self.cache_dir}/*.json"):
+            try:
+                stat = os.stat(entry_path)
+            except FileNotFoundError:
+                continue
+            all_entries.append((stat.st_mtime, entry_path, stat.st_size))
+
+        all_entries.sort()
+        self._entries = OrderedDict((path, size) for _, path, size in all_entries)
+        self._size = sum(self._entries.values())
+
+    def refresh(self) -> None:
+        """Rescan the directory on next use, after other processes wrote to it"""
+        self._entries = None
+
+    def get_size(self) -> int:
+        all_entries = glob.glob(f"{self.cache_dir}/*.json")
+        return sum(os.path.getsize(e) for e in all_entries)
+
+    def evict(self, keep_path: str = None) -> None:
+        """
+        Remove least recently used entries until the cache fits max_bytes.
+        keep_path (the entry just written) stays, even if it alone does not.
+        """
+        self._load_entries()
+        for entry_path in list(self._entries):
+            if self._size <= self.max_bytes:
+                break
+            if entry_path == keep_path:
+                continue
+
+            logging.debug(f"Evicting cache entry: {entry_path}")
+            try:
+                os.remove(entry_path)
+            except FileNotFoundError:
+                pass
+            self._size -= self._entries.pop(entry_path)
+
+    def purge(self) -> None:
+        all_entries = glob.glob(f"{self.cache_dir}/*.json")
+        logging.info(f"Purging {len(all_entries)} entries from {self.cache_dir}")
+        for entry_path in all_entries:
+            os.remove(entry_path)
+        self._entries = OrderedDict()
+        self._size = 0
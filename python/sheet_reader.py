@@ -0,0 +1,290 @@
+import hashlib
+import json
+import logging
+import numpy as np
+import pandas as pd
+
+from datetime import datetime
+from typing import Any, Iterator
+
+from pandas.io.parsers import TextParser
+
+# the default NA strings of pandas' parsers across versions ("None" from 2.0)
+NA_CANDIDATES = [
+    "", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan",
+    "1.#IND", "1.#QNAN", "<NA>", "N/A", "NA", "NULL", "NaN", "None", "n/a",
+    "nan", "null",
+]
+
+
+def get_na_strings() -> frozenset[str]:
+    """The NA_CANDIDATES the installed TextParser reads as NaN, as to_frame does"""
+    rows = [["col"]] + [[x] for x in NA_CANDIDATES]
+    frame = TextParser(rows, header=0, skip_blank_lines=False).read()
+    return frozenset(x for x, is_na in zip(NA_CANDIDATES, frame["col"].isna()) if is_na)
+
+
+# cells holding these are NaN in to_frame(), so not string cells
+NA_STRINGS = get_na_strings()
+
+
+class SheetData:
+    """
+    One worksheet, read once, as the cell rows pandas would see.
+
+    rows[0] is the header row (what pd.ExcelFile.parse uses for column names),
+    rows[1:] are the data rows, so row i of the arrays is index i of the
+    equivalent DataFrame. Missing cells are "" like in pandas' excel readers.
+    """
+
+    def __init__(self, sheet_idx: int, sheet_name: str, rows: list[list[Any]]):
+        self.sheet_idx = sheet_idx
+        self.sheet_name = sheet_name
+        self.rows = rows
+
+        self._columns = None
+        self._str_cells = None
+        self._num_cells = None
+        self._frame_cols = None
+        self._digest = None
+
+    def __len__(self) -> int:
+        return max(len(self.rows) - 1, 0)
+
+    @property
+    def columns(self) -> list[str]:
+        """Column labels as pd.ExcelFile.parse would name them."""
+        if self._columns is None:
+            if len(self.rows) == 0:
+                self._columns = []
+            else:
+                header = TextParser(self.rows[:1], header=0, skip_blank_lines=False)
+                self._columns = header.read().columns.tolist()
+
+        return self._columns
+
+    @property
+    def str_cells(self) -> np.ndarray:
+        """Object array of the string cells, "" everywhere else."""
+        if self._str_cells is None:
+            self._make_arrays()
+        return self._str_cells
+
+    @property
+    def num_cells(self) -> np.ndarray:
+        """float64 array of the numeric cells, NaN everywhere else."""
+        if self._num_cells is None:
+            self._make_arrays()
+        return self._num_cells
+
+    def _make_arrays(self) -> None:
+        nrows, ncols = len(self), len(self.columns)
+        str_cells = np.full((nrows, ncols), "", dtype=object)
+        num_cells = np.full((nrows, ncols), np.nan, dtype=np.float64)
+
+        for row_idx, row in enumerate(self.rows[1:]):
+            for col_idx, val in enumerate(row):
+                if type(val) == str:
+                    if val not in NA_STRINGS:
+                        str_cells[row_idx, col_idx] = val
+                elif type(val) in (float, int):
+                    num_cells[row_idx, col_idx] = val
+
+        self._str_cells = str_cells
+        self._num_cells = num_cells
+
+    @property
+    def filled_columns(self) -> list[str]:
+        """Labels of the columns with any cell, to_frame().dropna(axis=1, how="all")"""
+        if self._frame_cols is None:
+            self._make_frame_cols()
+        return list(self._frame_cols)
+
+    def _make_frame_cols(self) -> None:
+        # a column reads as float64 when all its strings are numbers, like
+        # TextParser does, else as object with the strings in place
+        frame_cols = {}
+        for col_idx, col in enumerate(self.columns):
+            col_strs = self.str_cells[:, col_idx]
+            col_nums = self.num_cells[:, col_idx]
+            is_str = col_strs != ""
+            if not is_str.any():
+                if not np.isnan(col_nums).all():
+                    frame_cols[col] = col_nums
+                continue
+
+            str_nums = pd.to_numeric(col_strs[is_str], errors="coerce")
+            if np.isnan(str_nums).any():
+                col_vals = col_nums.astype(object)
+                col_vals[is_str] = col_strs[is_str]
+            else:
+                col_vals = col_nums.copy()
+                col_vals[is_str] = str_nums
+            frame_cols[col] = col_vals
+
+        self._frame_cols = frame_cols
+
+    def get_frame(self, row_beg: int, row_end: int) -> pd.DataFrame:
+        """
+        Rows row_beg:row_end of to_frame() over filled_columns, built from
+        str_cells and num_cells instead of parsing the whole sheet.
+        """
+        if self._frame_cols is None:
+            self._make_frame_cols()
+        row_slice = slice(row_beg, row_end)
+        return pd.DataFrame(
+            {col: vals[row_slice] for col, vals in self._frame_cols.items()},
+            index=pd.RangeIndex(len(self))[row_slice],
+        )
+
+    def digest(self) -> str:
+        """sha256 of the cell contents, independent of sheet name and position."""
+        if self._digest is None:
+            rows_str = json.dumps(self.rows, default=str)
+            self._digest = hashlib.sha256(rows_str.encode("utf-8")).hexdigest()
+        return self._digest
+
+    def to_frame(self) -> pd.DataFrame:
+        """Same frame as pd.ExcelFile.parse(sheet_idx, convert_float=False)."""
+        if len(self.rows) == 0:
+            return pd.DataFrame()
+
+        parser = TextParser(self.rows, header=0, skip_blank_lines=False)
+        return parser.read()
+
+
+class WorkbookReader:
+    """
+    Opens an allsbe workbook once and streams its sheets as SheetData.
+
+    .xlsx files are read with openpyxl in read-only mode, the legacy .xls
+    with xlrd. Cell conversion follows pandas' excel readers, so
+    SheetData.to_frame() matches pd.ExcelFile.parse for either format.
+    """
+
+    def __init__(self, xls_path: str, convert_float: bool = False) -> None:
+        self.xls_path = xls_path
+        self.convert_float = convert_float
+        self.is_legacy = xls_path.lower().endswith(".xls")
+
+        if self.is_legacy:
+            import xlrd
+
+            self.book = xlrd.open_workbook(xls_path, on_demand=True)
+            self.sheet_names = self.book.sheet_names()
+        else:
+            import openpyxl
+
+            self.book = openpyxl.load_workbook(
+                xls_path, read_only=True, data_only=True, keep_links=False
+            )
+            self.sheet_names = self.book.sheetnames
+
+    def __enter__(self) -> "WorkbookReader":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def close(self) -> None:
+        if self.is_legacy:
+            self.book.release_resources()
+        else:
+            self.book.close()
+
+    def sheet_rows(self, sheet_idx: int) -> int:
+        """Row count from the sheet's stored dimensions, 0 if unknown."""
+        if self.is_legacy:
+            return self.book.sheet_by_index(sheet_idx).nrows
+
+        return self.book.worksheets[sheet_idx].max_row or 0
+
+    def read_sheet(self, sheet_idx: int, max_rows: int = None) -> SheetData:
+        """Read a sheet, or only its first max_rows rows (header row included)"""
+        if self.is_legacy:
+            rows = self._read_rows_xls(sheet_idx, max_rows)
+        else:
+            rows = self._trim_rows(self._read_rows_xlsx(sheet_idx, max_rows))
+
+        return SheetData(sheet_idx, self.sheet_names[sheet_idx], rows)
+
+    def iter_sheets(
+        self, sheet_idxes: list[int] = None, max_rows: int = None
+    ) -> Iterator[SheetData]:
+        if sheet_idxes is None:
+            sheet_idxes = range(len(self.sheet_names))
+
+        for sheet_idx in sheet_idxes:
+            logging.debug(f"Reading sheet {sheet_idx}: {self.sheet_names[sheet_idx]}")
+            yield self.read_sheet(sheet_idx, max_rows)
+
+    def _convert_num(self, val: float) -> Any:
+        if self.convert_float and int(val) == val:
+            return int(val)
+        return float(val)
+
+    def _read_rows_xlsx(self, sheet_idx: int, max_rows: int = None) -> list[list[Any]]:
+        from openpyxl.cell.cell import ERROR_CODES
+
+        sheet = self.book.worksheets[sheet_idx]
+        sheet.reset_dimensions()
+
+        rows = []
+        for row in sheet.iter_rows(max_row=max_rows, values_only=True):
+            row_conv = []
+            for val in row:
+                if val is None:
+                    val = ""
+                elif type(val) in (int, float):
+                    val = self._convert_num(val)
+                elif type(val) == str and val in ERROR_CODES:
+                    val = np.nan
+                row_conv.append(val)
+            rows.append(row_conv)
+
+        return rows
+
+    def _read_rows_xls(self, sheet_idx: int, max_rows: int = None) -> list[list[Any]]:
+        import xlrd
+
+        sheet = self.book.sheet_by_index(sheet_idx)
+        epoch = self.book.datemode
+        nrows = sheet.nrows if max_rows is None else min(sheet.nrows, max_rows)
+
+        rows = []
+        for row_idx in range(nrows):
+            row_conv = []
+            for cell in sheet.row(row_idx):
+                val = cell.value
+                if cell.ctype == xlrd.XL_CELL_DATE:
+                    val = datetime(*xlrd.xldate_as_tuple(val, epoch))
+                elif cell.ctype == xlrd.XL_CELL_BOOLEAN:
+                    val = bool(val)
+                elif cell.ctype == xlrd.XL_CELL_ERROR:
+                    val = np.nan
+                elif cell.ctype == xlrd.XL_CELL_NUMBER:
+                    val = self._convert_num(val)
+                row_conv.append(val)
+            rows.append(row_conv)
+
+        self.book.unload_sheet(sheet_idx)
+        return rows
+
+    @staticmethod
+    def _trim_rows(rows: list[list[Any]]) -> list[list[Any]]:
+        """Trim trailing empty cells and rows, pad to the widest row."""
+        last_row_with_data = -1
+        for row_idx, row in enumerate(rows):
+            while row and row[-1] == "":
+                row.pop()
+            if row:
+                last_row_with_data = row_idx
+
+        rows = rows[: last_row_with_data + 1]
+
+        if len(rows) > 0:
+            max_width = max(len(row) for row in rows)
+            for row in rows:
+                row.extend([""] * (max_width - len(row)))
+
+        return rows
@@ -1,6 +1,50 @@
+import glob
+import json
+import logging
+import os
+import tempfile
 import unittest
-from parse_utils import normalize_head
+from unittest import mock
+import numpy as np
+import pandas as pd
+from parse_utils import (
+    normalize_head,
+    get_meta_structure,
+    get_sheet_strs,
+    classify_sheet_strs,
+    triage_sheet,
+    parse_section,
+    prepare_section,
+    get_section_input,
+    get_net_rows,
+    find_net_row,
+    get_cell_types,
+    get_slice_columns,
+    HeadTable,
+    LayoutTemplates,
+    HEAD_CAPS,
+    HEAD_NET,
+    HEAD_TOTAL,
+    HEAD_VALID,
+    CELL_ALPHA,
+    CELL_EMPTY,
+    CELL_NUM,
+    CELL_OTHER,
+)
+from parse_trace import TRACE, read_trace
+from reconcile import get_segment_sums, reconcile_section
+from parse_arrays import (
+    parse_section_arrays,
+    run_parse_stack,
+    HeadIndex,
+    SectionArrays,
+)
+import parse_demands
+from budget_store import BudgetStore
 from budget_tree import BudgetNode, BudgetTreeUtils
+from sheet_cache import SheetCache
+from sheet_reader import NA_CANDIDATES, NA_STRINGS, SheetData, WorkbookReader
+from tree_store import TreeBuilder, TreeStore
 
 
 class TestNormalize(unittest.TestCase):
@@ -52,6 +96,738 @@ class TestBudgetTree(unittest.TestCase):
         #  print(nodes)
         #  print(edges)
 
+    def test_child_order(self):
+        tree = BudgetNode(name="Root Node", total_init=0)
+        tree.add_child("Small", 1)
+        tree.add_child("Large", 30)
+        tree.add_child("Medium", 20)
+        self.assertEqual([x.key for x in tree.children], ["large", "medium", "small"])
+
+        # ties of a later key keep the order of the earlier one
+        tree.add_child_ls(["Mid", "X"], 10)
+        tree.add_child_ls(["Top", "X"], 40)
+        tree.add_child("Zero", 0)
+        keys = [x.key for x in tree.children]
+        self.assertEqual(keys, ["large", "medium", "small", "top", "mid", "zero"])
+        self.assertIs(tree.get_child("Top"), tree.children[3])
+        self.assertEqual(tree.get_total(), 101)
+
+        # a tie of one key keeps the order that key sorted before it
+        tree = BudgetNode(name="Root Node", total_init=0)
+        tree.add_child_ls(["X", "a", "l1"], 5)
+        tree.add_child_ls(["X", "b", "l2"], 10)
+        tree.add_child_ls(["X", "a", "l3"], 5)
+        # inserts only append, the children are sorted when read
+        self.assertEqual([x.key for x in tree.get_child("X")._children], ["a", "b"])
+        self.assertEqual([x.key for x in tree.get_child("X").children], ["b", "a"])
+
+    def test_finalize(self):
+        tree = BudgetNode(name="Root Node", total_init=0)
+        tree.add_child_ls(["A", "X"], 0.1)
+        tree.add_child_ls(["A", "Y", "P"], 0.2)
+        tree.add_child_ls(["A", "Y", "Q"], -5)
+        tree.add_child_ls(["B"], 7)
+        tree.add_child_ls(["B", "Z"], 3)
+        tree.add_child_ls(["A", "X"], 0.3)
+        tree.finalize()
+
+        node_a = tree.get_child("A")
+        self.assertEqual(tree.total_children, tree.get_total_children_recursive())
+        self.assertEqual(node_a.total_children, node_a.get_total_children_recursive())
+        self.assertEqual(node_a.total_children, 0.1 + 0.2)
+        # a leaf's parent keeps the sum of its children, negatives included
+        self.assertEqual(node_a.get_child("Y").total_children, 0.2 - 5)
+        self.assertEqual(tree.get_child("B").total_children, 3)
+
+    def test_path_index(self):
+        tree = BudgetNode(name="Root Node", total_init=0)
+        tree.add_child("Ministry of X", 10)
+        path_index = tree.make_path_index()
+        tree.add_child_ls(["Ministry of X", "Dept of Y", "Scheme"], 4)
+
+        graft = BudgetNode(name="Dept of Z", total_init=0)
+        graft.add_child("Other Scheme", 2)
+        tree.get_child("Ministry of X").add_child_node(graft)
+
+        self.assertEqual(len(path_index), 6)
+        node = path_index.find(["ministry of x", " Dept of Z", "Other  Scheme"])
+        self.assertEqual(node.name, "Other Scheme")
+        self.assertIsNone(path_index.find(["Ministry of X", "Dept of W"]))
+        dept_node = path_index.get(("ministryofx", "deptofy"))
+        self.assertIs(tree.get_child_ls(["Ministry of X", "Dept of Y"]), dept_node)
+        self.assertEqual(dept_node.get_child_ls(["Scheme"]).name, "Scheme")
+
+        all_paths = [path for path, _ in path_index.iter_prefix(("ministryofx",))]
+        self.assertEqual(all_paths[0], ("ministryofx",))
+        self.assertEqual(len(all_paths), 5)
+        self.assertIn(("ministryofx", "deptofz", "otherscheme"), all_paths)
+
+    def test_tree_store(self):
+        tree = BudgetNode(name="Root Node", total_init=0)
+        tree.add_child_ls(["A", "X"], 2.5)
+        tree.add_child_ls(["A", "Y", "P"], 3.5)
+        tree.add_child_ls(["B", "Y"], 4.5)
+        tree.finalize()
+
+        store = TreeStore.from_node(tree)
+        view = store.root
+        self.assertEqual(len(store), 7)
+        self.assertEqual(store.depths.tolist(), [0, 1, 1, 2, 2, 2, 3])
+        self.assertEqual(store.depth_offsets.tolist(), [0, 1, 3, 6, 7])
+        self.assertEqual(store.get_leaf_mask().sum(), 3)
+
+        self.assertEqual(str(view), str(tree))
+        self.assertEqual(view.get_child_ls(["A", "Y"]).name, "Y")
+        self.assertEqual(view.get_child_ls(["A", "Y"]).parent.name, "A")
+        self.assertIsNone(view.get_child("C"))
+        self.assertEqual(store.get_totals()[0], tree.get_total())
+        pd.testing.assert_frame_equal(view.serialize_rows(), tree.serialize_rows())
+        pd.testing.assert_frame_equal(
+            BudgetTreeUtils.serialize(view), BudgetTreeUtils.serialize(tree)
+        )
+
+    def test_tree_store_adjust(self):
+        tree = BudgetNode(name="Root Node", total_init=0)
+        tree.add_child("A", 5)
+        tree.add_child("B", 1)
+        tree.get_child("A").add_child("X", 4)
+        tree.get_child("A").add_child("Y", 3)
+        tree.get_child("B").add_child("Z", 0.5)
+
+        store = TreeStore.from_node(tree)
+        table = store.adjust_totals_with_children()
+        tree.adjust_totals_with_children()
+        self.assertEqual(str(store.root), str(tree))
+        self.assertEqual(table["path"].tolist(), ["Root Node / A"])
+        self.assertEqual(table["total_init"].tolist(), [5])
+        self.assertEqual(store.get_node(1).total_init, 7)
+        self.assertEqual(len(store.adjust_totals_with_children()), 0)
+
+        # int amounts stay ints where no float is below, as in BudgetNode
+        for name in ["A", "B"]:
+            view, node = store.root.get_child(name), tree.get_child(name)
+            pd.testing.assert_frame_equal(view.serialize_rows(), node.serialize_rows())
+            pd.testing.assert_frame_equal(
+                BudgetTreeUtils.serialize(view), BudgetTreeUtils.serialize(node)
+            )
+        self.assertEqual(BudgetTreeUtils.serialize(view)["amount"].dtype, np.float64)
+        rows = store.root.get_child("A").serialize_rows()
+        self.assertEqual(rows["amounts_inrcr"].dtype, np.int64)
+
+    def test_tree_from_heads(self):
+        all_paths = [
+            ["A", "X"],
+            ["B"],
+            ["A", "Y", "P"],
+            [" a ", "Z"],
+            ["C", "Q"],
+            ["B", "W"],
+            ["A", "X"],
+            ["A", "Y", "R"],
+        ]
+        amounts = [0.5, 7.25, 0.1, 0.5, 0.0, 3.5, 9.0, 0.2]
+
+        tree = BudgetNode(name="Root Node", total_init=0)
+        for path, amount in zip(all_paths, amounts):
+            tree.add_child_ls(path, amount)
+        tree.finalize()
+
+        view = TreeStore.from_heads("Root Node", all_paths, amounts).root
+        self.assertEqual(str(view), str(tree))
+        self.assertEqual(view.get_child("A").name, "A")
+        node = view.get_child("A").to_node()
+        self.assertEqual(node.total_children, tree.get_child("A").total_children)
+        self.assertEqual([x.key for x in node.children], ["x", "z", "y"])
+
+        # ties in the order that sorting on every insert gave
+        all_paths = [["X", "a", "l1"], ["X", "b", "l2"], ["X", "a", "l3"], ["X", "c"]]
+        amounts = [5, 10, 5, 10]
+        tree = BudgetNode(name="Root Node", total_init=0)
+        for path, amount in zip(all_paths, amounts):
+            tree.add_child_ls(path, amount)
+        tree.finalize()
+
+        view = TreeStore.from_heads("Root Node", all_paths, amounts).root
+        self.assertEqual(str(view), str(tree))
+        keys = [x.key for x in view.get_child("X").children]
+        self.assertEqual(keys, ["c", "b", "a"])
+
+        # and ties of a later key in the order of the earlier one
+        all_paths = [["Small"], ["Large"], ["Mid", "X"], ["Top", "X"], ["Zero"]]
+        amounts = [1, 30, 10, 40, 0]
+        builder = TreeBuilder("Root Node")
+        for path, amount in zip(all_paths, amounts):
+            builder.add_head(path, amount)
+        # add_head only appends, get_store sorts
+        self.assertEqual(builder.all_children[0], [1, 2, 3, 5, 7])
+        view = builder.get_store().root
+        keys = [x.key for x in view.children]
+        self.assertEqual(keys, ["large", "small", "top", "mid", "zero"])
+
+    def test_tree_store_measures(self):
+        all_paths = [["A", "X"], ["A", "Y"], ["B"], ["A", "Y", "P"]]
+        amounts = [4.0, 2.0, 1.5, 1.0]
+        # be_cur_total is the last of the 12, the others scale it
+        all_measures = [[x * (i + 1) for i in range(11)] + [x] for x in amounts]
+
+        view = TreeStore.from_heads("Root Node", all_paths, amounts, all_measures).root
+        plain = TreeStore.from_heads("Root Node", all_paths, amounts).root
+        self.assertEqual(view.store.get_measures()[0].tolist()[:2], [7.5, 15.0])
+        self.assertEqual(view.store.measures_init[1].tolist(), [0.0] * 12)
+
+        rows, plain_rows = view.serialize_rows(), plain.serialize_rows()
+        pd.testing.assert_frame_equal(rows[plain_rows.columns], plain_rows)
+        self.assertEqual(rows["be_cur_total"].tolist(), rows["amounts_inrcr"].tolist())
+
+        edges = BudgetTreeUtils.serialize(view)
+        pd.testing.assert_frame_equal(edges.iloc[:, :7], plain.serialize_edges())
+        node = plain.to_node()
+        pd.testing.assert_frame_equal(plain.serialize_rows(), node.serialize_rows())
+        pd.testing.assert_frame_equal(
+            plain.serialize_edges(), BudgetTreeUtils.serialize(node)
+        )
+        self.assertEqual(edges["be_cur_total"].tolist(), edges["amount"].tolist())
+        self.assertEqual(edges["actual_prev2_capital"].tolist()[:2], [15.0, 12.0])
+
+        # every measure is summed on its own, a leaf without be_cur_total too
+        all_measures = [[100.0] + [0.0] * 11, [50.0] + [0.0] * 10 + [7.0]]
+        store = TreeStore.from_heads(
+            "Root Node", [["X", "a"], ["X", "b"]], [0.0, 7.0], all_measures
+        )
+        self.assertEqual(store.get_measures()[:2, 0].tolist(), [150.0, 150.0])
+        self.assertEqual(store.get_measures()[0, -1], 7.0)
+        rows = store.serialize_rows()
+        self.assertEqual(rows["actual_prev2_revenue"].sum(), 150.0)
+        store.adjust_totals_with_children()
+        self.assertEqual(store.get_measures()[1].tolist(), [150.0] + [0.0] * 10 + [7.0])
+
+        # a negative leaf counts as the scalar does, under a mixed-sign parent
+        all_paths = [["A", "X"], ["A", "Less Receipts"], ["B", "Y", "P"], ["A"]]
+        amounts = [10.0, -4.0, 3.0, 2.0]
+        all_measures = [[x] * 12 for x in amounts]
+        view = TreeStore.from_heads("Root Node", all_paths, amounts, all_measures).root
+        # the leaves' parent sums them all, the nodes above only rec totals
+        self.assertEqual(view.get_child("A").measures_children[-1], 6.0)
+        self.assertEqual(view.store.get_measures()[0, -1], 13.0)
+        root = BudgetNode("Root", 0)
+        root.add_child_node(view)
+        for store in [TreeStore.from_node(root), view.store]:
+            for _ in range(2):
+                edges = store.serialize_edges()
+                be_cur_total = edges["be_cur_total"].tolist()
+                self.assertEqual(be_cur_total, edges["amount"].tolist())
+                store.adjust_totals_with_children()
+
+
+class TestSheetReader(unittest.TestCase):
+    def make_sheet(self) -> SheetData:
+        rows = [
+            ["", "", ""],
+            ["Demand No. 1", "", ""],
+            ["", "Gross", 12.5],
+            ["NA", "", 3],
+        ]
+        return SheetData(1, "sbe1", rows)
+
+    def test_arrays(self):
+        sheet = self.make_sheet()
+        self.assertEqual(sheet.columns, ["Unnamed: 0", "Unnamed: 1", "Unnamed: 2"])
+        self.assertEqual(sheet.str_cells.shape, (3, 3))
+        self.assertEqual(sheet.str_cells[1, 1], "Gross")
+        # pandas NA strings are not string cells
+        self.assertEqual(sheet.str_cells[2, 0], "")
+        self.assertEqual(sheet.num_cells[2, 2], 3.0)
+
+    def test_na_strings(self):
+        # a string cell exactly where to_frame() has no NaN
+        all_strs = NA_CANDIDATES + ["none", "-", "n.a.", " NA", "Gross"]
+        sheet = SheetData(1, "sbe1", [["col"]] + [[x] for x in all_strs])
+        is_na = sheet.to_frame()["col"].isna().tolist()
+        self.assertEqual([x == "" for x in sheet.str_cells[:, 0]], is_na)
+        self.assertIn("NA", NA_STRINGS)
+
+    def test_get_frame(self):
+        rows = [
+            ["", "", "", "", ""],
+            ["A. Revenue", "", "", 1, ""],
+            ["1. ", "", "Gross", 2.5, ""],
+            [2, "", "", "", ""],
+        ]
+        sheet = SheetData(1, "sbe1", rows)
+        frame = sheet.to_frame().dropna(axis=1, how="all")
+        self.assertEqual(sheet.filled_columns, frame.columns.tolist())
+        for beg, end in [(0, 3), (1, 2), (2, 2)]:
+            expected = frame.iloc[beg:end]
+            pd.testing.assert_frame_equal(sheet.get_frame(beg, end), expected)
+
+        # numeric strings read as numbers in numeric columns only
+        self.assertEqual(sheet.get_frame(1, 3)["Unnamed: 0"].tolist(), ["1. ", 2.0])
+
+    def test_sheet_strs_match_frame(self):
+        sheet = self.make_sheet()
+        self.assertEqual(get_sheet_strs(sheet), get_sheet_strs(sheet.to_frame()))
+        self.assertIsNone(get_meta_structure(SheetData(2, "empty", [["x"], ["y"]])))
+
+    def test_classify_sheet_strs(self):
+        sheet_strs = [
+            (3, "Ministry of X\nDemand No. 1\nDept of Y"),
+            (5, "Actuals 2021-2022Budget Estimates 2022-2023"),
+            (6, "RevenueCapitalTotalRevenue"),
+            (11, "A. The Budget allocations"),
+            (40, "A. Repeated"),
+            (60, "B. Investment in Public Enterprises"),
+        ]
+        markers, sections = classify_sheet_strs(sheet_strs)
+        self.assertEqual(markers, {"demand": 0, "budget": 1, "revenue": 2})
+        self.assertEqual(sections, {"A": 3, "B": 5})
+
+    def test_triage_sheet(self):
+        triage = triage_sheet(self.make_sheet())
+        self.assertTrue(triage["is_demand"])
+        self.assertEqual(triage["demand_no"], 1)
+        self.assertEqual(triage["header"], ["Demand No. 1"])
+
+        triage = triage_sheet(SheetData(0, "Sheet1", [[""], ["Summary"]]))
+        self.assertFalse(triage["is_demand"])
+        self.assertIsNone(triage["demand_no"])
+
+    def test_demand_sheet_idxes(self):
+        xls_reader = TestIncrementalIngest.Reader(
+            [SheetData(0, "Sheet1", [[""], ["Summary"]]), self.make_sheet()]
+        )
+        xls_reader.sheet_names = ["Sheet1", "sbe1"]
+        with tempfile.TemporaryDirectory() as out_dir:
+            cwd = os.getcwd()
+            os.chdir(out_dir)
+            try:
+                sheet_idxes = parse_demands.get_demand_sheet_idxes(xls_reader)
+                # the triage manifest only when asked for
+                self.assertEqual(os.listdir(out_dir), [])
+                parse_demands.get_demand_sheet_idxes(xls_reader, "triage.jsonl")
+                with open("triage.jsonl") as f:
+                    triage = json.loads(f.readline())
+            finally:
+                os.chdir(cwd)
+
+        self.assertEqual(sheet_idxes, [1])
+        self.assertEqual(triage["demand_no"], 1)
+
+
+class TestSheetCache(unittest.TestCase):
+    def test_get_put(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = SheetCache(cache_dir)
+            sheet = SheetData(1, "sbe1", [[""], ["Demand No. 1"]])
+            key = cache.sheet_key(sheet)
+
+            self.assertEqual(cache.get(key), (False, None))
+            cache.put(key, None)
+            self.assertEqual(cache.get(key), (True, None))
+
+            # same cells under another name share the entry
+            sheet_copy = SheetData(7, "sbe7", [[""], ["Demand No. 1"]])
+            self.assertEqual(cache.sheet_key(sheet_copy), key)
+
+            # a section filter gets its own entry
+            key_a = cache.sheet_key(sheet, ["A"])
+            self.assertNotEqual(key_a, key)
+            key_ab = cache.sheet_key(sheet, ["A", "B"])
+            self.assertEqual(cache.sheet_key(sheet, ["B", "A"]), key_ab)
+            self.assertEqual(cache.get(key_a), (False, None))
+
+            cache.purge()
+            self.assertEqual(cache.get(key), (False, None))
+
+    def test_evict(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = SheetCache(cache_dir, max_bytes=1000)
+            with mock.patch("sheet_cache.glob.glob", wraps=glob.glob) as glob_fn:
+                for idx in range(10):
+                    cache.put(f"entry-{idx}", {"amount_heads": ["x" * 200]})
+                    # four entries fit, the one used last is evicted last
+                    if idx == 3:
+                        cache.get("entry-0")
+                    if idx == 4:
+                        self.assertFalse(cache.get("entry-1")[0])
+                        self.assertTrue(cache.get("entry-0")[0])
+            # one scan of the directory for all puts
+            self.assertEqual(glob_fn.call_count, 1)
+            self.assertLessEqual(cache.get_size(), 1000)
+            self.assertTrue(cache.get("entry-9")[0])
+
+            # an entry over max_bytes is kept when written, the rest goes
+            cache.put("large", {"amount_heads": ["x" * 2000]})
+            self.assertTrue(cache.get("large")[0])
+            self.assertFalse(cache.get("entry-9")[0])
+            cache.put("entry-10", None)
+            self.assertFalse(cache.get("large")[0])
+
+            # another process' view of the same directory
+            other_cache = SheetCache(cache_dir, max_bytes=1000)
+            self.assertEqual(other_cache.get("entry-10"), (True, None))
+            other_cache.put("entry-11", None)
+            self.assertTrue(cache.get("entry-11")[0])
+
+
+class TestBudgetStore(unittest.TestCase):
+    def test_roundtrip(self):
+        sheet = {
+            "sheet_name": "sbe1",
+            "header": ["Ministry of Defence", "Demand No. 19", "Dept of", " Defence"],
+            "amount_heads": [
+                {"head": ["A. X", "Secretariat"], "amount": 10.5},
+                {"head": ["A. X", "Secretariat", "Misc"], "amount": 2},
+                {"head": ["B. Y"], "amount": -1.0},
+            ],
+        }
+
+        with tempfile.TemporaryDirectory() as store_dir:
+            store_path = f"{store_dir}/budget.bst"
+            BudgetStore.write([sheet, None], store_path)
+            store = BudgetStore(store_path)
+
+            self.assertEqual(store.demand_ids, [19])
+            self.assertEqual(
+                store.get_header(19),
+                ["Ministry of Defence", "Demand No. 19", "Dept of Defence"],
+            )
+            self.assertEqual(store.get_heads(19), sheet["amount_heads"])
+            self.assertEqual(store.get_sheet(19)["sheet_name"], "sbe1")
+
+    def test_roundtrip_measures(self):
+        heads = [
+            {"head": ["A. X"], "amount": 3.0, "amounts": [0.0] * 11 + [3.0]},
+            {"head": ["B. Y"], "amount": -1.0, "amounts": [2.0] * 11 + [-1.0]},
+        ]
+        sheet = {"sheet_name": "sbe1", "header": ["M", "Demand No. 2", "D"]}
+        sheet["amount_heads"] = heads
+
+        with tempfile.TemporaryDirectory() as store_dir:
+            store_path = f"{store_dir}/budget.bst"
+            BudgetStore.write([sheet], store_path)
+            store = BudgetStore(store_path)
+            self.assertEqual(store.get_heads(2), heads)
+
+
+class TestIncrementalIngest(unittest.TestCase):
+    class Reader:
+        def __init__(self, all_sheets: list[SheetData]) -> None:
+            self.sheets = {sheet.sheet_idx: sheet for sheet in all_sheets}
+
+        def iter_sheets(self, sheet_idxes: list[int], max_rows: int = None):
+            for sidx in sheet_idxes:
+                yield self.sheets[sidx]
+
+    @staticmethod
+    def parse_sheet(sheet_name, sheet, *args):
+        # demand number and amount from the cells, outputs saved as usual
+        demand_no, amount = sheet.rows[0]
+        sheet_struct = {
+            "header": ["Ministry of X", f"Demand No. {demand_no}", "Dept of Y"],
+            "amount_heads": [{"head": ["A. Z"], "amount": amount}],
+        }
+        parse_demands.save_parsed_sheet(sheet_struct, "budget_parsed")
+        return sheet_struct
+
+    def ingest(self, all_sheets: list[SheetData], **kwargs) -> list[int]:
+        """Demand numbers of the sheets parsed again"""
+        with mock.patch.object(
+            parse_demands, "parse_sheet_inner", side_effect=self.parse_sheet
+        ) as parse_fn:
+            parse_demands.parse_secondary_sheets_incremental(
+                self.Reader(all_sheets),
+                [sheet.sheet_idx for sheet in all_sheets],
+                **kwargs,
+            )
+        return [call.args[1].rows[0][0] for call in parse_fn.call_args_list]
+
+    def setUp(self) -> None:
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(tmp_dir.name)
+
+    def test_incremental(self):
+        all_sheets = [SheetData(i, f"sbe{i}", [[i, 1.0 * i]]) for i in [1, 2, 3]]
+        self.assertEqual(self.ingest(all_sheets), [1, 2, 3])
+        # unchanged, and reordered and renamed sheets are not reparsed
+        self.assertEqual(self.ingest(all_sheets), [])
+        moved = [SheetData(9 - x.sheet_idx, "x", x.rows) for x in all_sheets]
+        self.assertEqual(self.ingest(moved[::-1]), [])
+
+        all_sheets[1] = SheetData(2, "sbe2", [[2, 20.0]])
+        self.assertEqual(self.ingest(all_sheets), [2])
+        with open("budget_parsed/dno_2_mox_doy.json") as f:
+            self.assertEqual(json.loads(f.read())["amount_heads"][0]["amount"], 20.0)
+
+        self.assertEqual(self.ingest(all_sheets[:2]), [])
+        self.assertFalse(os.path.exists("budget_parsed/dno_3_mox_doy.json"))
+        with open(f"budget_parsed/{parse_demands.INGEST_REPORT}") as f:
+            self.assertIn("Removed demands: [3]", f.read())
+
+    def test_incremental_options(self):
+        all_sheets = [SheetData(i, f"sbe{i}", [[i, 1.0 * i]]) for i in [1, 2]]
+        self.assertEqual(self.ingest(all_sheets), [1, 2])
+        self.assertEqual(self.ingest(all_sheets, sections=["A"]), [1, 2])
+        self.assertEqual(self.ingest(all_sheets, sections=["A"]), [])
+        changed = self.ingest(all_sheets, engine="array", sections=["A"])
+        self.assertEqual(changed, [1, 2])
+        with mock.patch.object(parse_demands, "PARSER_VERSION", -1):
+            self.assertEqual(self.ingest(all_sheets, engine="array"), [1, 2])
+        self.assertEqual(self.ingest(all_sheets, engine="array"), [1, 2])
+        self.assertEqual(self.ingest(all_sheets, engine="array"), [])
+
+    def test_workbook_cache_triage(self):
+        os.makedirs("data/budget_doc")
+        with open("data/budget_doc/allsbe.xlsx", "wb") as f:
+            f.write(b"allsbe")
+        os.makedirs("python")
+        os.chdir("python")
+
+        summary = SheetData(0, "Sheet1", [[""], ["Summary"]])
+        xls_reader = self.Reader([summary, TestSheetReader.make_sheet(None)])
+        xls_reader.sheet_names = ["Sheet1", "sbe1"]
+        reader_ctx = mock.MagicMock(**{"__enter__.return_value": xls_reader})
+        sheet_cache = SheetCache("budget_cache")
+
+        all_triage = []
+        for _ in range(2):
+            with mock.patch.object(
+                parse_demands, "WorkbookReader", return_value=reader_ctx
+            ) as reader_fn, mock.patch.object(
+                parse_demands, "parse_sheet_inner", return_value=None
+            ):
+                parse_demands.parse_secondary_sheets(
+                    sheet_cache=sheet_cache, triage_path="triage.jsonl"
+                )
+            with open("triage.jsonl") as f:
+                all_triage.append(f.read())
+            os.remove("triage.jsonl")
+
+        # the cached rerun does not open the workbook, but still writes triage
+        self.assertEqual(reader_fn.call_count, 0)
+        self.assertEqual(all_triage[1], all_triage[0])
+        self.assertEqual(len(all_triage[0].splitlines()), 1)
+
+
+def parse_sheet_logged(sheet_name, sheet, *args):
+    # module level, so forked pool workers run it too
+    logging.info(f"Parsed {sheet_name}")
+    return {"sheet_name": sheet_name, "rows": sheet.rows, "options": list(args)}
+
+
+class TestParallelParse(unittest.TestCase):
+    def test_parallel_matches_serial(self):
+        import openpyxl
+
+        with tempfile.TemporaryDirectory() as xls_dir:
+            xls_path = f"{xls_dir}/book.xlsx"
+            book = openpyxl.Workbook()
+            book.remove(book.active)
+            # later sheets are larger, so workers take them first
+            for idx in range(6):
+                sheet = book.create_sheet(f"sbe{idx}")
+                for row_idx in range(1 + 3 * idx):
+                    sheet.append([f"Demand No. {idx}", row_idx])
+            book.save(xls_path)
+
+            sheet_idxes = [0, 2, 3, 4, 5]
+            with mock.patch.object(
+                parse_demands, "parse_sheet_inner", parse_sheet_logged
+            ), WorkbookReader(xls_path) as xls_reader:
+                options = [None, "array", ["A"], True]
+                serial = [
+                    parse_sheet_logged(sheet.sheet_name, sheet, *options)
+                    for sheet in xls_reader.iter_sheets(sheet_idxes)
+                ]
+                with self.assertLogs(level=logging.INFO) as logs:
+                    parallel = parse_demands.parse_secondary_sheets_parallel(
+                        xls_reader, sheet_idxes, 3, *options
+                    )
+
+        self.assertEqual(list(parallel), sheet_idxes)
+        self.assertEqual(list(parallel.values()), serial)
+
+        # every sheet's logs replayed in sheet order
+        all_parsed = [x for x in logs.output if "Parsed " in x]
+        self.assertEqual(all_parsed, [f"INFO:root:Parsed sbe{x}" for x in sheet_idxes])
+
+
+class TestParseEngines(unittest.TestCase):
+    def make_sheet(self) -> pd.DataFrame:
+        nan = np.nan
+        # name columns, net column, be_cur_total (repeated for all 12 amounts)
+        rows = [
+            ["A. Schemes", nan, nan, nan, nan],
+            ["CENTRAL SECTOR", nan, nan, nan, nan],
+            [nan, "Scheme One", nan, nan, 10.0],
+            [nan, "Scheme Two", nan, nan, nan],
+            [nan, nan, "Sub a", nan, 5.0],
+            [nan, nan, "Sub b", nan, 6.0],
+            ["Total - CENTRAL SECTOR", nan, nan, nan, 21.0],
+            ["Other", nan, nan, nan, 3.0],
+            ["Receipts head", nan, nan, nan, nan],
+            [nan, "Gross", nan, nan, 10.0],
+            [nan, "Deduct Recoveries", nan, nan, -4.0],
+            [nan, nan, nan, "Net", 6.0],
+        ]
+        rows = [r[:4] + [r[4]] * 12 for r in rows]
+        return pd.DataFrame(rows, columns=[f"Unnamed: {i}" for i in range(16)])
+
+    def test_engines_match(self):
+        sheet = self.make_sheet()
+        section = {"name": "A", "start": 0, "end": len(sheet)}
+
+        frame_sheet = {"amount_heads": []}
+        parse_section(sheet, section, frame_sheet)
+        array_sheet = {"amount_heads": []}
+        parse_section_arrays(sheet, section, array_sheet)
+
+        self.assertEqual(len(frame_sheet["amount_heads"]), 4)
+        self.assertEqual(frame_sheet["amount_heads"], array_sheet["amount_heads"])
+        self.assertNotIn("amounts", frame_sheet["amount_heads"][0])
+
+        # heads keep every amount column only when asked to
+        frame_sheet = {"amount_heads": [], "measures": True}
+        parse_section(sheet, section, frame_sheet)
+        array_sheet = {"amount_heads": [], "measures": True}
+        parse_section_arrays(sheet, section, array_sheet)
+        self.assertEqual(frame_sheet["amount_heads"], array_sheet["amount_heads"])
+        for head in frame_sheet["amount_heads"]:
+            self.assertEqual(head["amounts"], [head["amount"]] * 12)
+
+    def test_trace_roundtrip(self):
+        sheet = self.make_sheet()
+        section = {"name": "A", "start": 0, "end": len(sheet)}
+
+        all_events = []
+        for parse_fn in [parse_section, parse_section_arrays]:
+            TRACE.start()
+            parse_fn(sheet, section, {"amount_heads": []})
+            TRACE.stop()
+
+            with tempfile.TemporaryDirectory() as trace_dir:
+                TRACE.dump(f"{trace_dir}/trace.jsonl")
+                records = read_trace(f"{trace_dir}/trace.jsonl")
+            self.assertEqual(records, TRACE.get_records())
+            all_events.append(sorted(json.dumps(r) for r in records))
+
+        # the stack engine visits ranges in another order, same events though
+        self.assertEqual(all_events[0], all_events[1])
+        self.assertTrue(any('"head_added"' in e for e in all_events[0]))
+
+    def test_net_rows(self):
+        sec_slice = pd.DataFrame(
+            {"net": [np.nan, " NET", "Gross", "net", 1.0]}, index=range(10, 15)
+        )
+        net_rows = get_net_rows(sec_slice)
+        self.assertEqual(net_rows.tolist(), [11, 13])
+        self.assertEqual(find_net_row(net_rows, 10, 15), 11)
+        self.assertEqual(find_net_row(net_rows, 12, 15), 13)
+        self.assertEqual(find_net_row(net_rows, 12, 13), -1)
+        self.assertEqual(get_net_rows(sec_slice.rename(columns={"net": "x"})).size, 0)
+
+    def test_slice_columns(self):
+        df = pd.DataFrame([["Abc", 1.0, True], ["A1", np.nan, 2]])
+        self.assertEqual(
+            get_cell_types(df).tolist(),
+            [[CELL_ALPHA, CELL_NUM, CELL_NUM], [CELL_OTHER, CELL_EMPTY, CELL_NUM]],
+        )
+
+        sheet = self.make_sheet()
+        name_cols, amount_cols = get_slice_columns(sheet)
+        self.assertEqual(name_cols, [f"Unnamed: {i}" for i in range(4)])
+        self.assertEqual(amount_cols, [f"Unnamed: {i}" for i in range(4, 16)])
+
+    def test_section_input(self):
+        sheet = self.make_sheet()
+        section = {"name": "A", "start": 0, "end": len(sheet)}
+        sec_input = get_section_input(sheet, section)
+        self.assertEqual(sec_input["header"], "A. Schemes")
+        self.assertEqual(sec_input["name_cols"], ["name0", "name1", "name2"])
+        self.assertEqual(sec_input["labels"].tolist(), list(range(1, len(sheet))))
+        self.assertEqual(sec_input["amounts"].dtype, np.float64)
+        self.assertTrue(sec_input["amounts"].flags["C_CONTIGUOUS"])
+
+        sec_slice, name_cols, sec_header = prepare_section(sheet, section)
+        self.assertEqual(sec_slice.columns[3], "net")
+        self.assertEqual(sec_slice.columns[-1], "be_cur_total")
+        self.assertEqual(sec_slice.loc[6, "name0"], "Total - CENTRAL SECTOR")
+
+    def test_reconcile(self):
+        begs, ends = np.array([0, 1, 2]), np.array([6, 3, 2])
+        sums = get_segment_sums(np.arange(6.0), begs, ends)
+        self.assertEqual(sums.tolist(), [15.0, 3.0, 0.0])
+
+        sheet = self.make_sheet()
+        section = {"name": "A", "start": 0, "end": len(sheet)}
+        sec_arrays = SectionArrays(get_section_input(sheet, section), HeadTable())
+        self.assertEqual(reconcile_section(sec_arrays, "A. Schemes", 1, "A"), [])
+
+        sheet.iloc[6, 4:] = 25.0
+        sheet.iloc[11, 4:] = 8.0
+        sec_arrays = SectionArrays(get_section_input(sheet, section), HeadTable())
+        mismatches = reconcile_section(sec_arrays, "A. Schemes", 1, "A")
+        self.assertEqual(
+            [(m["kind"], m["row"], m["path"], m["delta"]) for m in mismatches],
+            [
+                ("total", 6, ["A. Schemes", "CENTRAL SECTOR"], 4.0),
+                ("net", 11, ["A. Schemes", "Receipts head"], 2.0),
+            ],
+        )
+
+    def test_layout_templates(self):
+        sheet = self.make_sheet()
+        templates = LayoutTemplates()
+        cols = templates.get_slice_columns(sheet, "layout")
+        self.assertEqual(templates.get_slice_columns(sheet[2:], "layout"), cols)
+        self.assertEqual(templates.stats, {"learned": 1, "reused": 1, "rejected": 0})
+
+        # numbers only in the first 11 amount columns, the net column becomes one
+        sheet2 = sheet.copy()
+        sheet2["Unnamed: 15"] = np.nan
+        sheet2.loc[0, "Unnamed: 3"] = 1.0
+        cols2 = templates.get_slice_columns(sheet2, "layout")
+        self.assertEqual(cols2, get_slice_columns(sheet2))
+        self.assertNotEqual(cols2, cols)
+        self.assertEqual(templates.stats["rejected"], 1)
+
+    def test_parse_stack_depth(self):
+        sheet = self.make_sheet()
+        section = {"name": "A", "start": 0, "end": len(sheet)}
+        sec_input = get_section_input(sheet, section)
+        sec_header = sec_input["header"]
+        sec_arrays = SectionArrays(sec_input, HeadTable())
+
+        parsed_sheet = {"amount_heads": []}
+        peak_size, peak_depth = run_parse_stack(sec_arrays, [sec_header], parsed_sheet)
+        self.assertEqual(len(parsed_sheet["amount_heads"]), 4)
+        self.assertGreaterEqual(peak_size, 1)
+        self.assertGreater(peak_depth, 1)
+
+    def test_head_index(self):
+        col = np.array(["a", np.nan, "b", "a", 1.0, "a"], dtype=object)
+        head_index = HeadIndex(col)
+        self.assertEqual(head_index.find("a", 0, 6), (0, 3))
+        self.assertEqual(head_index.find("a", 1, 4), (3, 1))
+        self.assertEqual(head_index.find("a", 1, 3), (-1, 0))
+        self.assertEqual(head_index.get_duplicates(), {"a": [0, 3, 5]})
+
+    def test_head_table(self):
+        head_table = HeadTable()
+        close_id = head_table.intern("Total - REVENUE")
+        open_id = head_table.intern("REVENUE")
+        self.assertEqual(len(head_table), 2)
+        self.assertEqual(head_table.get_close(open_id), close_id)
+        self.assertEqual(head_table.get_close(close_id), -1)
+        self.assertEqual(head_table.flags[open_id], HEAD_VALID | HEAD_CAPS)
+        self.assertTrue(head_table.flags[close_id] & HEAD_TOTAL)
+
+        col = np.array([" Net", 2.0, "1.0"], dtype=object)
+        ids, flags = head_table.classify_col(col)
+        self.assertEqual(ids.tolist(), [2, -1, 3])
+        self.assertEqual(flags.tolist(), [HEAD_VALID | HEAD_NET, 0, 0])
+
 
 if __name__ == "__main__":
     unittest.main()
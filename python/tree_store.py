@@ -0,0 +1,842 @@
+import itertools
+import logging
+import numpy as np
+import pandas as pd
+
+from collections import deque
+
+from budget_tree import BudgetNode, BudgetTreeUtils
+from parse_utils import AMOUNT_HEADS
+
+
+class TreeStore:
+    """
+    A built BudgetNode tree as arrays, one entry per node.
+
+    Nodes are laid out level by level (breadth first), so the children of
+    node i are the range child_offsets[i]:child_offsets[i + 1] in their
+    BudgetNode order and every depth is one range of depth_offsets. Names
+    and keys are interned, nodes hold ids into them:
+        parents:        int32[n], -1 for the root
+        depths:         int32[n]
+        child_offsets:  int64[n + 1]
+        name_ids:       int32[n], into names
+        key_ids:        int32[n], into keys
+        total_init:     float64[n]
+        total_children: float64[n]
+        is_int:         bool[n], every total_init of the subtree was an int
+
+    In the multi-measure mode every node also has a row of all amount
+    columns (AMOUNT_HEADS), total_init and total_children as matrices:
+        measures_init:     float64[n, 12], the head's amounts, else 0
+        measures_children: float64[n, 12], total_children of every measure
+    Every measure is summed on its own, by the steps and rule of the scalar
+    totals (see get_measures): a node counts its amount if positive, else
+    its children's sum, so the be_cur_total column equals the scalar. A
+    head with no be_cur_total so still counts its earlier years.
+    """
+
+    def __init__(self) -> None:
+        self.names: list[str] = []
+        self.keys: list[str] = []
+        self.key_index: dict[str, int] = {}
+
+        self.parents = np.zeros(0, dtype=np.int32)
+        self.depths = np.zeros(0, dtype=np.int32)
+        # depth d is the node range depth_offsets[d]:depth_offsets[d + 1]
+        self.depth_offsets = np.zeros(1, dtype=np.int64)
+        self.child_offsets = np.zeros(1, dtype=np.int64)
+        self.name_ids = np.zeros(0, dtype=np.int32)
+        self.key_ids = np.zeros(0, dtype=np.int32)
+        self.total_init = np.zeros(0)
+        self.total_children = np.zeros(0)
+        self.is_int = np.zeros(0, dtype=bool)
+        self.measures_init: np.ndarray = None
+        self.measures_children: np.ndarray = None
+
+    @classmethod
+    def from_node(cls, root: BudgetNode) -> "TreeStore":
+        all_nodes = [root]
+        all_children = []
+        for node in all_nodes:
+            child_beg = len(all_nodes)
+            all_nodes.extend(node.children)
+            all_children.append(list(range(child_beg, len(all_nodes))))
+
+        # views of a store with measures bring theirs, nodes have none
+        all_measures = [getattr(node, "measures_init", None) for node in all_nodes]
+        all_measures_children = [
+            getattr(node, "measures_children", None) for node in all_nodes
+        ]
+        return cls.from_lists(
+            [node.name for node in all_nodes],
+            [node.key for node in all_nodes],
+            all_children,
+            [node.total_init for node in all_nodes],
+            [node.total_children for node in all_nodes],
+            all_measures,
+            all_measures_children,
+        )
+
+    @classmethod
+    def from_heads(
+        cls,
+        root_name: str,
+        all_paths: list[list[str]],
+        amounts: list[float],
+        all_measures: list[list[float]] = None,
+    ) -> "TreeStore":
+        """
+        The tree of BudgetNode(root_name, 0) after add_child_ls(path, amount)
+        of every head and finalize(), built without the nodes, see TreeBuilder.
+        With all_measures (the heads' "amounts"), in the multi-measure mode.
+        """
+        builder = TreeBuilder(root_name, all_measures is not None)
+        if all_measures is None:
+            all_measures = [None] * len(all_paths)
+        for path, amount, measures in zip(all_paths, amounts, all_measures):
+            builder.add_head(path, amount, measures)
+
+        return builder.get_store()
+
+    @classmethod
+    def from_lists(
+        cls,
+        names: list[str],
+        keys: list[str],
+        all_children: list[list[int]],
+        total_init: list[float],
+        total_children: list[float],
+        all_measures: list[np.ndarray] = None,
+        all_measures_children: list[np.ndarray] = None,
+    ) -> "TreeStore":
+        """
+        Store of the nodes given by index, node 0 is the root. With measure
+        rows for some nodes (None for the rest, which get 0) the store is in
+        the multi-measure mode, and their sums are computed here, but for
+        the nodes with a row of all_measures_children (their total_children
+        of every measure).
+        """
+        store = cls()
+        name_index: dict[str, int] = {}
+
+        parents, depths, nchildren, name_ids, key_ids = [], [], [], [], []
+        node_order = []
+
+        # breadth first, children in order, so a node's children are
+        # consecutive and come after every node of the depth above
+        queue = deque([(0, -1, 0)])
+        while queue:
+            node_id, parent_idx, depth = queue.popleft()
+            node_idx = len(parents)
+            children = all_children[node_id]
+
+            node_order.append(node_id)
+            parents.append(parent_idx)
+            depths.append(depth)
+            nchildren.append(len(children))
+            name_ids.append(name_index.setdefault(names[node_id], len(name_index)))
+            key_ids.append(
+                store.key_index.setdefault(keys[node_id], len(store.key_index))
+            )
+
+            for child_id in children:
+                queue.append((child_id, node_idx, depth + 1))
+
+        store.names = list(name_index)
+        store.keys = list(store.key_index)
+        store.parents = np.array(parents, dtype=np.int32)
+        store.depths = np.array(depths, dtype=np.int32)
+        store.child_offsets = np.zeros(len(parents) + 1, dtype=np.int64)
+        # the root's children start right after it
+        store.child_offsets[0] = 1
+        store.child_offsets[1:] = 1 + np.cumsum(nchildren)
+        store.name_ids = np.array(name_ids, dtype=np.int32)
+        store.key_ids = np.array(key_ids, dtype=np.int32)
+        store.depth_offsets = np.searchsorted(store.depths, np.arange(depth + 2))
+        store.total_init = np.array(total_init, dtype=np.float64)[node_order]
+        store.total_children = np.array(total_children, dtype=np.float64)[node_order]
+        # BudgetNode sums stay ints unless a float is below, see get_int_mask
+        init_is_int = [isinstance(x, (int, np.integer)) for x in total_init]
+        init_is_int = np.array(init_is_int, dtype=bool)[node_order]
+        store.is_int = store.get_int_mask(init_is_int)
+
+        if all_measures is not None and any(x is not None for x in all_measures):
+            store.measures_init = np.zeros((len(store), len(AMOUNT_HEADS)))
+            for node_idx, node_id in enumerate(node_order):
+                if all_measures[node_id] is not None:
+                    store.measures_init[node_idx] = all_measures[node_id]
+
+            store.measures_children = np.zeros_like(store.measures_init)
+            is_known = np.zeros(len(store), dtype=bool)
+            if all_measures_children is not None:
+                for node_idx, node_id in enumerate(node_order):
+                    measures_children = all_measures_children[node_id]
+                    if measures_children is not None:
+                        store.measures_children[node_idx] = measures_children
+                        is_known[node_idx] = True
+            store.aggregate_measures(is_known)
+
+        logging.info(
+            f"Stored {len(store)} nodes, {len(store.names)} names,"
+            f" {store.nbytes} bytes of arrays"
+        )
+        return store
+
+    def __len__(self) -> int:
+        return len(self.parents)
+
+    @property
+    def nbytes(self) -> int:
+        all_arrays = [
+            self.parents,
+            self.depths,
+            self.child_offsets,
+            self.name_ids,
+            self.key_ids,
+            self.total_init,
+            self.total_children,
+            self.is_int,
+        ]
+        if self.measures_init is not None:
+            all_arrays += [self.measures_init, self.measures_children]
+        return sum(arr.nbytes for arr in all_arrays)
+
+    @property
+    def root(self) -> "TreeNodeView":
+        return TreeNodeView(self, 0)
+
+    def get_node(self, node_idx: int) -> "TreeNodeView":
+        return TreeNodeView(self, node_idx)
+
+    def get_totals(self) -> np.ndarray:
+        """BudgetNode.get_total of every node"""
+        return np.where(self.total_init > 0, self.total_init, self.total_children)
+
+    def get_measures(self, node_beg: int = 0, node_end: int = None) -> np.ndarray:
+        """
+        get_totals of every measure of the nodes node_beg:node_end, decided
+        per measure. None without measures.
+        """
+        if self.measures_init is None:
+            return None
+
+        if node_end is None:
+            node_end = len(self)
+        measures_init = self.measures_init[node_beg:node_end]
+        measures_children = self.measures_children[node_beg:node_end]
+        return np.where(measures_init > 0, measures_init, measures_children)
+
+    def sum_children(self, depth: int, child_vals: np.ndarray) -> np.ndarray:
+        """
+        Sums of child_vals (a value or a row per node of depth) over the
+        children of every node of depth - 1. bincount adds in index order,
+        which is children order, so the sums equal sum() over the children
+        bit for bit.
+        """
+        node_beg, child_beg = self.depth_offsets[depth - 1], self.depth_offsets[depth]
+        child_end = self.depth_offsets[depth + 1]
+        child_parents = self.parents[child_beg:child_end] - node_beg
+        nnodes = child_beg - node_beg
+        if child_vals.ndim == 1:
+            return np.bincount(child_parents, weights=child_vals, minlength=nnodes)
+
+        all_sums = [
+            np.bincount(child_parents, weights=col_vals, minlength=nnodes)
+            for col_vals in child_vals.T
+        ]
+        return np.stack(all_sums, axis=1)
+
+    def get_int_mask(self, init_is_int: np.ndarray) -> np.ndarray:
+        """Nodes with no float total_init in their subtree, from the deepest up"""
+        num_floats = (~init_is_int).astype(np.float64)
+        depth_offsets = self.depth_offsets
+        for depth in range(len(depth_offsets) - 2, 0, -1):
+            child_beg, child_end = depth_offsets[depth], depth_offsets[depth + 1]
+            node_rows = slice(depth_offsets[depth - 1], child_beg)
+            child_floats = num_floats[child_beg:child_end]
+            num_floats[node_rows] += self.sum_children(depth, child_floats)
+        return num_floats == 0
+
+    def aggregate_measures(self, is_known: np.ndarray) -> None:
+        """
+        measures_children of every node but the is_known ones, as sums of
+        their children's get_measures, one depth at a time from the deepest
+        """
+        depth_offsets = self.depth_offsets
+        for depth in range(len(depth_offsets) - 2, 0, -1):
+            child_beg, child_end = depth_offsets[depth], depth_offsets[depth + 1]
+            child_measures = self.get_measures(child_beg, child_end)
+            node_rows = slice(depth_offsets[depth - 1], child_beg)
+            measures_children = self.sum_children(depth, child_measures)
+            is_summed = ~is_known[node_rows]
+            self.measures_children[node_rows][is_summed] = measures_children[is_summed]
+
+    def get_preorder(self) -> tuple[np.ndarray, np.ndarray]:
+        """Depth-first (children in order) position and size of every subtree"""
+        depth_offsets = self.depth_offsets
+        sizes = np.ones(len(self), dtype=np.int64)
+        for depth in range(len(depth_offsets) - 2, 0, -1):
+            child_beg, child_end = depth_offsets[depth], depth_offsets[depth + 1]
+            child_sizes = self.sum_children(depth, sizes[child_beg:child_end])
+            sizes[depth_offsets[depth - 1] : child_beg] += child_sizes.astype(np.int64)
+
+        # a first child follows its parent, a later one the subtrees before it
+        pre = np.zeros(len(self), dtype=np.int64)
+        for depth in range(1, len(depth_offsets) - 1):
+            child_beg, child_end = depth_offsets[depth], depth_offsets[depth + 1]
+            child_sizes = sizes[child_beg:child_end]
+            sibling_sizes = np.cumsum(child_sizes) - child_sizes
+            child_parents = self.parents[child_beg:child_end]
+            first_childs = self.child_offsets[child_parents] - child_beg
+            sibling_sizes -= sibling_sizes[first_childs]
+            pre[child_beg:child_end] = pre[child_parents] + 1 + sibling_sizes
+
+        return pre, sizes
+
+    def get_path_names(self, node_idxes: np.ndarray, node_idx: int) -> np.ndarray:
+        """
+        Names from node_idx down to each of node_idxes (all in its subtree),
+        one row per node padded with None, filled one level at a time
+        """
+        base_depth = self.depths[node_idx]
+        rel_depths = self.depths[node_idxes] - base_depth
+        max_len = int(rel_depths.max()) + 1
+        names = np.array(self.names, dtype=object)
+
+        path_names = np.full((len(node_idxes), max_len), None, dtype=object)
+        cur_idxes = node_idxes.copy()
+        for col_idx in range(max_len - 1, -1, -1):
+            has_col = rel_depths >= col_idx
+            col_idxes = cur_idxes[has_col]
+            path_names[has_col, col_idx] = names[self.name_ids[col_idxes]]
+            cur_idxes[has_col] = self.parents[col_idxes]
+        return path_names
+
+    def serialize_rows(self, node_idx: int = 0) -> pd.DataFrame:
+        """
+        BudgetNode.serialize_rows in one pass: a row per leaf under node_idx,
+        depth first, with its path and total_init, and in the multi-measure
+        mode a column per measure
+        """
+        pre, sizes = self.get_preorder()
+        in_subtree = (pre >= pre[node_idx]) & (pre < pre[node_idx] + sizes[node_idx])
+        leaf_idxes = np.flatnonzero(in_subtree & self.get_leaf_mask())
+        leaf_idxes = leaf_idxes[np.argsort(pre[leaf_idxes])]
+
+        path_names = self.get_path_names(leaf_idxes, node_idx)
+        name_cols = [f"name{i}" for i in range(path_names.shape[1])]
+        df = pd.DataFrame(path_names, columns=name_cols)
+        amounts = self.total_init[leaf_idxes]
+        if self.is_int[leaf_idxes].all():
+            amounts = amounts.astype(np.int64)
+        df["amounts_inrcr"] = amounts
+        df["amounts_usdb"] = (
+            amounts * BudgetNode.INR_ONE_CRORE / BudgetNode.USD_TO_INR / 1e9
+        )
+        if self.measures_init is not None:
+            df[AMOUNT_HEADS] = self.measures_init[leaf_idxes]
+        return df
+
+    def serialize_edges(self, node_idx: int = 0) -> pd.DataFrame:
+        """
+        BudgetTreeUtils.serialize in one pass. Edges are made in the order of
+        its depth first walk, so the (unstable) sort orders ties the same:
+        ROOT to node_idx, then every node's children, an Unallocated edge
+        after the last child's subtree. In the multi-measure mode every edge
+        gets a column per measure.
+        """
+        pre, sizes = self.get_preorder()
+        in_subtree = (pre >= pre[node_idx]) & (pre < pre[node_idx] + sizes[node_idx])
+        in_subtree[node_idx] = False
+        child_idxes = np.flatnonzero(in_subtree)
+
+        name_abbrevs = np.array(
+            [BudgetTreeUtils.get_key_abbrev(name) for name in self.names], dtype=object
+        )
+        abbrevs = name_abbrevs[self.name_ids]
+        path_abbrevs = np.full(len(self), None, dtype=object)
+        path_abbrevs[node_idx] = "r_" + abbrevs[node_idx]
+        for depth in range(self.depths[node_idx] + 1, len(self.depth_offsets) - 1):
+            depth_idxes = child_idxes[self.depths[child_idxes] == depth]
+            parent_paths = path_abbrevs[self.parents[depth_idxes]]
+            path_abbrevs[depth_idxes] = parent_paths + "_" + abbrevs[depth_idxes]
+
+        # tree_dfs_inner only looks at nodes with children
+        node_idxes = np.append(node_idx, child_idxes)
+        total_init = self.total_init[node_idxes]
+        total_children = self.total_children[node_idxes]
+        nchildren = self.child_offsets[node_idxes + 1] - self.child_offsets[node_idxes]
+        has_children = nchildren > 0
+        frac_unalloc = np.divide(
+            total_init - total_children,
+            total_init,
+            out=np.zeros(len(node_idxes)),
+            where=total_init > 0,
+        )
+        is_unalloc = has_children & (frac_unalloc > 0.02)
+        unalloc_idxes = node_idxes[is_unalloc]
+
+        names = np.array(self.names, dtype=object)[self.name_ids]
+        edge_parents = self.parents[child_idxes]
+        source_names = np.concatenate(
+            [["ROOT"], names[edge_parents], names[unalloc_idxes]]
+        )
+        dest_names = np.concatenate(
+            [
+                [names[node_idx]],
+                names[child_idxes],
+                np.full(len(unalloc_idxes), "Unallocated", dtype=object),
+            ]
+        )
+        source_abbrevs = np.concatenate(
+            [["r"], path_abbrevs[edge_parents], path_abbrevs[unalloc_idxes]]
+        )
+        dest_abbrevs = np.concatenate(
+            [
+                [path_abbrevs[node_idx]],
+                path_abbrevs[child_idxes],
+                path_abbrevs[unalloc_idxes] + "_u",
+            ]
+        )
+        totals = self.get_totals()
+        unalloc_amounts = (total_init - total_children)[is_unalloc]
+        amounts = np.concatenate(
+            [[totals[node_idx]], totals[child_idxes], unalloc_amounts]
+        )
+        if self.is_int[node_idx]:
+            amounts = amounts.astype(np.int64)
+
+        # an Unallocated edge comes after the last node of its parent's
+        # subtree, and after those of the nodes deeper on that last path
+        edge_idxes = np.concatenate([[node_idx], child_idxes])
+        walk_pos = np.concatenate(
+            [pre[edge_idxes], pre[unalloc_idxes] + sizes[unalloc_idxes] - 1]
+        )
+        walk_unalloc = np.arange(len(walk_pos)) > len(child_idxes)
+        walk_depths = np.concatenate(
+            [np.zeros(len(edge_idxes)), -self.depths[unalloc_idxes]]
+        )
+        walk_order = np.lexsort((walk_depths, walk_unalloc, walk_pos))
+
+        df = pd.DataFrame(
+            {
+                "source_name": source_names[walk_order],
+                "dest_name": dest_names[walk_order],
+                "source_abbrev": source_abbrevs[walk_order],
+                "dest_abbrev": dest_abbrevs[walk_order],
+                "amount": amounts[walk_order],
+            }
+        )
+        df.sort_values(["source_abbrev", "dest_abbrev"], inplace=True)
+        df["amount_inr"] = df["amount"] * BudgetNode.INR_ONE_CRORE
+        df["amount_usd"] = df["amount_inr"] / BudgetNode.USD_TO_INR
+
+        if self.measures_init is not None:
+            all_measures = self.get_measures()
+            unalloc_measures = self.measures_init - self.measures_children
+            unalloc_measures = unalloc_measures[unalloc_idxes]
+            edge_measures = np.concatenate([all_measures[edge_idxes], unalloc_measures])
+            df[AMOUNT_HEADS] = edge_measures[walk_order][df.index]
+        return df
+
+    def get_leaf_mask(self) -> np.ndarray:
+        return self.child_offsets[1:] == self.child_offsets[:-1]
+
+    def get_path(self, node_idx: int) -> list[str]:
+        all_names = []
+        while node_idx >= 0:
+            all_names.append(self.names[self.name_ids[node_idx]])
+            node_idx = int(self.parents[node_idx])
+        return all_names[::-1]
+
+    def adjust_totals_with_children(self) -> pd.DataFrame:
+        """
+        BudgetNode.adjust_totals_with_children of the whole tree, one depth
+        at a time from the deepest up: total_children is the sum of the
+        children's totals, and a total_init below it is raised to it. The
+        raised nodes are returned and logged as one table. A second run
+        raises nothing, so it can follow every edit.
+        """
+        depth_offsets = self.depth_offsets
+        all_raised_idxes = [np.zeros(0, dtype=np.int64)]
+        all_raised_inits = [np.zeros(0)]
+        # leaves sum no children
+        self.total_children[depth_offsets[-2] :] = 0
+        if self.measures_init is not None:
+            self.measures_children[depth_offsets[-2] :] = 0
+
+        for depth in range(len(depth_offsets) - 2, 0, -1):
+            child_beg, child_end = depth_offsets[depth], depth_offsets[depth + 1]
+            node_beg, node_end = depth_offsets[depth - 1], child_beg
+
+            child_inits = self.total_init[child_beg:child_end]
+            child_totals = np.where(
+                child_inits > 0, child_inits, self.total_children[child_beg:child_end]
+            )
+            total_children = self.sum_children(depth, child_totals)
+            self.total_children[node_beg:node_end] = total_children
+
+            total_init = self.total_init[node_beg:node_end]
+            is_raised = (total_init != 0) & (total_children != 0)
+            is_raised &= total_init < total_children
+            all_raised_idxes.append(node_beg + np.flatnonzero(is_raised))
+            all_raised_inits.append(total_init[is_raised])
+
+            if self.measures_init is not None:
+                # the same rule on every measure, each raised on its own
+                child_measures = self.get_measures(child_beg, child_end)
+                measures_children = self.sum_children(depth, child_measures)
+                self.measures_children[node_beg:node_end] = measures_children
+                measures_init = self.measures_init[node_beg:node_end]
+                is_raised_m = (measures_init != 0) & (measures_children != 0)
+                is_raised_m &= measures_init < measures_children
+                measures_init[is_raised_m] = measures_children[is_raised_m]
+
+            total_init[is_raised] = total_children[is_raised]
+
+        raised_idxes = np.concatenate(all_raised_idxes)
+        table = pd.DataFrame(
+            {
+                "node": raised_idxes,
+                "path": [" / ".join(self.get_path(x)) for x in raised_idxes.tolist()],
+                "total_init": np.concatenate(all_raised_inits),
+                "total_children": self.total_children[raised_idxes],
+            }
+        )
+        if len(table) > 0:
+            logging.warn(
+                f"Raised {len(table)} totals to their children's:\n"
+                f"{table.to_string(index=False)}"
+            )
+        return table
+
+
+# the keys BudgetNode.add_child_ls sorts children by, see BudgetNode.children,
+# indexes into TreeBuilder.get_sort_vals
+ORDER_INIT = 0
+ORDER_MAX = 1
+MAX_SORT_KEYS = BudgetNode.MAX_SORT_KEYS
+
+
+class TreeBuilder:
+    """
+    Builds the tree that BudgetNode.add_child_ls of each head followed by
+    finalize() builds, on node ids in lists instead of BudgetNodes. A
+    (parent id, key) dict replaces the walk of get_child per level, every
+    distinct name is sanitized once, and the first head through a node
+    decides its name and total_init.
+
+    The children order of add_child_ls depends on the order of the inserts,
+    ties keep the order left by the previous sort. Nodes keep the change
+    stamps and pending keys of BudgetNode for it (see BudgetNode.children),
+    and every node is sorted once, in get_store.
+    """
+
+    def __init__(self, root_name: str, measures: bool = False) -> None:
+        self.names: list[str] = []
+        self.keys: list[str] = []
+        self.all_children: list[list[int]] = []
+        self.total_init: list[float] = []
+        self.total_children: list[float] = []
+        # as BudgetNode._rec_children, _total_is_rec, _sort_keys, _sort_vals
+        # and _seqs
+        self.rec_children: list[float] = []
+        self.total_is_rec: list[bool] = []
+        self.sort_keys: list[list[tuple[int, int]]] = []
+        self.sort_vals: list[tuple[float, float]] = []
+        self.seqs: list[list[int]] = []
+        self.change_seq = itertools.count()
+        # a head's amounts, None for nodes no head created
+        self.all_measures: list[np.ndarray] = []
+        # with measures, rec_children and total_children of every measure,
+        # kept by the same steps as the scalars
+        self.measures = measures
+        self.rec_measures: list[np.ndarray] = []
+        self.measures_children: list[np.ndarray] = []
+
+        self.child_ids: dict[tuple[int, str], int] = {}
+        self.name_keys: dict[str, str] = {}
+        self.add_node(-1, root_name, 0)
+
+    def get_key(self, name: str) -> str:
+        key = self.name_keys.get(name)
+        if key is None:
+            key = self.name_keys[name] = BudgetNode.sanitize_str(name)
+        return key
+
+    def add_node(self, parent_id: int, name: str, total_init: float) -> int:
+        node_id = len(self.names)
+        self.names.append(BudgetNode.clean_name(name))
+        self.keys.append(self.get_key(name))
+        self.all_children.append([])
+        self.total_init.append(total_init)
+        self.total_children.append(0)
+        self.rec_children.append(0)
+        self.total_is_rec.append(False)
+        self.sort_keys.append([])
+        self.sort_vals.append(self.get_sort_vals(node_id))
+        self.seqs.append([next(self.change_seq)] * len(self.sort_vals[node_id]))
+        self.all_measures.append(None)
+        if self.measures:
+            self.rec_measures.append(np.zeros(len(AMOUNT_HEADS)))
+            self.measures_children.append(np.zeros(len(AMOUNT_HEADS)))
+
+        if parent_id >= 0:
+            self.all_children[parent_id].append(node_id)
+            self.child_ids[(parent_id, self.keys[node_id])] = node_id
+        return node_id
+
+    def get_rec(self, node_id: int) -> float:
+        # BudgetNode._get_total_rec
+        if self.total_init[node_id] > 0:
+            return self.total_init[node_id]
+
+        return self.rec_children[node_id]
+
+    def get_rec_measures(self, node_id: int) -> np.ndarray:
+        # get_rec of every measure
+        measures_init = self.all_measures[node_id]
+        if measures_init is None:
+            return self.rec_measures[node_id].copy()
+
+        return np.where(measures_init > 0, measures_init, self.rec_measures[node_id])
+
+    def get_sort_vals(self, node_id: int) -> tuple[float, float]:
+        # by ORDER_INIT and ORDER_MAX
+        total_init = self.total_init[node_id]
+        return total_init, max(total_init, self.total_children[node_id])
+
+    def sort_children(self, node_id: int) -> None:
+        # BudgetNode._flush_sort
+        sort_keys = self.sort_keys[node_id]
+        if len(sort_keys) == 0:
+            return
+
+        def get_sort_key(child_id: int) -> tuple:
+            sort_vals, seqs = self.sort_vals[child_id], self.seqs[child_id]
+            sort_key = []
+            for order, seq_beg in sort_keys:
+                seq = seqs[order] if abs(seqs[order]) > seq_beg else seq_beg
+                sort_key += [sort_vals[order], -seq]
+            return tuple(sort_key)
+
+        self.all_children[node_id].sort(key=get_sort_key, reverse=True)
+        self.sort_keys[node_id] = []
+
+    def set_order(self, node_id: int, order: int) -> None:
+        # BudgetNode._set_sort_key
+        sort_keys = self.sort_keys[node_id]
+        if len(sort_keys) == 0 or sort_keys[0][0] != order:
+            sort_keys.insert(0, (order, next(self.change_seq)))
+            del sort_keys[MAX_SORT_KEYS:]
+
+    def touch(self, node_id: int) -> None:
+        # BudgetNode._touch
+        sort_vals, seqs = self.get_sort_vals(node_id), self.seqs[node_id]
+        for order, val in enumerate(sort_vals):
+            if val > self.sort_vals[node_id][order]:
+                seqs[order] = next(self.change_seq)
+            elif val < self.sort_vals[node_id][order]:
+                seqs[order] = -next(self.change_seq)
+        self.sort_vals[node_id] = sort_vals
+
+    def add_head(
+        self, path: list[str], amount: float, measures: list[float] = None
+    ) -> None:
+        if len(path) == 0:
+            logging.warn(f"Empty child list for {self.names[0]}")
+            return
+
+        # down the path as add_child_ls recurses, creating the missing nodes
+        path_ids = [0]
+        all_rec_prev, all_rec_prev_m = [], []
+        for depth, name in enumerate(path):
+            parent_id = path_ids[-1]
+            child_id = self.child_ids.get((parent_id, self.get_key(name)))
+            if child_id is None:
+                child_total = amount if depth == len(path) - 1 else 0
+                # BudgetNode.add_child
+                self.set_order(parent_id, ORDER_INIT)
+                child_id = self.add_node(parent_id, name, child_total)
+                if depth == len(path) - 1 and measures is not None:
+                    self.all_measures[child_id] = np.asarray(measures, dtype=np.float64)
+                self.rec_children[parent_id] += self.get_rec(child_id)
+                self.total_children[parent_id] += child_total
+                self.total_is_rec[parent_id] = False
+                self.touch(parent_id)
+                if self.measures:
+                    self.rec_measures[parent_id] += self.get_rec_measures(child_id)
+                    if self.all_measures[child_id] is not None:
+                        self.measures_children[parent_id] += self.all_measures[child_id]
+
+            path_ids.append(child_id)
+            all_rec_prev.append(self.get_rec(child_id))
+            if self.measures:
+                all_rec_prev_m.append(self.get_rec_measures(child_id))
+
+        # and back up as it returns, all but the leaf's parent get the change
+        for depth in range(len(path) - 2, -1, -1):
+            node_id, child_id = path_ids[depth], path_ids[depth + 1]
+            # BudgetNode._update_total_children
+            self.set_order(node_id, ORDER_MAX)
+            self.rec_children[node_id] += self.get_rec(child_id) - all_rec_prev[depth]
+            self.total_children[node_id] = self.get_rec(node_id)
+            self.total_is_rec[node_id] = True
+            self.touch(node_id)
+            if self.measures:
+                rec_change = self.get_rec_measures(child_id) - all_rec_prev_m[depth]
+                self.rec_measures[node_id] += rec_change
+                self.measures_children[node_id] = self.get_rec_measures(node_id)
+
+    def finalize(self) -> None:
+        """BudgetNode.finalize of the root"""
+        for node_id in range(len(self.names)):
+            self.sort_children(node_id)
+
+        # children come after their parent, so backwards is bottom up
+        for node_id in range(len(self.names) - 1, -1, -1):
+            rec_children = 0
+            for child_id in self.all_children[node_id]:
+                rec_children += self.get_rec(child_id)
+
+            self.rec_children[node_id] = rec_children
+            if self.total_is_rec[node_id]:
+                self.total_children[node_id] = self.get_rec(node_id)
+
+            if self.measures:
+                rec_measures = np.zeros(len(AMOUNT_HEADS))
+                for child_id in self.all_children[node_id]:
+                    rec_measures += self.get_rec_measures(child_id)
+                self.rec_measures[node_id] = rec_measures
+                if self.total_is_rec[node_id]:
+                    self.measures_children[node_id] = self.get_rec_measures(node_id)
+
+    def get_store(self) -> TreeStore:
+        self.finalize()
+        return TreeStore.from_lists(
+            self.names,
+            self.keys,
+            self.all_children,
+            self.total_init,
+            self.total_children,
+            self.all_measures,
+            self.measures_children if self.measures else None,
+        )
+
+
+class TreeNodeView:
+    """
+    One node of a TreeStore, read-only, with the BudgetNode methods that
+    read a finished tree (children, get_child, serialize, ...). Views are
+    made on access and only hold the store and the node index.
+    """
+
+    # _seqs orders ties when a BudgetNode holds the view as a child
+    __slots__ = ("store", "idx", "_seqs")
+
+    def __init__(self, store: TreeStore, idx: int) -> None:
+        self.store = store
+        self.idx = idx
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, TreeNodeView):
+            return NotImplemented
+        return self.store is other.store and self.idx == other.idx
+
+    def __hash__(self) -> int:
+        return hash((id(self.store), self.idx))
+
+    @property
+    def name(self) -> str:
+        return self.store.names[self.store.name_ids[self.idx]]
+
+    @property
+    def key(self) -> str:
+        return self.store.keys[self.store.key_ids[self.idx]]
+
+    @property
+    def total_init(self) -> float:
+        if self.store.is_int[self.idx]:
+            return int(self.store.total_init[self.idx])
+        return float(self.store.total_init[self.idx])
+
+    @property
+    def total_children(self) -> float:
+        if self.store.is_int[self.idx]:
+            return int(self.store.total_children[self.idx])
+        return float(self.store.total_children[self.idx])
+
+    @property
+    def measures_init(self) -> np.ndarray:
+        if self.store.measures_init is None:
+            return None
+        return self.store.measures_init[self.idx]
+
+    @property
+    def measures_children(self) -> np.ndarray:
+        if self.store.measures_init is None:
+            return None
+        return self.store.measures_children[self.idx]
+
+    @property
+    def parent(self) -> "TreeNodeView":
+        parent_idx = int(self.store.parents[self.idx])
+        return None if parent_idx < 0 else TreeNodeView(self.store, parent_idx)
+
+    @property
+    def children(self) -> list["TreeNodeView"]:
+        child_beg = int(self.store.child_offsets[self.idx])
+        child_end = int(self.store.child_offsets[self.idx + 1])
+        return [TreeNodeView(self.store, idx) for idx in range(child_beg, child_end)]
+
+    def to_node(self) -> BudgetNode:
+        """A BudgetNode copy of the subtree, for code that edits the tree"""
+        node = BudgetNode(self.name, self.total_init)
+        node.key = self.key
+        for child in self.children:
+            child_node = child.to_node()
+            node._insert_child(child_node)
+            node._rec_children += child_node._get_total_rec()
+
+        node.total_children = self.total_children
+        return node
+
+    def get_total(self) -> float:
+        if self.total_init > 0:
+            return self.total_init
+
+        return self.total_children
+
+    def get_child(self, child_str: str) -> "TreeNodeView":
+        key_id = self.store.key_index.get(self.sanitize_str(child_str), -1)
+        child_beg = int(self.store.child_offsets[self.idx])
+        child_end = int(self.store.child_offsets[self.idx + 1])
+        child_idxes = np.flatnonzero(self.store.key_ids[child_beg:child_end] == key_id)
+        if len(child_idxes) > 0:
+            # the last of a key wins, as in BudgetNode.child_index
+            return TreeNodeView(self.store, child_beg + int(child_idxes[-1]))
+        else:
+            logging.warn(f'Child "{child_str}" not found in "{self.name}"')
+            return None
+
+    def serialize_rows(self) -> pd.DataFrame:
+        return self.store.serialize_rows(self.idx)
+
+    def serialize_edges(self) -> pd.DataFrame:
+        return self.store.serialize_edges(self.idx)
+
+    # views are not in a PathIndex, get_child_ls walks them
+    _path_index = None
+
+    # the rest only reads the node through the attributes above
+    sanitize_str = staticmethod(BudgetNode.sanitize_str)
+    get_child_ls = BudgetNode.get_child_ls
+    get_total_children_recursive = BudgetNode.get_total_children_recursive
+    # a view keeps no running sums, for BudgetNode.add_child_node
+    _get_total_rec = BudgetNode.get_total_children_recursive
+    __str__ = BudgetNode.__str__
+    serialize = BudgetNode.serialize
+    serialize_amount = BudgetNode.serialize_amount
+    _serialize_rows_inner = BudgetNode._serialize_rows_inner
+    get_root_edge = BudgetNode.get_root_edge